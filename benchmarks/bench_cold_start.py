@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks the cold-start time of the nifti_roi CLI (i.e. a new interpreter for each run), for code paths that
+should not import any heavy modules ('--help', '--dump-atlases', an argument error and a bare module import),
+along with the heavy modules (numpy, pandas, nibabel, scipy, and the server, zip and memory tracing modules) that
+each of them imports.
+
+Usage: python benchmarks/bench_cold_start.py [--repeats INT] [--save FILE.json]
+'''
+
+# Import modules
+import os
+import sys
+import json
+import time
+import subprocess
+import argparse
+
+# Define global variable(s)
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+script = os.path.join(repo_dir,"nifti_roi.py")
+
+# Heavy modules that should be deferred
+heavy_modules = ["numpy","pandas","nibabel","scipy","http.server","urllib.request","zipfile","tracemalloc"]
+
+# Benchmark name -> interpreter arguments
+commands = {
+    "python (no-op)": ["-c","pass"],
+    "import nifti_roi": ["-c",f"import sys; sys.path.insert(0,{repo_dir!r}); import nifti_roi"],
+    "--help": [script,"--help"],
+    "--dump-atlases": [script,"--dump-atlases"],
+    "argument error": [script,"--thresh","not-a-number"]}
+
+# Define functions
+
+def time_cmd(args,repeats):
+    '''
+    Returns the best wall time (in seconds) of some interpreter command over a number of repeats.
+    '''
+
+    best = float("inf")
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+        best = min(best,time.perf_counter() - start)
+
+    return best
+
+def imported_modules(args):
+    '''
+    Returns the heavy modules imported by some interpreter command (by running it with its exit deferred).
+    '''
+
+    code = "import sys, runpy\n"
+    if args[0] == "-c":
+        code += args[1] + "\n"
+    else:
+        code += f"sys.argv = {args!r}\ntry:\n    runpy.run_path({args[0]!r},run_name='__main__')\nexcept SystemExit:\n    pass\n"
+    code += f"print('modules:' + ','.join(m for m in {heavy_modules!r} if m in sys.modules))"
+
+    result = subprocess.run([sys.executable,"-c",code],capture_output=True,text=True)
+    lines = [line for line in result.stdout.splitlines() if line.startswith("modules:")]
+
+    return lines[-1][len("modules:"):] if lines else "?"
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmarks the cold-start time of the nifti_roi CLI.")
+    parser.add_argument('--repeats',type=int,default=5,help="Number of timing repeats. [default: 5]")
+    parser.add_argument('--save',type=str,default="",help="Write results to this JSON file.")
+    args = parser.parse_args()
+
+    results = dict()
+
+    print(f"{'Command':<20} {'Best (ms)':>10}  Heavy modules imported")
+    for name,cmd in commands.items():
+        results[name] = time_cmd(cmd,args.repeats)
+        print(f"{name:<20} {results[name]*1000:10.1f}  {imported_modules(cmd) or '-'}")
+
+    if args.save:
+        with open(args.save,"w") as f:
+            json.dump({"python":sys.version.split()[0],"repeats":args.repeats,"results":results},f,indent=2)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks the vectorized voxel-overlap engine in nifti_roi.get_roi_name against the original
+per-voxel Python loop, using the bundled infant AAL atlas (files.atlases/infant-neo-aal-2mm.nii).
+
+Usage: python benchmarks/bench_get_roi_name.py [--repeats INT] [--clusters INT]
+'''
+
+# Import modules
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import nibabel as nib
+
+# Define global variable(s)
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+atlas_dir = os.path.join(repo_dir,"files.atlases")
+
+sys.path.insert(0,repo_dir)
+import nifti_roi
+
+# Define functions
+
+def legacy_get_roi_name(cluster_data,atlas_data,atlas_dict):
+    '''
+    Original (per-voxel loop) implementation of get_roi_name, kept for comparison.
+    '''
+
+    cluster_data = cluster_data.flatten(order='C')
+    atlas_data = atlas_data.flatten(order='C')
+
+    roi_list = list()
+
+    for idx,val in enumerate(cluster_data):
+        if cluster_data[idx] == 0:
+            atlas_data[idx] = 0
+
+    for i in np.unique(atlas_data)[1:]:
+        roi_list.append(atlas_dict[i])
+
+    return roi_list
+
+def make_clusters(shape,n_clusters=20,radius=4,seed=0):
+    '''
+    Creates a synthetic volume of enumerated spherical clusters.
+    '''
+
+    rng = np.random.default_rng(seed)
+    cluster_data = np.zeros(shape)
+    [x,y,z] = np.ogrid[:shape[0],:shape[1],:shape[2]]
+
+    for i in range(1,n_clusters + 1):
+        center = [rng.integers(radius,dim - radius) for dim in shape]
+        ball = (x - center[0])**2 + (y - center[1])**2 + (z - center[2])**2 <= radius**2
+        cluster_data[ball] = i
+
+    return cluster_data
+
+def time_func(func,repeats,*args):
+    '''
+    Returns the best wall time (in seconds) of some function over a number of repeats, along with its result.
+    '''
+
+    best = float("inf")
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best,time.perf_counter() - start)
+
+    return best,result
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmarks get_roi_name against the original per-voxel loop.")
+    parser.add_argument('--repeats',type=int,default=3,help="Number of timing repeats. [default: 3]")
+    parser.add_argument('--clusters',type=int,default=20,help="Number of synthetic clusters. [default: 20]")
+    args = parser.parse_args()
+
+    nii_atlas = os.path.join(atlas_dir,"infant-neo-aal-2mm.nii")
+    atlas_info = os.path.join(atlas_dir,"infant-neo-aal.csv")
+
+    atlas_data = np.rint(nib.load(nii_atlas).get_fdata())
+    atlas_dict = nifti_roi.read_atlas_file(atlas_info)
+    cluster_data = make_clusters(atlas_data.shape,args.clusters)
+
+    # The legacy implementation mutates its input, hence the copies
+    [t_legacy,rois_legacy] = time_func(lambda: legacy_get_roi_name(cluster_data.copy(),atlas_data.copy(),atlas_dict),args.repeats)
+    [t_new,rois_new] = time_func(lambda: nifti_roi.get_roi_name(cluster_data,atlas_data,atlas_dict),args.repeats)
+
+    print(f"Atlas:          {nii_atlas} {atlas_data.shape} ({atlas_data.size} voxels)")
+    print(f"Clusters:       {args.clusters} ({int(np.count_nonzero(cluster_data))} voxels)")
+    print(f"Legacy loop:    {t_legacy * 1000:10.2f} ms")
+    print(f"Vectorized:     {t_new * 1000:10.2f} ms")
+    print(f"Speedup:        {t_legacy / t_new:10.1f}x")
+    print(f"Identical ROIs: {rois_legacy == rois_new} ({len(rois_new)} ROIs)")
+
+    if rois_legacy != rois_new:
+        sys.exit(1)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+'''
+Stage-level benchmarks of nifti_roi. Synthetic stat maps are generated at several grid sizes (2mm, 1mm, 0.5mm)
+and cluster densities (fraction of suprathreshold voxels) against the bundled infant AAL atlas
+(files.atlases/infant-neo-aal-2mm.nii, resampled to each grid), and each processing stage is timed separately:
+cluster labeling, local maxima, atlas load (decode and cached), overlap (of dense and sparse clusters), label lookup, FSL atlas (peak) lookup,
+bulk coordinate labeling and output writing.
+
+FSL is not required: FSL atlas lookups use a local stand-in $FSLDIR (the bundled atlas, described as FSL's
+'Talairach Daemon Labels' atlas), which is queried by the in-process atlas engine.
+
+Results are written as JSON (--save), and may be compared against a saved baseline (--baseline). The script
+exits with a non-zero status if any stage is slower than the baseline by more than the threshold.
+
+Usage: python benchmarks/bench_stages.py [--grids 2mm 1mm 0.5mm] [--densities FLOAT ...] [--repeats INT]
+                                         [--save FILE.json] [--baseline FILE.json] [--threshold FLOAT]
+'''
+
+# Import modules
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy import ndimage
+
+# Define global variable(s)
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+atlas_dir = os.path.join(repo_dir,"files.atlases")
+
+sys.path.insert(0,repo_dir)
+import nifti_roi
+
+# Grid name -> upsampling factor of the (2mm) bundled atlas
+grid_factors = {"2mm": 1, "1mm": 2, "0.5mm": 4}
+
+# FSL atlas number of the stand-in FSL atlas
+fsl_atlas_num = 19
+
+# Number of coordinates labeled in bulk
+n_coords = 100000
+
+# Minimum distance (mm) between local maxima
+peak_dist = 8
+
+# Define functions
+
+def time_func(func,repeats,*args):
+    '''
+    Returns the best wall time (in seconds) of some function over a number of repeats, along with its result.
+    '''
+
+    best = float("inf")
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best,time.perf_counter() - start)
+
+    return best,result
+
+def make_grid_atlas(nii_atlas,factor,out_dir):
+    '''
+    Resamples (nearest neighbour) some atlas onto a grid that is finer by some integer factor, and writes it to file.
+    '''
+
+    img = nib.load(nii_atlas)
+    data = np.asarray(img.dataobj)
+
+    if factor == 1:
+        return nii_atlas,data.shape
+
+    for axis in range(3):
+        data = np.repeat(data,factor,axis=axis)
+
+    affine = img.affine.copy()
+    affine[:3,:3] = affine[:3,:3] / factor
+    affine[:3,3] = affine[:3,3] - affine[:3,:3] @ np.full(3,(factor - 1)/2)
+
+    out_file = os.path.join(out_dir,f"atlas-x{factor}.nii.gz")
+    nib.save(nib.Nifti1Image(data,affine),out_file)
+
+    return out_file,data.shape
+
+def make_stat_map(nii_atlas,density,out_file,seed=0):
+    '''
+    Creates a synthetic (smoothed noise) stat map in the voxel grid of some atlas, scaled such that the given
+    fraction of voxels is above 1.0 (i.e. suprathreshold at a threshold of 1.0).
+    '''
+
+    img = nib.load(nii_atlas)
+    shape = img.shape[:3]
+    factor = max(int(round(2/min(img.header.get_zooms()[:3]))),1)
+
+    # Smooth at 2mm, then upsample, such that cluster shapes do not depend on the grid size
+    rng = np.random.default_rng(seed)
+    data = ndimage.gaussian_filter(rng.standard_normal([dim // factor for dim in shape]),2).astype(np.float32)
+    for axis in range(3):
+        data = np.repeat(data,factor,axis=axis)
+    data = data / np.quantile(data,1 - density)
+
+    nib.save(nib.Nifti1Image(data,img.affine),out_file)
+
+    return out_file
+
+def make_fsl_dir(nii_atlas,atlas_info,out_dir):
+    '''
+    Creates a stand-in $FSLDIR with a single label atlas (described as FSL atlas 'fsl_atlas_num'). As in FSL's label
+    atlas descriptions, the label of image value v is written with an index of v - 1.
+    '''
+
+    fsl_atlas_dir = os.path.join(out_dir,"data","atlases")
+    os.makedirs(os.path.join(fsl_atlas_dir,"Bench"),exist_ok=True)
+    shutil.copy(nii_atlas,os.path.join(fsl_atlas_dir,"Bench","bench.nii"))
+
+    labels = "".join(f'<label index="{key - 1}" x="0" y="0" z="0">{name}</label>\n' for key,name in nifti_roi.read_atlas_file(atlas_info).items() if key > 0)
+
+    with open(os.path.join(fsl_atlas_dir,"Bench.xml"),"w") as f:
+        f.write('<?xml version="1.0" encoding="ISO-8859-1"?>\n<atlas version="1.0">\n')
+        f.write(f"<header><name>{nifti_roi.vol_atlas_dict[fsl_atlas_num]}</name><type>Label</type>\n")
+        f.write("<images><imagefile>/Bench/bench</imagefile></images>\n</header>\n")
+        f.write(f"<data>\n{labels}</data></atlas>\n")
+
+    return out_dir
+
+def bench_grid(grid,densities,repeats,work_dir):
+    '''
+    Times each processing stage of some grid size for several cluster densities.
+    '''
+
+    results = dict()
+
+    nii_atlas = os.path.join(atlas_dir,"infant-neo-aal-2mm.nii")
+    atlas_info = os.path.join(atlas_dir,"infant-neo-aal.csv")
+
+    [nii_atlas,shape] = make_grid_atlas(nii_atlas,grid_factors[grid],work_dir)
+
+    # Atlas load (decode, then memory-mapped from the atlas cache)
+    nifti_roi.cache_dir = os.path.join(work_dir,f"cache-{grid}")
+    [results[f"{grid}/atlas load"],_] = time_func(lambda: nifti_roi.load_atlas_data(nii_atlas,atlas_info,use_cache=False),repeats)
+    nifti_roi.load_atlas_data(nii_atlas,atlas_info)
+    [results[f"{grid}/atlas load (cached)"],[atlas_data,atlas_dict]] = time_func(lambda: nifti_roi.load_atlas_data(nii_atlas,atlas_info),repeats)
+    atlas_lut = nifti_roi.make_label_lut(atlas_dict)
+
+    fsl_atlas = nifti_roi.load_fsl_atlas(fsl_atlas_num)
+    fsl_atlas.load()
+
+    # Bulk coordinate labeling (integer mm coordinates, such that many are repeated)
+    coords = np.round(np.random.default_rng(0).uniform(-90,90,(n_coords,3)))
+    atlases = nifti_roi.load_atlases([fsl_atlas_num,(nii_atlas,atlas_info)])
+    [results[f"{grid}/label coords"],_] = time_func(lambda: nifti_roi.label_coords(coords,atlases),repeats)
+
+    for density in densities:
+        key = f"{grid}/{density:g}"
+
+        stat_file = make_stat_map(nii_atlas,density,os.path.join(work_dir,f"stat-{grid}-{density:g}.nii.gz"))
+        img = nib.load(stat_file)
+        img_data = nifti_roi.load_img_data(img)
+
+        [results[f"{key}/cluster"],[cluster_data,clust_table]] = time_func(lambda: nifti_roi.find_clusters(img_data,1.0,26,img.affine),repeats)
+        [results[f"{key}/overlap"],[overlap]] = time_func(lambda: nifti_roi.atlas_overlaps(cluster_data,[atlas_data]),repeats)
+        [results[f"{key}/cluster (sparse)"],clusters] = time_func(lambda: nifti_roi.sparse_clusters(img_data,1.0,26),repeats)
+        [results[f"{key}/overlap (sparse)"],_] = time_func(lambda: nifti_roi.atlas_overlaps(clusters,[atlas_data]),repeats)
+        [results[f"{key}/peaks"],_] = time_func(lambda: nifti_roi.find_peaks(img_data,clusters,img.affine,peak_dist),repeats)
+
+        labels = np.unique(overlap[1])
+        labels = labels[labels != 0]
+        [results[f"{key}/label lookup"],roi_list] = time_func(lambda: nifti_roi.label_names(labels,atlas_lut),repeats)
+        [results[f"{key}/table"],roi_table] = time_func(lambda: nifti_roi.overlap_table(overlap,clust_table,atlas_lut),repeats)
+
+        # Peak lookups are cached per coordinate, hence the cache is cleared before each repeat
+        [results[f"{key}/fsl lookup"],_] = time_func(lambda: (fsl_atlas.query_cache.clear(),nifti_roi.peak_rois(clust_table,fsl_atlas_num)),repeats)
+
+        out_file = os.path.join(work_dir,"out.csv")
+        table_file = os.path.join(work_dir,"out.tsv")
+        [results[f"{key}/write"],_] = time_func(lambda: (nifti_roi.write_spread(stat_file,out_file,roi_list),nifti_roi.write_table(stat_file,table_file,roi_table)),repeats)
+
+        print(f"{grid:>6} {density:>6g}: {shape} {len(clust_table):6d} clusters {len(roi_list):4d} ROIs",flush=True)
+
+    return results
+
+def compare(results,baseline,threshold=0.25,min_diff=0.001):
+    '''
+    Compares benchmark results against some baseline. Stages slower than the baseline by more than the
+    threshold (fraction) and by more than min_diff (seconds) are regressions.
+    '''
+
+    regressions = list()
+
+    print("")
+    print(f"{'Stage':<40} {'Baseline (ms)':>14} {'Current (ms)':>14} {'Change':>8}")
+
+    for key,value in results.items():
+        if key not in baseline:
+            continue
+        change = value/baseline[key] - 1 if baseline[key] > 0 else 0.0
+        regressed = change > threshold and value - baseline[key] > min_diff
+        print(f"{key:<40} {baseline[key]*1000:14.2f} {value*1000:14.2f} {change:+8.1%}{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(key)
+
+    return regressions
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Stage-level benchmarks of nifti_roi with synthetic stat maps.")
+    parser.add_argument('--grids',type=str,nargs='+',default=["2mm","1mm"],choices=list(grid_factors),help="Grid sizes. [default: 2mm 1mm]")
+    parser.add_argument('--densities',type=float,nargs='+',default=[0.01,0.05],help="Fractions of suprathreshold voxels. [default: 0.01 0.05]")
+    parser.add_argument('--repeats',type=int,default=3,help="Number of timing repeats. [default: 3]")
+    parser.add_argument('--save',type=str,default="",help="Write results to this JSON file.")
+    parser.add_argument('--baseline',type=str,default="",help="Compare results against this (saved) JSON file.")
+    parser.add_argument('--threshold',type=float,default=0.25,help="Regression threshold, as a fraction of the baseline time. [default: 0.25]")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="nifti_roi-bench-")
+
+    try:
+        os.environ["FSLDIR"] = make_fsl_dir(os.path.join(atlas_dir,"infant-neo-aal-2mm.nii"),os.path.join(atlas_dir,"infant-neo-aal.csv"),work_dir)
+
+        results = dict()
+        for grid in args.grids:
+            results.update(bench_grid(grid,args.densities,args.repeats,work_dir))
+    finally:
+        shutil.rmtree(work_dir,ignore_errors=True)
+
+    print("")
+    for key,value in results.items():
+        print(f"{key:<40} {value*1000:10.2f} ms")
+
+    if args.save:
+        with open(args.save,"w") as f:
+            json.dump({"python":platform.python_version(),
+                       "numpy":np.__version__,
+                       "pandas":pd.__version__,
+                       "platform":platform.platform(),
+                       "repeats":args.repeats,
+                       "results":results},f,indent=2)
+
+    if args.baseline:
+        with open(args.baseline,"r") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results,baseline,args.threshold)
+        if regressions:
+            print("")
+            print(f"{len(regressions)} stage(s) regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
@@ -41,18 +41,96 @@ Atlas Numbers (for atlasquery wrapper)
 import os
 import re
 import sys
-import numpy as np
-import pandas as pd
-import nibabel as nib
+import xml.etree.ElementTree as ET
 import subprocess
+import hashlib
+import json
+import tempfile
+import csv
+import glob
+import functools
+import collections
+import warnings
+import threading
+import time
+import contextlib
 import platform
+import resource
 
 # Import modules for argument parsing
 import argparse
 
+# Import supporting modules (see roilib)
+from roilib.lazy import LazyModule
+from roilib.stores import CsvStore, SqliteStore, ParquetStore, store_backends, store_backend, table_records, csv_name
+from roilib.pipeline import BatchPipeline
+
+# Deferred (heavy) module imports
+np = LazyModule("numpy","np",globals())
+pd = LazyModule("pandas","pd",globals())
+nib = LazyModule("nibabel","nib",globals())
+ndimage = LazyModule("scipy.ndimage","ndimage",globals())
+sparse = LazyModule("scipy.sparse","sparse",globals())
+csgraph = LazyModule("scipy.sparse.csgraph","csgraph",globals())
+spatial = LazyModule("scipy.spatial","spatial",globals())
+multiprocessing = LazyModule("multiprocessing","multiprocessing",globals())
+sqlite3 = LazyModule("sqlite3","sqlite3",globals())
+zipfile = LazyModule("zipfile","zipfile",globals())
+tracemalloc = LazyModule("tracemalloc","tracemalloc",globals())
+server = LazyModule("roilib.server","server",globals())
+
 # Define global variable(s)
 scripts_dir = os.path.dirname(os.path.realpath(__file__))
 
+# Voxel connectivity -> scipy.ndimage structuring element rank
+conn_rank = {6: 1, 18: 2, 26: 3}
+
+# FSL atlas number -> atlas name (for atlasquery)
+vol_atlas_dict = {
+    1: "Cerebellar Atlas in MNI152 space after normalization with FLIRT",
+    2: "Cerebellar Atlas in MNI152 space after normalization with FNIRT",
+    3: "Harvard-Oxford Cortical Structural Atlas",
+    4: "Harvard-Oxford Subcortical Structural Atlas",
+    5: "Human Sensorimotor Tracts Labels",
+    6: "JHU ICBM-DTI-81 White-Matter Labels",
+    7: "JHU White-Matter Tractography Atlas",
+    8: "Juelich Histological Atlas",
+    9: "MNI Structural Atlas",
+    10: "Mars Parietal connectivity-based parcellation",
+    11: "Mars TPJ connectivity-based parcellation",
+    12: "Neubert Ventral Frontal connectivity-based parcellation",
+    13: "Oxford Thalamic Connectivity Probability Atlas",
+    14: "Oxford-Imanova Striatal Connectivity Atlas 3 sub-regions",
+    15: "Oxford-Imanova Striatal Connectivity Atlas 7 sub-regions",
+    16: "Oxford-Imanova Striatal Structural Atlas",
+    17: "Sallet Dorsal Frontal connectivity-based parcellation",
+    18: "Subthalamic Nucleus Atlas",
+    19: "Talairach Daemon Labels"}
+
+# Decoded atlas (and cluster) cache directory and size cap (in bytes)
+cache_dir = os.environ.get("NIFTI_ROI_CACHE",os.path.join(os.path.expanduser("~"),".cache","nifti_roi"))
+cache_size = int(os.environ.get("NIFTI_ROI_CACHE_SIZE",1 << 30))
+
+# Per-stage peak memory (see mem_stage)
+mem_stats = list()
+
+# Per-stage profile records and profiler state (see mem_stage and start_profile)
+prof_stats = list()
+prof_state = {"enabled": False, "start": None}
+
+# Stages running in any thread (see mem_stage), such that stages that overlap the stages of other threads are marked
+running_stages = dict()
+running_lock = threading.Lock()
+
+# Metrics of the last pipelined batch run (see BatchPipeline.stats)
+pipe_stats = dict()
+
+# Atlas shared by batch workers
+batch_atlas = dict()
+
+# Loaded FSL atlases and atlas query results
+fsl_atlas_cache = dict()
+
 # Define class(es)
 
 class Command():
@@ -82,407 +160,4272 @@ class Command():
         self.cmd_list = [f"{self.command}"]
         return self.cmd_list
 
-# Define functions
-
-def run(cmd_list,stdout="",stderr=""):
+class FslAtlas():
     '''
-    Uses python's built-in subprocess class to run a command from an input command list.
-    The standard output and error can optionally be written to file.
+    In-process FSL atlas (i.e. an atlas in $FSLDIR/data/atlases), used in place of FSL's `atlasquery` to look up
+    the ROIs at some set of MNI space mm coordinates. The atlas XML description is parsed once, the (highest
+    resolution) atlas image is loaded on the first query, and query results are cached per coordinate.
     
-    Arguments:
-        cmd_list(list): Input command list to be run from the UNIX command line.
-        stdout(file): Output file to write standard output to.
-        stderr(file): Output file to write standard error to.
-    Returns:
-        stdout(file): Output file that contains the standard output.
-        stderr(file): Output file that contains the standard error.
+    Attributes:
+        name: Atlas name
+        atlas_type: Atlas type ('probabilistic' or 'label')
+        image_file: Atlas image file (4D probability image for probabilistic atlases, label image otherwise)
+        labels: Dictionary of label (volume) indices to ROI names
     '''
-    if stdout and stderr:
-        with open(stdout,"w") as file:
-            with open(stderr,"w") as file_err:
-                subprocess.call(cmd_list,stdout=file,stderr=file_err)
-                file.close(); file_err.close()
-    elif stdout:
-        with open(stdout,"w") as file:
-            subprocess.call(cmd_list,stdout=file)
-            file.close()
-        stderr = None
-    else:
-        subprocess.call(cmd_list)
-        stdout = None
-        stderr = None
+    
+    def __init__(self, xml_file):
+        '''
+        Init doc-string for FslAtlas class.
+        
+        Arguments:
+            xml_file (file): Atlas XML description file
+        '''
+        self.xml_file = os.path.abspath(xml_file)
+        atlas_dir = os.path.dirname(self.xml_file)
+        
+        tree = ET.parse(self.xml_file)
+        self.name = tree.findtext("header/name").strip()
+        self.atlas_type = tree.findtext("header/type").strip().lower()
+        
+        # Use the highest resolution image (as does atlasquery)
+        images = list()
+        for image in tree.findall("header/images"):
+            image_file = atlas_dir + image.findtext("imagefile").strip()
+            image_file = [file for file in [image_file + ".nii.gz",image_file + ".nii",image_file] if os.path.exists(file)][0]
+            images.append((min(nib.load(image_file).header.get_zooms()[:3]),image_file))
+        self.image_file = min(images)[1]
+        
+        # Probabilistic atlas labels refer to volume indices, label atlas labels refer to label values. Label atlases
+        # without 'value' attributes store the label of index i as the value i + 1 (0 is unlabelled), as atlasquery assumes.
+        self.labels = dict()
+        for label in tree.findall("data/label"):
+            index = int(label.get("index"))
+            if self.atlas_type == "probabilistic":
+                self.labels[index] = label.text.strip()
+            else:
+                self.labels[int(label.get("value",index + 1))] = label.text.strip()
+        
+        self.data = None
+        self.affine = None
+        self.query_cache = dict()
+    
+    def load(self):
+        '''
+        Loads the atlas image data (if not already loaded).
+        
+        Returns:
+            data (numpy array): Atlas image data
+        '''
+        if self.data is None:
+            img = nib.load(self.image_file)
+            self.data = np.asanyarray(img.dataobj)
+            self.affine = img.affine
+        return self.data
+    
+    def coords_to_vox(self, coords):
+        '''
+        Converts MNI space mm coordinates to (rounded) voxel coordinates in a single matrix operation.
+        
+        Arguments:
+            coords (numpy array): N x 3 array of mm coordinates
+        Returns:
+            vox (numpy array): N x 3 array of voxel coordinates
+            in_fov (numpy array): Boolean array, which is False for coordinates outside of the atlas field of view
+        '''
+        data = self.load()
+        coords = np.asarray(coords,dtype=np.float64).reshape(-1,3)
+        
+        vox = np.rint(nib.affines.apply_affine(np.linalg.inv(self.affine),coords)).astype(np.int64)
+        in_fov = np.all((vox >= 0) & (vox < np.array(data.shape[:3])),axis=1)
+        vox[~in_fov] = 0
+        
+        return vox,in_fov
+    
+    def values(self, coords):
+        '''
+        Looks up the atlas values at some set of MNI space mm coordinates.
+        
+        Arguments:
+            coords (numpy array): N x 3 array of mm coordinates
+        Returns:
+            values (numpy array): N x R array of probabilities (probabilistic atlases) or N array of labels (label atlases).
+                                  Coordinates outside of the atlas field of view have values of 0.
+        '''
+        [vox,in_fov] = self.coords_to_vox(coords)
+        
+        values = self.data[vox[:,0],vox[:,1],vox[:,2]]
+        values[~in_fov] = 0
+        
+        return values
+    
+    def format_values(self, values):
+        '''
+        Formats the atlas value(s) at a single coordinate as `atlasquery` does.
+        
+        Arguments:
+            values (numpy array): Probabilities or label at a single coordinate (see values)
+        Returns:
+            text (str): `atlasquery` text (e.g. '<b>Atlas name</b><br>53% ROI A, 2% ROI B')
+        '''
+        if self.atlas_type == "probabilistic":
+            result = self.prob_text(values)
+        else:
+            result = self.labels.get(int(values),"") if values else ""
+        
+        if not result:
+            result = "No label found!"
+        
+        return f"<b>{self.name}</b><br>{result}"
+    
+    def prob_text(self, values):
+        '''
+        Formats the (non-zero) probabilities of a probabilistic atlas at a single coordinate, in decreasing order.
+        
+        Arguments:
+            values (numpy array): Probabilities at a single coordinate (see values)
+        Returns:
+            text (str): Probabilities and ROI names (e.g. '53% ROI A, 2% ROI B'), empty if all probabilities are 0
+        '''
+        nz_idx = np.flatnonzero(values > 0)
+        nz_props = values[nz_idx]
+        rois = [f"{int(round(float(nz_props[i])))}% {self.labels.get(int(nz_idx[i]),'')}" for i in reversed(np.argsort(nz_props))]
+        
+        return ", ".join(rois)
+    
+    def query_text(self, coords):
+        '''
+        Queries the atlas at some set of MNI space mm coordinates. Coordinates that have not been queried before
+        are looked up together, and all results are cached per coordinate.
+        
+        Arguments:
+            coords (list): List (or N x 3 array) of XYZ mm coordinates
+        Returns:
+            text_list (list): `atlasquery` text for each coordinate
+        '''
+        keys = [tuple(float(c) for c in coord) for coord in np.asarray(coords,dtype=np.float64).reshape(-1,3)]
+        new_keys = list(dict.fromkeys(key for key in keys if key not in self.query_cache))
+        
+        if new_keys:
+            for key,values in zip(new_keys,self.values(new_keys)):
+                self.query_cache[key] = self.format_values(values)
+        
+        text_list = [self.query_cache[key] for key in keys]
+        
+        return text_list
 
-    return stdout,stderr
+class AtlasIndex():
+    '''
+    Spatial index of some stand-alone atlas: the voxel count, bounding box and centroid of each label, and a coarse
+    grid of blocks (of block x block x block voxels) that records which labels occur in each block. The index is built
+    in a single pass over the atlas (see load_atlas_index for the cached index), such that region queries only read the
+    atlas blocks that are relevant to them (e.g. the nearest labelled region of some coordinate).
+    
+    Attributes:
+        data: Atlas labels (e.g. memory-mapped, see load_atlas_data)
+        affine: Atlas 4 x 4 voxel to mm affine
+        block: Block size (in voxels)
+        grid_shape: Shape of the block grid
+        labels: Sorted array of the (non-zero) labels of the atlas
+        counts: Number of voxels of each label
+        bbox: K x 6 array of the (inclusive) minimum and maximum voxel coordinates of each label
+        centroids: K x 3 array of the centroid voxel coordinates of each label
+        block_offsets: Offsets of the labels of each (C order) block in block_labels (CSR style)
+        block_labels: Labels of each block, grouped by block
+    '''
+    
+    def __init__(self, data, affine, block=8, arrays=None):
+        '''
+        Init doc-string for AtlasIndex class.
+        
+        Arguments:
+            data (numpy array): Atlas labels
+            affine (numpy array): Atlas 4 x 4 voxel to mm affine
+            block (int): Block size (in voxels)
+            arrays (dict): Index arrays of a previously built index (see save), otherwise the index is built from the atlas labels
+        '''
+        self.data = data
+        self.affine = np.asarray(affine,dtype=np.float64)
+        self.block = int(block)
+        self.grid_shape = tuple(-(-int(dim) // self.block) for dim in data.shape[:3])
+        
+        if arrays is None:
+            arrays = self.build()
+        
+        for name in ["labels","counts","bbox","centroids","block_offsets","block_labels"]:
+            setattr(self,name,np.asarray(arrays[name]))
+        
+        self.tree = None
+    
+    def build(self):
+        '''
+        Builds the index arrays in a single pass over the atlas, one row of blocks (along the first axis) at a time.
+        
+        Returns:
+            arrays (dict): Index arrays
+        '''
+        shape = self.data.shape[:3]
+        n_labels = max(int(np.max(self.data)) + 1,1)
+        
+        counts = np.zeros(n_labels,dtype=np.int64)
+        sums = np.zeros((n_labels,3))
+        bbox = np.empty((n_labels,6),dtype=np.int64)
+        bbox[:,:3] = np.iinfo(np.int64).max
+        bbox[:,3:] = -1
+        codes = list()
+        
+        for start in range(0,shape[0],self.block):
+            slab = np.asarray(self.data[start:start + self.block]).reshape((-1,) + tuple(shape[1:]))
+            ijk = np.nonzero(slab > 0)
+            labels = slab[ijk].astype(np.int64)
+            ijk = (ijk[0] + start,ijk[1],ijk[2])
+            
+            counts += np.bincount(labels,minlength=n_labels)
+            for axis in range(3):
+                sums[:,axis] += np.bincount(labels,weights=ijk[axis],minlength=n_labels)
+                np.minimum.at(bbox[:,axis],labels,ijk[axis])
+                np.maximum.at(bbox[:,axis + 3],labels,ijk[axis])
+            
+            # (Block, label) pairs of this row of blocks, in order of block
+            blocks = np.ravel_multi_index(tuple(dim // self.block for dim in ijk),self.grid_shape)
+            codes.append(np.unique(blocks*n_labels + labels))
+        
+        codes = np.concatenate(codes) if codes else np.empty(0,dtype=np.int64)
+        labels = np.flatnonzero(counts)
+        
+        arrays = {"labels":labels,
+                  "counts":counts[labels],
+                  "bbox":bbox[labels],
+                  "centroids":sums[labels] / counts[labels,None],
+                  "block_offsets":np.searchsorted(codes // n_labels,np.arange(int(np.prod(self.grid_shape)) + 1)),
+                  "block_labels":codes % n_labels}
+        
+        return arrays
+    
+    def save(self, f):
+        '''
+        Writes the index arrays (along with the block size) to some (open, binary) file object as a .npz file.
+        
+        Arguments:
+            f (file object): Output file object
+        '''
+        np.savez(f,block=self.block,**{name:getattr(self,name) for name in ["labels","counts","bbox","centroids","block_offsets","block_labels"]})
+    
+    def sizes(self):
+        '''
+        Returns the number of voxels of each label, indexed by label (as label_sizes does, without reading the atlas).
+        
+        Returns:
+            roi_sizes (numpy array): Number of voxels of each label (indexed by label)
+        '''
+        roi_sizes = np.zeros(int(self.labels.max()) + 1 if len(self.labels) else 1,dtype=np.int64)
+        roi_sizes[self.labels] = self.counts
+        return roi_sizes
+    
+    def coords_to_vox(self, coords):
+        '''
+        Converts MNI space mm coordinates to (continuous) atlas voxel coordinates.
+        
+        Arguments:
+            coords (numpy array): N x 3 array of mm coordinates
+        Returns:
+            vox (numpy array): N x 3 array of voxel coordinates
+        '''
+        return nib.affines.apply_affine(np.linalg.inv(self.affine),np.asarray(coords,dtype=np.float64).reshape(-1,3))
+    
+    def label_at(self, coords):
+        '''
+        Looks up the labels at some set of MNI space mm coordinates (nearest voxel).
+        
+        Arguments:
+            coords (numpy array): N x 3 array of mm coordinates
+        Returns:
+            labels (numpy array): Label of each coordinate (0 outside of the atlas field of view)
+        '''
+        vox = np.rint(self.coords_to_vox(coords)).astype(np.int64)
+        in_fov = np.all((vox >= 0) & (vox < np.array(self.data.shape[:3])),axis=1)
+        vox[~in_fov] = 0
+        
+        labels = np.asarray(self.data[vox[:,0],vox[:,1],vox[:,2]]).astype(np.int64).reshape(-1)
+        labels[~in_fov] = 0
+        
+        return labels
+    
+    def nearest(self, coords):
+        '''
+        Finds the nearest labelled voxel of some set of MNI space mm coordinates. Blocks are visited in rings of
+        increasing (block) distance around each coordinate, skipping blocks without labels, until no unvisited block
+        can be nearer than the nearest labelled voxel found so far.
+        
+        Arguments:
+            coords (numpy array): N x 3 array of mm coordinates
+        Returns:
+            labels (numpy array): Label of the nearest labelled voxel of each coordinate (0 if the atlas has no labels)
+            dists (numpy array): Distance (in mm) to the nearest labelled voxel of each coordinate
+        '''
+        points = self.coords_to_vox(coords)
+        linear = self.affine[:3,:3]
+        
+        # Lower bound on the mm length of a (voxel) displacement
+        scale = float(np.linalg.svd(linear,compute_uv=False).min())
+        
+        grid = np.array(self.grid_shape)
+        labelled = np.diff(self.block_offsets) > 0
+        
+        # Many coordinates are queried at once through the label boundaries (for orthogonal voxel axes, see boundary_tree)
+        gram = linear.T @ linear
+        if len(points) >= 32 and labelled.any() and np.allclose(gram,np.diag(np.diag(gram))):
+            return self.nearest_boundary(coords)
+        
+        labels = np.zeros(len(points),dtype=np.int64)
+        dists = np.full(len(points),np.inf)
+        
+        for n,point in enumerate(points):
+            origin = np.floor(point / self.block).astype(np.int64)
+            max_ring = int(np.max(np.maximum(origin,grid - 1 - origin))) if labelled.any() else -1
+            
+            for ring in range(max_ring + 1):
+                # Labelled blocks of this ring (within the block grid)
+                ranges = [np.arange(max(origin[d] - ring,0),min(origin[d] + ring,grid[d] - 1) + 1) for d in range(3)]
+                blocks = np.stack(np.meshgrid(*ranges,indexing='ij'),axis=-1).reshape(-1,3)
+                blocks = blocks[np.max(np.abs(blocks - origin),axis=1) == ring]
+                blocks = blocks[labelled[np.ravel_multi_index(blocks.T,self.grid_shape)]] if len(blocks) else blocks
+                
+                for block in blocks:
+                    lo = block*self.block
+                    data = np.asarray(self.data[lo[0]:lo[0] + self.block,lo[1]:lo[1] + self.block,lo[2]:lo[2] + self.block])
+                    vox = np.argwhere(data > 0)
+                    block_dists = np.linalg.norm((vox + lo - point) @ linear.T,axis=1)
+                    best = np.lexsort((data[tuple(vox.T)],block_dists))[0]
+                    if block_dists[best] < dists[n] or (block_dists[best] == dists[n] and data[tuple(vox[best])] < labels[n]):
+                        [labels[n],dists[n]] = [int(data[tuple(vox[best])]),float(block_dists[best])]
+                
+                # Blocks of further rings are at least ring x block voxels away
+                if dists[n] <= ring*self.block*scale:
+                    break
+        
+        return labels,dists
+    
+    def boundary_tree(self):
+        '''
+        Builds (once) a KD-tree of the mm coordinates of the boundary voxels of the atlas labels, i.e. labelled voxels with
+        an unlabelled 6-neighbour (or at the edge of the field of view). If the voxel axes are orthogonal, the nearest
+        labelled voxel of any unlabelled coordinate is a boundary voxel (a step towards the coordinate would otherwise be nearer).
+        
+        Returns:
+            tree (cKDTree): KD-tree of the boundary voxel mm coordinates
+            labels (numpy array): Label of each boundary voxel
+        '''
+        if self.tree is None:
+            mask = np.asarray(self.data) > 0
+            vox = np.argwhere(mask & ~ndimage.binary_erosion(mask,border_value=0))
+            self.tree = (spatial.cKDTree(nib.affines.apply_affine(self.affine,vox)),np.asarray(self.data[tuple(vox.T)]).astype(np.int64))
+        
+        return self.tree
+    
+    def nearest_boundary(self, coords, k=32):
+        '''
+        Finds the nearest labelled voxel of some set of MNI space mm coordinates at once, through the KD-tree of the label
+        boundaries (see boundary_tree). As with nearest, ties (among the k nearest boundary voxels) are resolved to the lowest label.
+        
+        Arguments:
+            coords (numpy array): N x 3 array of mm coordinates
+            k (int): Number of nearest boundary voxels considered for ties
+        Returns:
+            labels (numpy array): Label of the nearest labelled voxel of each coordinate
+            dists (numpy array): Distance (in mm) to the nearest labelled voxel of each coordinate
+        '''
+        [tree,tree_labels] = self.boundary_tree()
+        coords = np.asarray(coords,dtype=np.float64).reshape(-1,3)
+        
+        [dists,idx] = tree.query(coords,k=min(k,tree.n))
+        [dists,idx] = [dists.reshape(len(coords),-1),idx.reshape(len(coords),-1)]
+        
+        ties = dists <= dists[:,:1]*(1 + 1e-9)
+        labels = np.where(ties,tree_labels[idx],np.iinfo(np.int64).max).min(axis=1)
+        
+        return labels,dists[:,0]
+    
+    def region(self, coords):
+        '''
+        Looks up the label at some set of MNI space mm coordinates, or the nearest labelled region (see nearest) of
+        unlabelled (label 0) coordinates.
+        
+        Arguments:
+            coords (numpy array): N x 3 array of mm coordinates
+        Returns:
+            labels (numpy array): Label (or nearest label) of each coordinate
+            dists (numpy array): Distance (in mm) to the nearest labelled voxel of each coordinate (0 for labelled coordinates)
+        '''
+        coords = np.asarray(coords,dtype=np.float64).reshape(-1,3)
+        
+        labels = self.label_at(coords)
+        dists = np.zeros(len(coords))
+        
+        unlabelled = labels == 0
+        if unlabelled.any():
+            [labels[unlabelled],dists[unlabelled]] = self.nearest(coords[unlabelled])
+        
+        return labels,dists
 
-def roi_loc(coords,vol_atlas_num=3):
+class ProbRows():
     '''
-    Uses input list of X,Y,Z MNI space mm coordinates to identify ROIs.
+    Voxels x regions view of some 4D probabilistic atlas image (see load_prob_atlas), read on demand rather than loaded.
+    Rows (voxels, in C order) are gathered directly from memory-mapped (uncompressed, unscaled) images, and otherwise
+    one region (volume) at a time, such that memory is bounded by a single volume rather than the whole atlas.
     
-    NOTE: External bash script is used.
+    Attributes:
+        img: 4D probabilistic atlas image
+        grid: Atlas grid shape (N, M, P)
+        shape: Shape of the view, i.e. (N*M*P, R)
+        dtype: Data type of the probabilities (float64 for scaled images, as with load_img_data)
+    '''
     
-    Arguments:
-        coords(list): Coordinate list with a lenth of 3 that corresponds to the XYZ coordinates of some ROI in MNI space.
-        vol_atlas_num(int): Atlas to be used in FSL's `atlasquery`. Number corresponds to an atlas. See FSL's `atlasquery` help menu for details.
-    Returns:
-        roi_list(list): List of ROIs generated from input coordinates.
+    def __init__(self, img):
+        '''
+        Init doc-string for ProbRows class.
+        
+        Arguments:
+            img (Nifti1Image): 4D probabilistic atlas image
+        '''
+        dataobj = img.dataobj
+        scaled = nib.is_proxy(dataobj) and not (dataobj.slope == 1 and dataobj.inter == 0)
+        
+        self.img = img
+        self.grid = tuple(img.shape[:3])
+        self.shape = (int(np.prod(self.grid)),int(img.shape[3]))
+        self.dtype = np.dtype(np.float64) if scaled else np.dtype(img.get_data_dtype())
+        self.mmap = not scaled and not str(img.get_filename()).endswith(".gz")
+    
+    def volume(self, region):
+        '''
+        Reads the probabilities of a single region (volume), as a flat (C order) array.
+        
+        Arguments:
+            region (int): Region (volume) index
+        Returns:
+            values (numpy array): N*M*P array of probabilities
+        '''
+        return np.asarray(self.img.dataobj[...,region],dtype=self.dtype).reshape(-1)
+    
+    def __getitem__(self, rows):
+        '''
+        Reads the probabilities of all regions at some voxels.
+        
+        Arguments:
+            rows (numpy array): Flat (C order) voxel indices
+        Returns:
+            values (numpy array): len(rows) x R array of probabilities
+        '''
+        rows = np.asarray(rows,dtype=np.int64)
+        
+        if self.mmap:
+            return np.asarray(np.asanyarray(self.img.dataobj)[np.unravel_index(rows,self.grid)],dtype=self.dtype)
+        
+        values = np.empty((len(rows),self.shape[1]),dtype=self.dtype)
+        for region in range(self.shape[1]):
+            values[:,region] = self.volume(region)[rows]
+        
+        return values
+
+class RoiLocator():
     '''
+    Reusable ROI locator for library use (e.g. notebooks and pipelines). Atlases are loaded once on construction: the
+    (decoded) label volume, label -> ROI name lookup array and spatial index of stand-alone atlases, and the data of
+    FSL atlases (which are queried in-process, see FslAtlas). Inputs may be paths, NIFTI images or arrays, and results
+    are returned rather than written, such that repeated calls only pay for clustering and overlap computations.
     
-    # Define volume atlas number dictionary
-    vol_atlas_dict = {
-    1: "Cerebellar Atlas in MNI152 space after normalization with FLIRT",
-    2: "Cerebellar Atlas in MNI152 space after normalization with FNIRT",
-    3: "Harvard-Oxford Cortical Structural Atlas",
-    4: "Harvard-Oxford Subcortical Structural Atlas",
-    5: "Human Sensorimotor Tracts Labels",
-    6: "JHU ICBM-DTI-81 White-Matter Labels",
-    7: "JHU White-Matter Tractography Atlas",
-    8: "Juelich Histological Atlas",
-    9: "MNI Structural Atlas",
-    10: "Mars Parietal connectivity-based parcellation",
-    11: "Mars TPJ connectivity-based parcellation",
-    12: "Neubert Ventral Frontal connectivity-based parcellation",
-    13: "Oxford Thalamic Connectivity Probability Atlas",
-    14: "Oxford-Imanova Striatal Connectivity Atlas 3 sub-regions",
-    15: "Oxford-Imanova Striatal Connectivity Atlas 7 sub-regions",
-    16: "Oxford-Imanova Striatal Structural Atlas",
-    17: "Sallet Dorsal Frontal connectivity-based parcellation",
-    18: "Subthalamic Nucleus Atlas",
-    19: "Talairach Daemon Labels"}
+    Attributes:
+        atlases: List of loaded atlases (see load_atlases)
+        names: Atlas names (one per atlas, as the keys of results)
+        thresh: Default threshold (values below this value are not clustered)
+        connectivity: Voxel connectivity used to form clusters (6, 18, or 26)
+        table: Also compute cluster x ROI tables
+        nearest: Report the nearest labelled ROI of unlabelled cluster peaks and coordinates (stand-alone atlases)
+        grids: Dictionary of atlases mapped onto the voxel grids of previous inputs (see match_atlas_grid), in order of use
+        max_grids: Maximum number of voxel grids for which mapped atlases are kept
+    '''
+    
+    max_grids = 4
+    
+    def __init__(self, atlases=None, thresh=0.95, connectivity=26, table=False, nearest=False, use_cache=True, prob_cutoff=None):
+        '''
+        Init doc-string for RoiLocator class.
+        
+        Arguments:
+            atlases (list): List of FSL atlas numbers (int) and/or (NIFTI atlas, CSV file) tuples [default: FSL atlas 3]
+            thresh (float): Default threshold
+            connectivity (int): Voxel connectivity used to form clusters (6, 18, or 26)
+            table (bool): Also compute cluster x ROI tables (see overlap_table and peak_table)
+            nearest (bool): Report the nearest labelled ROI of unlabelled cluster peaks and coordinates (see AtlasIndex.region)
+            use_cache (bool): Read from/write to the decoded atlas cache
+            prob_cutoff (float): Resolve probabilistic FSL atlases over whole clusters with this cutoff (see load_atlases)
+        '''
+        self.thresh = thresh
+        self.connectivity = connectivity
+        self.table = table
+        self.nearest = nearest
+        self.atlases = load_atlases(atlases or [3],use_cache,table,nearest,prob_cutoff)
+        self.names = [atlas["name"] for atlas in self.atlases]
+        self.grids = collections.OrderedDict()
+        
+        # FSL atlases are only queried in-process (atlasquery writes temporary files)
+        for atlas in self.atlases:
+            if atlas.get("num") is not None:
+                load_fsl_atlas(atlas["num"]).load()
+    
+    def image(self, img, affine=None):
+        '''
+        Returns some input as a NIFTI image.
+        
+        Arguments:
+            img (NIFTI file): Input NIFTI file, NIFTI image or (3D or 4D) numpy array
+            affine (numpy array): 4 x 4 voxel to mm affine of array inputs. The affine of the first stand-alone atlas is used if not provided.
+        Returns:
+            img (Nifti1Image): Input NIFTI image
+        '''
+        if isinstance(img,(str,os.PathLike)):
+            return nib.load(img)
+        
+        if isinstance(img,np.ndarray):
+            if affine is None:
+                affine = next((atlas["affine"] for atlas in self.atlases if atlas.get("affine") is not None),None)
+            if affine is None:
+                raise ValueError("Array inputs require a voxel to mm affine (if no stand-alone atlas is loaded).")
+            return nib.Nifti1Image(img,affine)
+        
+        return img
+    
+    def grid_atlases(self, img):
+        '''
+        Returns the atlases mapped onto the voxel grid of some input image (see match_atlas_grid). Mapped atlases are kept
+        for the most recently used input grids (up to max_grids), the least recently used grid being evicted first.
+        
+        Arguments:
+            img (Nifti1Image): Input NIFTI image
+        Returns:
+            atlases (list): List of loaded atlases in the input grid
+        '''
+        affine = grid_affine(img)
+        key = (tuple(img.shape[:3]),None if affine is None else tuple(np.round(affine,6).ravel()))
+        
+        if key in self.grids:
+            self.grids.move_to_end(key)
+        else:
+            self.grids[key] = [match_atlas_grid(atlas,img.shape,affine) for atlas in self.atlases]
+            while len(self.grids) > self.max_grids:
+                self.grids.popitem(last=False)
+        
+        return self.grids[key]
+    
+    def locate(self, img, affine=None, thresh=None):
+        '''
+        Identifies the ROIs of every atlas that have overlap with some cluster(s) of some (3D or 4D) input.
+        Nothing is written to file.
+        
+        Arguments:
+            img (NIFTI file): Input NIFTI file, NIFTI image or (3D or 4D) numpy array
+            affine (numpy array): 4 x 4 voxel to mm affine of array inputs (see image)
+            thresh (float): Threshold values below this value. The default threshold is used if not provided.
+        Returns:
+            results (list): List of dictionaries, one for each volume, with the volume index ('volume', None for 3D inputs),
+                            a dictionary of atlas names to ROI lists ('rois') and the cluster x ROI table of all atlases
+                            ('table', see atlas_table, None if not computed)
+        '''
+        img = self.image(img,affine)
+        thresh = self.thresh if thresh is None else thresh
+        
+        prefetched = read_input(img,thresh,self.connectivity)
+        vol_rois = get_file_atlas_rois(img.get_filename() or "",self.grid_atlases(img),thresh,self.connectivity,0,self.table,False,prefetched)
+        
+        results = [{"volume":volume,
+                    "rois":dict(zip(self.names,roi_lists)),
+                    "table":atlas_table(self.atlases,roi_tables)} for volume,roi_lists,roi_tables in vol_rois]
+        
+        return results
+    
+    def locate_coords(self, coords):
+        '''
+        Identifies the ROIs of every atlas at several XYZ mm coordinates (see coord_rois and roi_loc_batch).
+        
+        Arguments:
+            coords (numpy array): N x 3 array (or list) of XYZ mm coordinates
+        Returns:
+            result (dict): Dictionary of the 'coords' (N x 3 array), and a dictionary of atlas names to lists of ROI lists
+                           (one for each coordinate, 'rois'). If nearest ROIs are reported, a dictionary of stand-alone
+                           atlas names to the distance (in mm) of each coordinate to its nearest labelled voxel ('distances').
+        '''
+        coords = np.asarray(coords,dtype=np.float64).reshape(-1,3)
+        
+        rois = dict()
+        dists = dict()
+        
+        for name,atlas in zip(self.names,self.atlases):
+            if atlas.get("data") is None:
+                rois[name] = roi_loc_batch(coords,atlas["num"])
+            elif self.nearest:
+                [rois[name],dists[name]] = coord_rois(coords,atlas["data"],atlas["lut"],atlas["affine"],atlas["index"])
+            else:
+                rois[name] = coord_rois(coords,atlas["data"],atlas["lut"],atlas["affine"])
+        
+        result = {"coords":coords,"rois":rois}
+        
+        if self.nearest:
+            result["distances"] = dists
+        
+        return result
+    
+    def label_table(self, coords):
+        '''
+        Labels several (e.g. tens of thousands of) XYZ mm coordinates with every atlas (see label_coords).
+        
+        Arguments:
+            coords (numpy array): N x 3 array (or list) of XYZ mm coordinates
+        Returns:
+            df (DataFrame): Table of N rows, with the label, ROI (and probabilities) of each atlas
+        '''
+        return label_coords(coords,self.atlases)
+
+class RoiServer():
+    '''
+    Resident ROI query server state (see roilib.server for its HTTP transport). Atlases (stand-alone NIFTI + CSV pairs
+    and FSL atlases) are loaded once (or preloaded) and kept in memory for the lifetime of the server, so that each
+    query only pays for the clustering and overlap computations. Queries may only name input (and atlas) files in the
+    server root directory.
+    
+    Attributes:
+        atlases: Dictionary of loaded stand-alone atlases, keyed by (NIFTI atlas, CSV file) paths
+        fsl_atlases: List of loaded FSL atlas numbers
+        use_cache: Read from/write to the decoded atlas (and cluster) caches
+        root: Directory of the files that queries may name (preloaded atlases excepted)
+    '''
+    
+    def __init__(self, preload=None, use_cache=True, root=""):
+        '''
+        Init doc-string for RoiServer class.
+        
+        Arguments:
+            preload (list): Atlases to preload. Either FSL atlas numbers (int) or (NIFTI atlas, CSV file) tuples.
+            use_cache (bool): Read from/write to the decoded atlas (and cluster) caches
+            root (str): Directory of the files that queries may name. The current working directory is used if not provided.
+        '''
+        self.atlases = dict()
+        self.fsl_atlases = list()
+        self.use_cache = use_cache
+        self.root = os.path.realpath(root or os.getcwd())
+        self.lock = threading.Lock()
+        
+        for atlas in preload or list():
+            if isinstance(atlas,int):
+                self.get_fsl_atlas(atlas)
+            else:
+                self.get_atlas(*atlas,check=False)
+    
+    def check_path(self, path):
+        '''
+        Checks that some requested file is in the server root directory.
+        
+        Arguments:
+            path (str): Requested file
+        Returns:
+            path (str): Real path of the requested file
+        '''
+        real_path = os.path.realpath(path)
+        
+        if os.path.commonpath([self.root,real_path]) != self.root:
+            raise PermissionError(f"{path} is not in the server root directory ({self.root}).")
+        
+        return real_path
+    
+    def get_atlas(self, nii_atlas, atlas_info, check=True):
+        '''
+        Returns some (loaded) stand-alone atlas, loading it if necessary.
+        
+        Arguments:
+            nii_atlas (NIFTI file): NIFTI atlas file
+            atlas_info (file): Corresponding CSV key, value pairs of ROIs for atlas file
+            check (bool): Only load atlases in the server root directory (see check_path)
+        Returns:
+            atlas (dict): Atlas data, dictionary, label lookup array, affine and spatial index (see load_atlas_index)
+        '''
+        key = (os.path.abspath(nii_atlas),os.path.abspath(atlas_info))
+        
+        with self.lock:
+            if key not in self.atlases:
+                if check:
+                    self.check_path(nii_atlas)
+                    self.check_path(atlas_info)
+                [atlas_data,atlas_dict] = load_atlas_data(nii_atlas,atlas_info,use_cache=self.use_cache)
+                self.atlases[key] = {"data":atlas_data,
+                                     "dict":atlas_dict,
+                                     "lut":make_label_lut(atlas_dict),
+                                     "affine":nib.load(nii_atlas).affine,
+                                     "index":load_atlas_index(nii_atlas,atlas_data,self.use_cache)}
+        
+        return self.atlases[key]
+    
+    def get_fsl_atlas(self, vol_atlas_num):
+        '''
+        Returns some (loaded) FSL atlas, loading it if necessary.
+        
+        Arguments:
+            vol_atlas_num (int): Atlas number. See '--dump-atlases' for details.
+        Returns:
+            atlas (FslAtlas): Loaded FSL atlas
+        '''
+        with self.lock:
+            atlas = load_fsl_atlas(vol_atlas_num)
+            atlas.load()
+            if vol_atlas_num not in self.fsl_atlases:
+                self.fsl_atlases.append(vol_atlas_num)
+        
+        return atlas
+    
+    def get_atlases(self, request):
+        '''
+        Returns the (loaded) atlases of some request, in the format of load_atlases. Requests list their atlases in
+        'atlases' (FSL atlas numbers and/or [NIFTI atlas, CSV file] pairs), or name a single stand-alone atlas
+        ('atlas' and 'atlas_info') or FSL atlas ('atlas_num', default: 3).
+        
+        Arguments:
+            request (dict): Query request
+        Returns:
+            atlases (list): List of atlas dictionaries (see load_atlases)
+        '''
+        if request.get("atlases"):
+            specs = [int(atlas) if isinstance(atlas,(int,str)) else tuple(atlas) for atlas in request["atlases"]]
+        elif request.get("atlas") and request.get("atlas_info"):
+            specs = [(request["atlas"],request["atlas_info"])]
+        else:
+            specs = [int(request.get("atlas_num") or 3)]
+        
+        atlases = list()
+        names = list()
+        
+        for spec in specs:
+            # Unique (output column) names, as in load_atlases
+            name = atlas_name(spec)
+            if name in names:
+                name = f"{name} ({names.count(name) + 1})"
+            names.append(atlas_name(spec))
+            
+            if isinstance(spec,int):
+                self.get_fsl_atlas(spec)
+                atlases.append({"name":name,"num":spec})
+            else:
+                atlas = self.get_atlas(*spec)
+                atlases.append(dict(atlas,name=name,sizes=None,nearest=bool(request.get("nearest"))))
+        
+        return atlases
+    
+    def query(self, request):
+        '''
+        Performs some ROI query. Requests either contain an 'input' NIFTI file (with optional 'thresh', 'slab' and
+        'connectivity' values), or a list of XYZ mm 'coords', along with their atlases (see get_atlases). The input
+        is clustered once for all atlases. Queries of stand-alone atlases with 'nearest' set also report the nearest
+        labelled ROI of unlabelled cluster peaks (or coordinates).
+        
+        Arguments:
+            request (dict): Query request
+        Returns:
+            response (dict): Query response, with the ROI list of the input file ('rois'), a list of ROI lists
+                             of each volume of 4D input files ('volumes'), or a list of ROI lists (one for each coordinate,
+                             along with their nearest labelled voxel 'distances' if 'nearest' is set). Requests that list
+                             their 'atlases' have a dictionary of atlas names to such ROI lists (and distances) instead.
+        '''
+        atlases = self.get_atlases(request)
+        names = [atlas["name"] for atlas in atlases]
+        
+        # Responses to requests that list their atlases are keyed by atlas name
+        if request.get("atlases"):
+            by_atlas = lambda values: dict(zip(names,values))
+        else:
+            by_atlas = lambda values: values[0]
+        
+        if request.get("input"):
+            vol_rois = get_file_atlas_rois(self.check_path(request["input"]),
+                                           atlases,
+                                           float(request.get("thresh",0.95)),
+                                           int(request.get("connectivity",26)),
+                                           int(request.get("slab",0)),
+                                           use_cache=self.use_cache)
+            if vol_rois[0][0] is None:
+                return {"input":request["input"],"rois":by_atlas(vol_rois[0][1])}
+            return {"input":request["input"],"volumes":[{"volume":volume,"rois":by_atlas(roi_lists)} for volume,roi_lists,_ in vol_rois]}
+        elif request.get("coords") is not None:
+            coords = np.asarray(request["coords"],dtype=np.float64).reshape(-1,3)
+            rois = list()
+            dists = list()
+            for atlas in atlases:
+                if atlas.get("num") is not None:
+                    rois.append(roi_loc_batch(coords,atlas["num"]))
+                    dists.append(None)
+                elif atlas["nearest"]:
+                    [roi_lists,atlas_dists] = coord_rois(coords,atlas["data"],atlas["lut"],atlas["affine"],atlas["index"])
+                    rois.append(roi_lists)
+                    dists.append(atlas_dists)
+                else:
+                    rois.append(coord_rois(coords,atlas["data"],atlas["lut"],atlas["affine"]))
+                    dists.append(None)
+            response = {"coords":coords.tolist(),"rois":by_atlas(rois)}
+            if request.get("nearest"):
+                response["distances"] = by_atlas(dists)
+            return response
+        else:
+            raise ValueError("Requests require either an 'input' file or a list of 'coords'.")
+
+# Define functions
+
+def run(cmd_list,stdout="",stderr=""):
+    '''
+    Uses python's built-in subprocess class to run a command from an input command list.
+    The standard output and error can optionally be written to file.
+    
+    Arguments:
+        cmd_list(list): Input command list to be run from the UNIX command line.
+        stdout(file): Output file to write standard output to.
+        stderr(file): Output file to write standard error to.
+    Returns:
+        stdout(file): Output file that contains the standard output.
+        stderr(file): Output file that contains the standard error.
+    '''
+    with mem_stage(f"run {os.path.basename(cmd_list[0])}",subprocs=1):
+        if stdout and stderr:
+            with open(stdout,"w") as file:
+                with open(stderr,"w") as file_err:
+                    subprocess.call(cmd_list,stdout=file,stderr=file_err)
+                    file.close(); file_err.close()
+        elif stdout:
+            with open(stdout,"w") as file:
+                subprocess.call(cmd_list,stdout=file)
+                file.close()
+            stderr = None
+        else:
+            subprocess.call(cmd_list)
+            stdout = None
+            stderr = None
+
+    return stdout,stderr
+
+def roi_loc(coords,vol_atlas_num=3):
+    '''
+    Uses input list of X,Y,Z MNI space mm coordinates to identify ROIs.
+    
+    NOTE: FSL's atlases are queried in-process (see FslAtlas) if they can be found in $FSLDIR,
+    otherwise an external bash script (which wraps FSL's `atlasquery`) is used.
+    
+    Arguments:
+        coords(list): Coordinate list with a lenth of 3 that corresponds to the XYZ coordinates of some ROI in MNI space.
+        vol_atlas_num(int): Atlas to be used in FSL's `atlasquery`. Number corresponds to an atlas. See FSL's `atlasquery` help menu for details.
+    Returns:
+        roi_list(list): List of ROIs generated from input coordinates.
+    '''
+    
+    # Define list
+    roi_list = list()
+    
+    if len(coords) == 3 and find_fsl_atlas(vol_atlas_num):
+        roi_list = roi_loc_batch([coords],vol_atlas_num)[0]
+    elif len(coords) == 3:
+        # Output file (unique, such that concurrent queries do not overwrite each other's results)
+        [fd,out_file] = tempfile.mkstemp(prefix="subcort.rois.",suffix=".txt")
+        os.close(fd)
+        
+        atlasq_cmd = os.path.join(scripts_dir,"atlasq.sh")
+        atlasq = Command().init_cmd(atlasq_cmd)
+        atlasq.append(f"--coord")
+        atlasq.append(f"\"{coords[0]},{coords[1]},{coords[2]}\"")
+        atlasq.append("--atlas-num")
+        atlasq.append(f"{vol_atlas_num}")
+    
+        try:
+            run(atlasq,out_file)
+            
+            with open(out_file,"r") as file:
+                text = file.readlines()
+                for i in range(0,len(text)):
+                    text[i] = re.sub(f"<b>{vol_atlas_dict[vol_atlas_num]}</b><br>","",text[i].rstrip())
+        finally:
+            os.remove(out_file)
+        
+        if len(text) == 0:
+            pass
+        else:
+            roi_list.extend(text) 
+        
+    return roi_list
+
+def roi_loc_batch(coords,vol_atlas_num=3):
+    '''
+    Identifies the ROIs of several X,Y,Z MNI space mm coordinates at once, using an in-process FSL atlas
+    (see FslAtlas). The results for each coordinate are identical to those of roi_loc.
+    
+    Arguments:
+        coords(list): List (or N x 3 array) of XYZ coordinates in MNI space.
+        vol_atlas_num(int): Atlas to be used. Number corresponds to an atlas. See '--dump-atlases' for details.
+    Returns:
+        roi_lists(list): List of ROI lists, one for each input coordinate.
+    '''
+    
+    atlas = load_fsl_atlas(vol_atlas_num)
+    
+    # Strip the atlas name, as in roi_loc
+    roi_lists = [[re.sub(f"<b>{atlas.name}</b><br>","",text)] for text in atlas.query_text(coords)]
+    
+    return roi_lists
+
+def find_fsl_atlas(vol_atlas_num,fsl_dir=""):
+    '''
+    Finds the XML description file of some FSL atlas in $FSLDIR/data/atlases.
+    
+    Arguments:
+        vol_atlas_num(int): Atlas number. See '--dump-atlases' for details.
+        fsl_dir(str): FSL installation directory. $FSLDIR is used if not provided.
+    Returns:
+        xml_file(file): Atlas XML file. An empty string is returned if the atlas could not be found.
+    '''
+    
+    key = ("xml",vol_atlas_num,fsl_dir)
+    
+    if key in fsl_atlas_cache:
+        return fsl_atlas_cache[key]
+    
+    if not fsl_dir:
+        fsl_dir = os.environ.get("FSLDIR","")
+    
+    atlas_dir = os.path.join(fsl_dir,"data","atlases")
+    xml_file = ""
+    
+    if fsl_dir and vol_atlas_num in vol_atlas_dict and os.path.isdir(atlas_dir):
+        for file in sorted(os.listdir(atlas_dir)):
+            if not file.endswith(".xml"):
+                continue
+            try:
+                name = ET.parse(os.path.join(atlas_dir,file)).findtext("header/name")
+            except ET.ParseError:
+                continue
+            if name and name.strip() == vol_atlas_dict[vol_atlas_num]:
+                xml_file = os.path.join(atlas_dir,file)
+                break
+    
+    fsl_atlas_cache[key] = xml_file
+    
+    return xml_file
+
+def load_fsl_atlas(vol_atlas_num,fsl_dir=""):
+    '''
+    Loads (once) some FSL atlas from $FSLDIR/data/atlases. Subsequent calls return the same FslAtlas object.
+    
+    Arguments:
+        vol_atlas_num(int): Atlas number. See '--dump-atlases' for details.
+        fsl_dir(str): FSL installation directory. $FSLDIR is used if not provided.
+    Returns:
+        atlas(FslAtlas): Loaded FSL atlas.
+    '''
+    
+    key = ("atlas",vol_atlas_num,fsl_dir)
+    
+    if key not in fsl_atlas_cache:
+        xml_file = find_fsl_atlas(vol_atlas_num,fsl_dir)
+        
+        if not xml_file:
+            raise FileNotFoundError(f"Unable to find FSL atlas {vol_atlas_num} ({vol_atlas_dict.get(vol_atlas_num)}). Is $FSLDIR set?")
+        
+        fsl_atlas_cache[key] = FslAtlas(xml_file)
+    
+    return fsl_atlas_cache[key]
+
+def warn_dist(dist,func_name):
+    '''
+    Warns that the (deprecated) 'dist' argument of some function is ignored, if it was provided. Minimum distances
+    only apply to the local maxima of clusters (see find_peaks and get_file_peaks), not to their ROIs.
+    
+    Arguments:
+        dist(float): Minimum distance between local maxima
+        func_name(str): Name of the function
+    '''
+    
+    if dist:
+        warnings.warn(f"The 'dist' argument of {func_name} is deprecated and ignored (minimum distances only apply to local maxima, see find_peaks), and will be removed in a future version.",DeprecationWarning,stacklevel=3)
+
+def vol_clust(nii_file,thresh=0.95,dist=0,vol_atlas_num=3,connectivity=26,slab=0):
+    '''
+    Identifies clusters in a volumetric (NIFTI) file.
+    
+    Arguments:
+        nii_file(file): Input NIFTI file
+        thresh(float): Cluster minimum threshold
+        dist(float): Minimum distance between local maxima (deprecated and ignored, as it only applies to local maxima, see find_peaks. It will be removed in a future version.)
+        vol_atlas_num(int): Atlas to be used in FSL's `atlasquery`. Number corresponds to an atlas. See FSL's `atlasquery` help menu for details.
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+        slab(int): Number of z-slices per slab if the input is streamed (see stream_clusters), or 0 to load the whole input into memory
+    Returns:
+        roi_list(list): List of ROIs that overlap with some given cluster
+    '''
+    
+    warn_dist(dist,"vol_clust")
+    
+    img = nib.load(nii_file)
+    
+    if slab:
+        [df_tmp,_] = stream_clusters(nii_file,thresh,connectivity,slab,affine=img.affine)
+    else:
+        with mem_stage("load input"):
+            img_data = load_img_data(img)
+        
+        with mem_stage("cluster"):
+            df_tmp = sparse_table(sparse_clusters(img_data,thresh,connectivity),img.affine)
+    
+    roi_list = peak_rois(df_tmp,vol_atlas_num)
+    
+    return roi_list
+
+def peak_roi_lists(clust_table,vol_atlas_num=3):
+    '''
+    Identifies the ROIs at the (MNI space mm) peak coordinates of each cluster of some cluster table, using FSL's atlases.
+    
+    Arguments:
+        clust_table(DataFrame): Cluster table with FSL `cluster` style columns (see find_clusters)
+        vol_atlas_num(int): Atlas to be used in FSL's `atlasquery`. Number corresponds to an atlas. See FSL's `atlasquery` help menu for details.
+    Returns:
+        roi_lists(list): List of ROI lists, one for each cluster (in the order of the cluster table)
+    '''
+    
+    df = clust_table[['MAX X (mm)','MAX Y (mm)','MAX Z (mm)']].copy()
+    
+    # Query all cluster peaks at once if the atlas is available in-process
+    if find_fsl_atlas(vol_atlas_num):
+        with mem_stage("atlas query"):
+            return roi_loc_batch(df.values,vol_atlas_num)
+    
+    roi_lists = list()
+    
+    for i in range(0,len(df)):
+        coord_list=[df['MAX X (mm)'][i],df['MAX Y (mm)'][i],df['MAX Z (mm)'][i]]
+        roi_lists.append(roi_loc(coord_list,vol_atlas_num))
+    
+    return roi_lists
+
+def peak_rois(clust_table,vol_atlas_num=3):
+    '''
+    Identifies the ROIs at the (MNI space mm) peak coordinates of some cluster table, using FSL's atlases.
+    
+    Arguments:
+        clust_table(DataFrame): Cluster table with FSL `cluster` style columns (see find_clusters)
+        vol_atlas_num(int): Atlas to be used in FSL's `atlasquery`. Number corresponds to an atlas. See FSL's `atlasquery` help menu for details.
+    Returns:
+        roi_list(list): List of ROIs at the cluster peaks
+    '''
+    
+    roi_list = list()
+    
+    for tmp_list in peak_roi_lists(clust_table,vol_atlas_num):
+        roi_list.extend(tmp_list)
+    
+    return roi_list
+
+def read_atlas_file(atlas_info):
+    '''
+    Reads CSV (or TSV) of key, value pairs of enumerated ROIs for some corresponding atlas.
+    
+    Arguments:
+        atlas_info(file): Input CSV (or TSV) file of enumerated ROI key, value pairs
+    Returns:
+        atlas_dict(dict): Dictionary of atlas key, value pairs
+    '''
+    
+    atlas_info = os.path.abspath(atlas_info)
+    atlas_dict = dict()
+    
+    with open(atlas_info,"r",newline="") as f:
+        for row in csv.reader(f,delimiter="\t" if atlas_info.endswith('.tsv') else ","):
+            if len(row) == 0:
+                continue
+            if len(row) != 2:
+                raise ValueError(f"Expected 2 fields (key, ROI name) in {atlas_info}, found {len(row)}: {row}")
+            atlas_dict[int(row[0])] = row[1]
+    
+    return atlas_dict
+
+def remove_ext(file):
+    '''
+    Removes extension of some input file string. Primarily intended for NIFTI files.
+    
+    Arguments:
+        file(str): Input file name string
+    Returns:
+        name(str): File name string with extension removed
+    '''
+    
+    if '.nii.gz' in file:
+        name = file[:-7]
+    elif '.nii' in file:
+        name = file[:-4]
+    elif '.txt' in file or '.tsv' in file or '.csv' in file:
+        name = file
+    else:
+        name = file
+    
+    return name
+
+def convert_img_dtype(img,data_type="int"):
+    '''
+    Converts image data type to some other arbitrary data type. See fslmaths help menu for further details.
+    
+    Arguments:
+        img(NIFTI file): Input NIFTI file
+        data_type(str): Output data type (e.g. 'int','float','char','float','double')
+    Returns:
+        out_file(NIFTI file): NIFTI file with desired data type
+    '''
+    
+    img = os.path.abspath(img)
+    out_dir = os.path.dirname(img)
+    
+    img = remove_ext(img)
+    name = os.path.basename(img)
+    
+    out_file = os.path.join(out_dir,name + ".int" + ".nii.gz")
+    
+    img_dtype = Command().init_cmd("fslmaths")
+    img_dtype.append("-dt")
+    img_dtype.append(data_type)
+    img_dtype.append(img)
+    img_dtype.append(out_file)
+    img_dtype.append("-odt")
+    img_dtype.append(data_type)
+    
+    run(img_dtype)
+    
+    return out_file
+
+def file_hash(file,block_size=1 << 20):
+    '''
+    Computes the SHA-1 hash of some file's contents.
+    
+    Arguments:
+        file(file): Input file
+        block_size(int): Number of bytes read at a time
+    Returns:
+        digest(str): Hexadecimal SHA-1 digest
+    '''
+    
+    sha = hashlib.sha1()
+    
+    with open(file,"rb") as f:
+        for block in iter(lambda: f.read(block_size),b""):
+            sha.update(block)
+    
+    return sha.hexdigest()
+
+def atlas_fingerprint(atlases):
+    '''
+    Computes the identity of several atlases, i.e. FSL atlas numbers and the contents of stand-alone atlas files.
+    
+    Arguments:
+        atlases(list): List of FSL atlas numbers (int) and/or (NIFTI atlas, CSV file) tuples
+    Returns:
+        digest(str): Hexadecimal SHA-1 digest
+    '''
+    
+    ident = [f"fsl-{atlas}" if isinstance(atlas,int) else [file_hash(atlas[0]),file_hash(atlas[1])] for atlas in atlases]
+    
+    return hashlib.sha1(json.dumps(ident).encode()).hexdigest()
+
+def input_fingerprint(nii_file,atlas_key="",params=None,content=False):
+    '''
+    Computes the fingerprint of some input file for a given set of atlases and clustering parameters. Unchanged
+    inputs (i.e. with the same fingerprint) need not be reprocessed.
+    
+    Arguments:
+        nii_file(file): Input NIFTI file
+        atlas_key(str): Atlas identity (see atlas_fingerprint)
+        params(dict): Clustering parameters ('thresh', 'dist' and 'connectivity')
+        content(bool): Fingerprint the file contents (see file_hash), rather than its size and modification time
+    Returns:
+        digest(str): Hexadecimal SHA-1 digest (empty if the file cannot be read)
+    '''
+    
+    try:
+        stat = os.stat(nii_file)
+        ident = file_hash(nii_file) if content else f"{stat.st_size}-{stat.st_mtime_ns}"
+    except OSError:
+        return ""
+    
+    key = json.dumps([os.path.abspath(nii_file),ident,atlas_key,params or {}],sort_keys=True)
+    
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def int_dtype(data):
+    '''
+    Determines the smallest integer data type that can exactly represent the values of some integer valued array.
+    
+    Arguments:
+        data(numpy array): Input (integer valued) array
+    Returns:
+        dtype(numpy dtype): Smallest integer data type
+    '''
+    
+    if data.size == 0:
+        return np.dtype(np.uint8)
+    
+    dtype = np.result_type(np.min_scalar_type(int(data.min())),np.min_scalar_type(int(data.max())))
+    
+    return dtype
+
+def load_img_data(img):
+    '''
+    Loads the data of some NIFTI image in its native (on-disk) data type. Uncompressed (.nii) images are
+    memory-mapped, rather than read into memory. Images with scaling factors are loaded as float64 arrays
+    (as with get_fdata).
+    
+    Arguments:
+        img(Nifti1Image): Input NIFTI image
+    Returns:
+        img_data(numpy array): Image data
+    '''
+    
+    dataobj = img.dataobj
+    
+    if nib.is_proxy(dataobj) and not (dataobj.slope == 1 and dataobj.inter == 0):
+        return img.get_fdata()
+    
+    return np.asanyarray(dataobj)
+
+def img_nbytes(img):
+    '''
+    Estimates the memory (in bytes) of the data of some NIFTI image once loaded (see load_img_data), from its header
+    alone (i.e. without reading the data).
+    
+    Arguments:
+        img(Nifti1Image): Input NIFTI image
+    Returns:
+        nbytes(int): Size of the loaded image data (in bytes)
+    '''
+    
+    dataobj = img.dataobj
+    
+    if nib.is_proxy(dataobj) and not (dataobj.slope == 1 and dataobj.inter == 0):
+        itemsize = np.dtype(np.float64).itemsize
+    else:
+        itemsize = img.get_data_dtype().itemsize
+    
+    return int(np.prod(img.shape,dtype=np.int64))*itemsize
+
+def decode_atlas(nii_atlas,mmap=False):
+    '''
+    Decodes the labels of some NIFTI atlas in-process (in place of `fslmaths -dt int ... -odt int`), such that
+    labels are stored using the smallest integer data type that exactly represents them.
+    
+    Arguments:
+        nii_atlas(NIFTI file): Input NIFTI atlas
+        mmap(bool): Return the memory-mapped image data (in its native data type) of uncompressed, unscaled,
+                    integer atlases, rather than a decoded copy.
+    Returns:
+        atlas_data(numpy array): Atlas labels represented as an N x M x P integer array
+    '''
+    
+    img = nib.load(nii_atlas)
+    dataobj = img.dataobj
+    
+    if nib.is_proxy(dataobj):
+        raw = np.asanyarray(dataobj.get_unscaled())
+        [slope,inter] = [float(dataobj.slope),float(dataobj.inter)]
+    else:
+        raw = np.asanyarray(dataobj)
+        [slope,inter] = [1.0,0.0]
+    
+    scaled = not (slope == 1 and inter == 0)
+    
+    if np.issubdtype(raw.dtype,np.integer) and not scaled:
+        if mmap and isinstance(raw,np.memmap):
+            return raw
+        atlas_data = raw
+    elif np.issubdtype(raw.dtype,np.integer) and int(raw.max()) - int(raw.min()) <= 1 << 16:
+        # Scaled integer labels: round each possible (raw) value once, then look them up
+        raw_min = int(raw.min())
+        lut = np.rint(np.arange(raw_min,int(raw.max()) + 1)*slope + inter)
+        lut = lut.astype(int_dtype(lut))
+        # (the offset is subtracted in np.intp, as the range of the raw values may exceed their data type)
+        atlas_data = lut[raw.astype(np.intp) - raw_min] if raw_min else lut[raw]
+    else:
+        # Float labels are rounded to their nearest integer label
+        atlas_data = np.rint(raw*slope + inter if scaled else raw)
+    
+    atlas_data = atlas_data.astype(int_dtype(atlas_data),copy=False)
+    
+    return atlas_data
+
+def prof_snapshot():
+    '''
+    Takes a snapshot of the resource usage of this process (and its finished subprocesses).
+    
+    Returns:
+        snapshot(dict): Wall clock time, CPU time, peak RSS (bytes), and bytes read/written (from /proc/self/io, if available)
+    '''
+    
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    child = resource.getrusage(resource.RUSAGE_CHILDREN)
+    
+    snapshot = {"time":time.time(),
+                "wall":time.perf_counter(),
+                "cpu":usage.ru_utime + usage.ru_stime + child.ru_utime + child.ru_stime,
+                "rss":usage.ru_maxrss*(1 if sys.platform == "darwin" else 1024),
+                "read":0,
+                "write":0}
+    
+    try:
+        with open("/proc/self/io","r") as f:
+            io = dict(line.split(":") for line in f if ":" in line)
+        [snapshot["read"],snapshot["write"]] = [int(io["rchar"]),int(io["wchar"])]
+    except (OSError,KeyError,ValueError):
+        pass
+    
+    return snapshot
+
+@contextlib.contextmanager
+def mem_stage(stage,subprocs=0):
+    '''
+    Records the peak (traced) memory allocated during some processing stage, provided that memory tracing has been
+    started (see start_mem_report), and the wall time, CPU time, peak RSS increase, bytes read/written and number of
+    subprocesses of the stage, provided that profiling has been started (see start_profile). Otherwise, this does nothing.
+    
+    Traced memory, CPU time, RSS and I/O are process-wide. Stages that overlap the stages of other threads (e.g. of
+    pipelined batches, see BatchPipeline) thus include their allocations and time, and are marked as concurrent. The
+    traced memory peak is only reset by stages that start while no other thread runs a stage.
+    
+    Arguments:
+        stage(str): Processing stage name
+        subprocs(int): Number of subprocesses launched by the stage
+    '''
+    
+    tracing = tracemalloc.is_tracing()
+    
+    if not (tracing or prof_state["enabled"]):
+        yield
+        return
+    
+    # Mark this stage, and the running stages of other threads, as concurrent if they overlap
+    tid = threading.get_ident()
+    state = {"tid":tid,"concurrent":False}
+    
+    with running_lock:
+        others = [other for other in running_stages.values() if other["tid"] != tid]
+        for other in others:
+            other["concurrent"] = True
+        state["concurrent"] = len(others) > 0
+        running_stages[id(state)] = state
+        if tracing:
+            start = tracemalloc.get_traced_memory()[0]
+            if not others:
+                tracemalloc.reset_peak()
+    
+    before = prof_snapshot() if prof_state["enabled"] else None
+    
+    try:
+        yield
+    finally:
+        with running_lock:
+            del running_stages[id(state)]
+        if tracing:
+            [current,peak] = tracemalloc.get_traced_memory()
+            mem_stats.append((stage,peak - start,current - start,state["concurrent"]))
+        if before is not None:
+            after = prof_snapshot()
+            prof_stats.append({"stage":stage,
+                               "concurrent":state["concurrent"],
+                               "pid":os.getpid(),
+                               "tid":threading.get_ident(),
+                               "start":before["time"],
+                               "wall":after["wall"] - before["wall"],
+                               "cpu":after["cpu"] - before["cpu"],
+                               "rss":after["rss"] - before["rss"],
+                               "read":after["read"] - before["read"],
+                               "write":after["write"] - before["write"],
+                               "subprocs":subprocs})
+
+def start_mem_report():
+    '''
+    Starts tracing memory allocations, such that the peak memory of each processing stage is recorded (see mem_stage).
+    '''
+    
+    mem_stats.clear()
+    tracemalloc.start()
+
+def print_mem_report():
+    '''
+    Prints the peak memory of each (recorded) processing stage, along with the memory retained after each stage.
+    Repeated stages (e.g. of streamed slabs) are combined: their maximum peak and total retained memory are reported.
+    Peaks are process-wide: stages marked with '*' overlapped the stages of other threads (see mem_stage).
+    '''
+    
+    report = dict()
+    for stage,peak,retained,concurrent in mem_stats:
+        [calls,max_peak,total,any_concurrent] = report.get(stage,(0,0,0,False))
+        report[stage] = (calls + 1,max(max_peak,peak),total + retained,any_concurrent or concurrent)
+    
+    print("")
+    print(f"{'Stage':<20}{'Calls':>7}{'Peak (MiB)':>14}{'Retained (MiB)':>18}")
+    for stage,(calls,peak,retained,concurrent) in report.items():
+        print(f"{stage + (' *' if concurrent else ''):<20}{calls:>7}{peak/2**20:>14.2f}{retained/2**20:>18.2f}")
+    if any(concurrent for _,_,_,concurrent in report.values()):
+        print("* Process-wide peaks: these stages ran concurrently with stages of other threads, and include their allocations.")
+    print("")
+
+def start_profile():
+    '''
+    Starts profiling, such that the wall time, CPU time, peak RSS increase, bytes read/written and number of
+    subprocesses of each processing stage (and of each subprocess, see run) are recorded (see mem_stage).
+    '''
+    
+    prof_stats.clear()
+    prof_state["enabled"] = True
+    prof_state["start"] = prof_snapshot()
+
+def print_profile(trace_file=""):
+    '''
+    Prints the profile of each (recorded) processing stage. Repeated stages (e.g. of streamed slabs, or of batch input
+    files) are combined: their total time, bytes and subprocesses, and their maximum peak RSS increase are reported.
+    Stage times include those of nested stages (e.g. subprocesses). The profile may also be written to a JSON file in
+    the Chrome trace event format (viewable in chrome://tracing or Perfetto), with the printed summary as 'otherData'.
+    Stages marked with '*' overlapped the stages of other threads: their CPU time, RSS and I/O are process-wide.
+    
+    Arguments:
+        trace_file(file): Output JSON (Chrome trace) file. The profile is not written to file if not provided.
+    '''
+    
+    report = dict()
+    for rec in prof_stats:
+        stats = report.setdefault(rec["stage"],{"calls":0,"wall":0.0,"cpu":0.0,"rss":0,"read":0,"write":0,"subprocs":0,"concurrent":False})
+        stats["calls"] += 1
+        stats["concurrent"] = stats["concurrent"] or rec.get("concurrent",False)
+        stats["rss"] = max(stats["rss"],rec["rss"])
+        for key in ["wall","cpu","read","write","subprocs"]:
+            stats[key] += rec[key]
+    
+    start = prof_state["start"] or prof_snapshot()
+    end = prof_snapshot()
+    report["total"] = {"calls":1,
+                       "wall":end["wall"] - start["wall"],
+                       "cpu":end["cpu"] - start["cpu"],
+                       "rss":end["rss"] - start["rss"],
+                       "read":end["read"] - start["read"],
+                       "write":end["write"] - start["write"],
+                       "subprocs":sum(rec["subprocs"] for rec in prof_stats)}
+    
+    print("")
+    print(f"{'Stage':<20}{'Calls':>7}{'Wall (s)':>10}{'CPU (s)':>10}{'RSS (MiB)':>11}{'Read (MiB)':>12}{'Write (MiB)':>13}{'Subprocs':>10}")
+    for stage,stats in report.items():
+        print(f"{stage + (' *' if stats.get('concurrent') else ''):<20}{stats['calls']:>7}{stats['wall']:>10.3f}{stats['cpu']:>10.3f}{stats['rss']/2**20:>11.2f}{stats['read']/2**20:>12.2f}{stats['write']/2**20:>13.2f}{stats['subprocs']:>10}")
+    if any(stats.get("concurrent") for stats in report.values()):
+        print("* Process-wide CPU time, RSS and I/O: these stages ran concurrently with stages of other threads, and include their use.")
+    print("")
+    
+    if trace_file:
+        events = [{"name":rec["stage"],
+                   "cat":"subprocess" if rec["subprocs"] else "stage",
+                   "ph":"X",
+                   "ts":rec["start"]*1e6,
+                   "dur":rec["wall"]*1e6,
+                   "pid":rec["pid"],
+                   "tid":rec["tid"],
+                   "args":{key:rec[key] for key in ["cpu","rss","read","write","subprocs","concurrent"] if key in rec}} for rec in prof_stats]
+        with open(trace_file,"w") as f:
+            json.dump({"traceEvents":events,"displayTimeUnit":"ms","otherData":dict(report,pipeline=pipe_stats) if pipe_stats else report},f)
+
+def print_pipeline_stats():
+    '''
+    Prints the metrics of the last pipelined batch run (see BatchPipeline): the busy, active and waiting time of the
+    read, compute and write stages, and the time during which reading (I/O) overlaps compute. The busy time is summed
+    over the threads of each stage, while the active time is the time during which any thread of the stage is busy.
+    '''
+    
+    if not pipe_stats:
+        return
+    
+    stats = pipe_stats
+    
+    print("")
+    print(f"Pipeline: {stats['inputs']} input(s), {stats['readers']} reader(s), {stats['workers']} worker(s), read-ahead of {stats['depth']} input(s)/{stats['max_bytes']/2**20:.0f} MiB")
+    print(f"{'Stage':<20}{'Busy (s)':>10}{'Active (s)':>12}{'Waiting (s)':>13}")
+    for stage in ["read","compute","write"]:
+        print(f"{stage:<20}{stats[stage]['busy']:>10.3f}{stats[stage]['active']:>12.3f}{stats[stage]['wait']:>13.3f}")
+    print(f"{'wall':<20}{'':>10}{stats['wall']:>12.3f}")
+    print(f"I/O and compute overlap: {stats['overlap']:.3f} s ({stats['hidden']:.0%} of read time hidden behind compute)")
+    print(f"Peak read-ahead: {stats['peak_items']} queued input(s), {stats['peak_bytes']/2**20:.2f} MiB")
+    print("")
+
+def cache_path(key,ext=".npy"):
+    '''
+    Constructs the path of some entry in the atlas cache directory.
+    
+    Arguments:
+        key(str): Cache key
+        ext(str): Cache file extension
+    Returns:
+        file(file): Cache file path
+    '''
+    return os.path.join(cache_dir,key + ext)
+
+def evict_cache(max_size=None,keep=""):
+    '''
+    Removes the least recently used files from the atlas cache directory until its total size is below some size cap.
+    
+    Arguments:
+        max_size(int): Cache size cap (in bytes). The NIFTI_ROI_CACHE_SIZE environment variable (or 1 GiB) is used if not provided.
+        keep(file): Cache file that is never removed (e.g. a file that was just written)
+    Returns:
+        removed(list): List of removed cache files
+    '''
+    
+    if max_size is None:
+        max_size = cache_size
+    
+    removed = list()
+    
+    if not os.path.isdir(cache_dir):
+        return removed
+    
+    # Cache files, least recently used first
+    entries = list()
+    for entry in os.scandir(cache_dir):
+        if entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime,stat.st_size,entry.path))
+    entries.sort()
+    
+    total = sum(size for _,size,_ in entries)
+    
+    for _,size,file in entries:
+        if total <= max_size:
+            break
+        if file == keep:
+            continue
+        try:
+            os.remove(file)
+            removed.append(file)
+        except OSError:
+            pass
+        total -= size
+    
+    return removed
+
+def write_cache(key,ext,write_func):
+    '''
+    Atomically writes some entry to the atlas cache directory, and then enforces the cache size cap.
+    Caching is skipped (without error) if the cache directory is not writable.
+    
+    Arguments:
+        key(str): Cache key
+        ext(str): Cache file extension
+        write_func(function): Function that writes the cache entry to an (open, binary) file object
+    Returns:
+        file(file): Cache file path. An empty string is returned if the entry could not be written.
+    '''
+    
+    file = cache_path(key,ext)
+    
+    try:
+        os.makedirs(cache_dir,exist_ok=True)
+        [fd,tmp_file] = tempfile.mkstemp(dir=cache_dir,suffix=".tmp")
+        with os.fdopen(fd,"wb") as f:
+            write_func(f)
+        os.replace(tmp_file,file)
+    except OSError:
+        return ""
+    
+    evict_cache(keep=file)
+    
+    return file
+
+def touch_cache(file):
+    '''
+    Marks some atlas cache file as recently used.
+    
+    Arguments:
+        file(file): Cache file path
+    '''
+    try:
+        os.utime(file)
+    except OSError:
+        pass
+
+def atlas_cache_key(nii_atlas):
+    '''
+    Computes the atlas cache key of some NIFTI atlas, i.e. the hash of its file contents plus its header/affine.
+    
+    Arguments:
+        nii_atlas(NIFTI file): Input NIFTI atlas
+    Returns:
+        digest(str): Hexadecimal SHA-1 digest
+    '''
+    
+    img = nib.load(nii_atlas)
+    sha = hashlib.sha1(file_hash(nii_atlas).encode())
+    sha.update(img.header.binaryblock)
+    sha.update(np.ascontiguousarray(img.affine,dtype=np.float64).tobytes())
+    
+    return sha.hexdigest()
+
+def load_atlas_vol(nii_atlas,use_cache=True):
+    '''
+    Loads the (integer) labels of some NIFTI atlas. Decoded labels are stored in the atlas cache directory
+    (as a .npy file, keyed by the atlas file contents plus its header/affine), so that subsequent loads of the
+    same atlas are memory-mapped from the cache rather than decoded.
+    
+    Arguments:
+        nii_atlas(NIFTI file): Input NIFTI atlas
+        use_cache(bool): Read from/write to the atlas cache
+    Returns:
+        atlas_data(numpy array): Atlas labels represented as an N x M x P (read-only if cached) integer array
+    '''
+    
+    if not use_cache:
+        return decode_atlas(nii_atlas,mmap=True)
+    
+    key = "atlas-" + atlas_cache_key(nii_atlas)
+    file = cache_path(key)
+    
+    if os.path.exists(file):
+        try:
+            atlas_data = np.load(file,mmap_mode='r')
+            touch_cache(file)
+            return atlas_data
+        except (OSError,ValueError):
+            pass
+    
+    atlas_data = decode_atlas(nii_atlas)
+    
+    if write_cache(key,".npy",lambda f: np.save(f,atlas_data)):
+        atlas_data = np.load(file,mmap_mode='r')
+    
+    return atlas_data
+
+def load_prob_atlas(image_file,use_cache=True):
+    '''
+    Loads the probabilities of some 4D probabilistic (e.g. FSL) atlas as a voxels x regions array, such that the
+    probabilities of all regions at some voxel are contiguous. Decoded probabilities are written to the atlas cache
+    directory (see load_atlas_vol) one region at a time, and memory-mapped from the cache. Without the cache, the atlas
+    image is read on demand (see ProbRows). The whole atlas is never held in memory.
+    
+    Arguments:
+        image_file(NIFTI file): Input 4D probabilistic atlas
+        use_cache(bool): Read from/write to the atlas cache
+    Returns:
+        probs(numpy array): (N*M*P) x R array of probabilities (rows in C order of the voxels, read-only), or its
+                            on demand view (see ProbRows) if the atlas is not cached
+        shape(tuple): Atlas grid shape (N, M, P)
+        affine(numpy array): Atlas 4 x 4 voxel to mm affine
+    '''
+    
+    img = nib.load(image_file,keep_file_open=True)
+    shape = tuple(img.shape[:3])
+    rows = ProbRows(img)
+    
+    if not use_cache:
+        return rows,shape,img.affine
+    
+    key = "prob-" + atlas_cache_key(image_file)
+    file = cache_path(key)
+    
+    if os.path.exists(file):
+        try:
+            probs = np.load(file,mmap_mode='r')
+            touch_cache(file)
+            return probs,shape,img.affine
+        except (OSError,ValueError):
+            pass
+    
+    def write_probs(f):
+        # .npy header, then the voxels x regions array (memory-mapped), written one region (volume) at a time
+        np.lib.format.write_array_header_1_0(f,{"descr":np.lib.format.dtype_to_descr(rows.dtype),"fortran_order":False,"shape":rows.shape})
+        f.flush()
+        probs = np.memmap(f,dtype=rows.dtype,mode='r+',offset=f.tell(),shape=rows.shape)
+        for region in range(rows.shape[1]):
+            probs[:,region] = rows.volume(region)
+        probs.flush()
+        del probs
+    
+    with mem_stage("load atlas"):
+        if write_cache(key,".npy",write_probs):
+            return np.load(file,mmap_mode='r'),shape,img.affine
+    
+    return rows,shape,img.affine
+
+def load_atlas_index(nii_atlas,atlas_data,use_cache=True,block=8):
+    '''
+    Loads the spatial index (see AtlasIndex) of some NIFTI atlas. Indices are stored in the atlas cache directory
+    alongside the decoded atlas (keyed by the same atlas file contents plus its header/affine), so that each atlas is
+    only indexed once.
+    
+    Arguments:
+        nii_atlas(NIFTI file): Input NIFTI atlas
+        atlas_data(numpy array): Atlas labels (see load_atlas_vol)
+        use_cache(bool): Read from/write to the atlas cache
+        block(int): Block size (in voxels) of the index block grid
+    Returns:
+        index(AtlasIndex): Atlas spatial index
+    '''
+    
+    affine = nib.load(nii_atlas).affine
+    
+    if not use_cache:
+        return AtlasIndex(atlas_data,affine,block)
+    
+    key = f"index-{block}-" + atlas_cache_key(nii_atlas)
+    file = cache_path(key,".npz")
+    
+    if os.path.exists(file):
+        try:
+            with np.load(file) as npz:
+                index = AtlasIndex(atlas_data,affine,block,{name:npz[name] for name in npz.files})
+            touch_cache(file)
+            return index
+        except (OSError,ValueError,KeyError,zipfile.BadZipFile):
+            pass
+    
+    with mem_stage("index atlas"):
+        index = AtlasIndex(atlas_data,affine,block)
+    
+    write_cache(key,".npz",index.save)
+    
+    return index
+
+def load_atlas_info(atlas_info,use_cache=True):
+    '''
+    Loads the enumerated ROI key, value pairs of some atlas CSV file. Parsed label tables are stored in the
+    atlas cache directory (keyed by the CSV file contents).
+    
+    Arguments:
+        atlas_info(file): Input CSV file of enumerated ROI key, value pairs
+        use_cache(bool): Read from/write to the atlas cache
+    Returns:
+        atlas_dict(dict): Dictionary of atlas key, value pairs
+    '''
+    
+    if not use_cache:
+        return read_atlas_file(atlas_info)
+    
+    cache_key = "labels-" + file_hash(atlas_info)
+    file = cache_path(cache_key,".json")
+    
+    if os.path.exists(file):
+        try:
+            with open(file,"r") as f:
+                atlas_dict = {key: val for key,val in json.load(f)}
+            touch_cache(file)
+            return atlas_dict
+        except (OSError,ValueError):
+            pass
+    
+    atlas_dict = read_atlas_file(atlas_info)
+    
+    items = [[int(key),val] for key,val in atlas_dict.items()]
+    write_cache(cache_key,".json",lambda f: f.write(json.dumps(items).encode()))
+    
+    return atlas_dict
+
+def load_atlas_data(nii_atlas,atlas_info,data_type="int",use_cache=True):
+    '''
+    Loads atlas data from input NIFTI neuroimage atlas and it's corresponding
+    enumerated key, value paired atlas CSV file. Both are decoded in-process and
+    cached (see load_atlas_vol and load_atlas_info).
+    
+    Arguments:
+        nii_atlas(NIFTI file): Input NIFTI atlas
+        atlas_info(file): Corresponding atlas CSV file
+        data_type(str): Output data type (retained for compatibility, atlas labels are always loaded as integers)
+        use_cache(bool): Read from/write to the atlas cache
+    Returns:
+        atlas_data(numpy array): Atlas data represented as an N x M x P array
+        atlas_dict(dict): Atlas dictionary of key, value pairs
+    '''
+    
+    with mem_stage("load atlas"):
+        # Load atlas key/ID information
+        atlas_dict = load_atlas_info(atlas_info,use_cache)
+        
+        # Load atlas labels as integers
+        atlas_data = load_atlas_vol(nii_atlas,use_cache)
+    
+    return atlas_data,atlas_dict
+
+def atlas_name(atlas):
+    '''
+    Constructs the (output column) name of some atlas.
+    
+    Arguments:
+        atlas(int or tuple): FSL atlas number, or (NIFTI atlas, CSV file) tuple (see parse_atlas_spec)
+    Returns:
+        name(str): Atlas name (the FSL atlas name, or the NIFTI atlas file name without its extension)
+    '''
+    
+    if isinstance(atlas,(int,np.integer)):
+        return vol_atlas_dict.get(int(atlas),f"Atlas {atlas}")
+    
+    return os.path.basename(remove_ext(atlas[0]))
+
+def load_atlases(atlases,use_cache=True,table=False,nearest=False,prob_cutoff=None):
+    '''
+    Loads several (FSL and/or stand-alone) atlases, such that all of them can be resolved against the same clusters.
+    Duplicate atlases are only loaded (and reported) once.
+    
+    Arguments:
+        atlases(list): List of FSL atlas numbers (int) and/or (NIFTI atlas, CSV file) tuples
+        use_cache(bool): Read from/write to the atlas cache
+        table(bool): Also count the voxels of each stand-alone atlas label (for cluster x ROI tables)
+        nearest(bool): Report the nearest labelled ROI of unlabelled cluster peaks in the cluster x ROI tables of stand-alone atlases
+        prob_cutoff(float): Resolve probabilistic FSL atlases over whole clusters, reporting ROIs whose mean membership
+                            probability (%) is at least this value (see cluster_memberships). FSL atlases are resolved
+                            at cluster peaks if not provided.
+    Returns:
+        loaded(list): List of atlas dictionaries with the atlas 'name', and either the FSL atlas number ('num'), or the
+                      stand-alone atlas 'data', 'dict', label lookup array ('lut'), label voxel counts ('sizes'), voxel to
+                      mm 'affine', spatial 'index' (see load_atlas_index, if required) and 'nearest' flag. Probabilistic
+                      FSL atlases loaded with a cutoff also have their (voxels x regions) 'probs', 'prob_shape',
+                      'prob_affine', region 'labels' and 'cutoff' (see load_prob_atlas).
+    '''
+    
+    loaded = list()
+    specs = list()
+    names = list()
+    
+    for atlas in atlases:
+        spec = int(atlas) if isinstance(atlas,(int,np.integer)) else (os.path.abspath(atlas[0]),os.path.abspath(atlas[1]))
+        
+        if spec in specs:
+            continue
+        specs.append(spec)
+        
+        # Unique (output column) names
+        name = atlas_name(atlas)
+        if name in names:
+            name = f"{name} ({names.count(name) + 1})"
+        names.append(atlas_name(atlas))
+        
+        if isinstance(spec,int) and prob_cutoff is not None and load_fsl_atlas(spec).atlas_type == "probabilistic":
+            fsl = load_fsl_atlas(spec)
+            [probs,shape,affine] = load_prob_atlas(fsl.image_file,use_cache)
+            loaded.append({"name":name,
+                           "num":spec,
+                           "probs":probs,
+                           "prob_shape":shape,
+                           "prob_affine":affine,
+                           "labels":fsl.labels,
+                           "cutoff":float(prob_cutoff)})
+        elif isinstance(spec,int):
+            loaded.append({"name":name,"num":spec})
+        else:
+            [atlas_data,atlas_dict] = load_atlas_data(atlas[0],atlas[1],use_cache=use_cache)
+            index = load_atlas_index(atlas[0],atlas_data,use_cache) if table or nearest else None
+            loaded.append({"name":name,
+                           "data":atlas_data,
+                           "dict":atlas_dict,
+                           "lut":make_label_lut(atlas_dict),
+                           "sizes":index.sizes() if table else None,
+                           "affine":nib.load(atlas[0]).affine,
+                           "index":index,
+                           "nearest":nearest})
+    
+    return loaded
+
+def make_cluster_vol(nii_file,thresh=0.95,dist=0,connectivity=26):
+    '''
+    Creates enumerated clusters from input NIFTI file and writes the enumerated clusters to a separate NIFTI volume,
+    along with the cluster and local maxima tables (see find_clusters and find_peaks). Clusters are computed in-process,
+    and all outputs are written next to the input file.
+    
+    Arguments:
+        nii_file(NIFTI file): Input NIFTI file
+        thresh(float): Minimum threshold 
+        dist(float): Minimum distance (in mm) between the local maxima of a cluster
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+    Returns:
+        out_file(NIFTI file): Output NIFTI file of enumerated clusters
+        out_stat(file): Corresponding table of enumerated clusters with MNI space mm coordinates
+        out_peaks(file): Corresponding table of the local maxima of each cluster with MNI space mm coordinates
+    '''
+    
+    # Construct file paths
+    nii_file = os.path.abspath(nii_file)
+    out_dir = os.path.dirname(nii_file)
+    
+    img = nib.load(nii_file)
+    
+    nii_file = remove_ext(nii_file)
+    name = os.path.basename(nii_file)
+    out_prefix = os.path.join(out_dir,name + ".cluster")
+    
+    out_file = out_prefix + ".nii.gz"
+    out_stat = out_prefix + ".txt"
+    out_peaks = out_prefix + ".lmax.txt"
+    
+    # Make cluster(s) from input data
+    with mem_stage("load input"):
+        img_data = load_img_data(img).reshape(img.shape[:3],order='A')
+    
+    with mem_stage("cluster"):
+        clusters = sparse_clusters(img_data,thresh,connectivity)
+        peak_table = find_peaks(img_data,clusters,img.affine,dist)
+    
+    nib.save(nib.Nifti1Image(dense_clusters(clusters),img.affine),out_file)
+    sparse_table(clusters,img.affine).to_csv(out_stat,sep="\t",index=False)
+    peak_table.to_csv(out_peaks,sep="\t",index=False)
+    
+    return out_file,out_stat,out_peaks
+
+def sparse_clusters(img_data,thresh=0.95,connectivity=26):
+    '''
+    Identifies clusters of suprathreshold voxels in a 3D array, and represents them sparsely: the (C order) flat
+    indices of the clustered voxels are grouped by cluster (CSR style), such that the voxels of cluster index i are
+    index[offsets[i - 1]:offsets[i]]. Clusters are enumerated by size (the largest cluster has the highest cluster
+    index), as with find_clusters. Voxels are connected through their (suprathreshold) neighbours only, so that
+    no dense label volume is created, and the cost of clustering scales with the number of suprathreshold voxels.
+    
+    Arguments:
+        img_data(numpy array): N x M x P numpy array of (statistical) image data
+        thresh(float): Minimum threshold (voxels >= thresh are included)
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+    Returns:
+        clusters(dict): Sparse clusters, i.e. the volume 'shape', cluster 'offsets' (K + 1) and voxel 'index' arrays, along with
+                        the 'peak_val', 'peak_idx' (flat index) and 'cog_vox' (K x 3) of each cluster (at position i - 1)
+    '''
+    
+    img_data = np.asarray(img_data)
+    shape = img_data.shape
+    
+    if connectivity not in conn_rank:
+        raise ValueError(f"Invalid connectivity: {connectivity}. Valid values are: {list(conn_rank)}")
+    
+    # Suprathreshold voxel (C order) flat indices, voxel coordinates and values (the threshold is compared in double
+    # precision, whatever the image data type). Voxels are gathered by coordinate, so that (e.g. Fortran ordered) image
+    # data is never copied.
+    mask = (img_data >= np.float64(thresh)).ravel()
+    vox_idx = np.flatnonzero(mask)
+    vox_ijk = np.unravel_index(vox_idx,shape)
+    vox_val = np.asarray(img_data[vox_ijk],dtype=np.float64)
+    
+    # Edges between suprathreshold neighbours (each neighbour offset is visited in one direction only). Voxels that
+    # follow a suprathreshold voxel (along the last axis) only need the edges that their predecessor does not have.
+    structure = ndimage.generate_binary_structure(3,conn_rank[connectivity])
+    strides = np.array([shape[1]*shape[2],shape[2],1])
+    has_pred = (np.diff(vox_idx,prepend=-1) == 1) & (vox_ijk[2] > 0)
+    edges = list()
+    
+    for offset in np.argwhere(structure) - 1:
+        if tuple(offset) <= (0,0,0):
+            continue
+        valid = ~has_pred if offset[2] < 1 and structure[offset[0] + 1,offset[1] + 1,offset[2] + 2] else np.ones(len(vox_idx),dtype=bool)
+        for axis in range(3):
+            if offset[axis] > 0:
+                valid &= vox_ijk[axis] < shape[axis] - offset[axis]
+            elif offset[axis] < 0:
+                valid &= vox_ijk[axis] >= -offset[axis]
+        src = np.flatnonzero(valid)
+        dst = vox_idx[src] + offset @ strides
+        hit = mask[dst]
+        edges.append((src[hit],np.searchsorted(vox_idx,dst[hit])))
+    
+    a = np.concatenate([edge[0] for edge in edges])
+    b = np.concatenate([edge[1] for edge in edges])
+    
+    # Connected components are numbered in order of their first voxel (as with ndimage.label)
+    graph = sparse.coo_matrix((np.ones(len(a),dtype=np.int8),(a,b)),shape=(len(vox_idx),len(vox_idx)))
+    [n_clusters,vox_lab] = csgraph.connected_components(graph,directed=False)
+    
+    # Order clusters by size: the largest cluster has the highest index
+    sizes = np.bincount(vox_lab,minlength=n_clusters)
+    order = np.argsort(sizes,kind='stable')
+    relabel = np.zeros(n_clusters,dtype=np.int64)
+    relabel[order] = np.arange(1,n_clusters + 1)
+    
+    vox_lab = relabel[vox_lab]
+    sizes = np.bincount(vox_lab,minlength=n_clusters + 1)[1:]
+    
+    # Voxels grouped by cluster (in C order within each cluster)
+    order = np.argsort(vox_lab,kind='stable')
+    offsets = np.concatenate(([0],np.cumsum(sizes)))
+    index = vox_idx[order]
+    
+    # Peak (maximum value) voxel of each cluster, i.e. its first voxel of maximum value
+    values = vox_val[order]
+    peak_val = np.maximum.reduceat(values,offsets[:-1]) if n_clusters else np.empty(0)
+    peaks = np.flatnonzero(values == np.repeat(peak_val,sizes))
+    peak_idx = index[peaks[np.searchsorted(peaks,offsets[:-1])]]
+    
+    # Intensity weighted center of gravity of each cluster
+    weights = np.bincount(vox_lab,weights=vox_val,minlength=n_clusters + 1)[1:]
+    cog_vox = np.column_stack([np.bincount(vox_lab,weights=vox_val*ijk,minlength=n_clusters + 1)[1:] for ijk in vox_ijk]) if n_clusters else np.empty((0,3))
+    cog_vox = cog_vox / np.where(weights == 0,1,weights)[:,None]
+    
+    clusters = {"shape":shape,
+                "offsets":offsets,
+                "index":index,
+                "peak_val":peak_val,
+                "peak_idx":peak_idx,
+                "cog_vox":cog_vox}
+    
+    return clusters
+
+def sparse_table(clusters,affine=None):
+    '''
+    Constructs the FSL `cluster` style table of some sparse clusters (see sparse_clusters).
+    
+    Arguments:
+        clusters(dict): Sparse clusters
+        affine(numpy array): 4 x 4 voxel to mm affine. If provided, coordinates are reported in mm, otherwise in voxels.
+    Returns:
+        clust_table(DataFrame): Cluster table with FSL `cluster` style columns
+    '''
+    
+    peak_vox = np.column_stack(np.unravel_index(clusters["peak_idx"],clusters["shape"]))
+    clust_table = make_clust_table(np.diff(clusters["offsets"]),clusters["peak_val"],peak_vox,clusters["cog_vox"],affine)
+    
+    return clust_table
+
+def dense_clusters(clusters):
+    '''
+    Creates the volume of enumerated clusters of some sparse clusters (see sparse_clusters), stored in the
+    smallest integer data type.
+    
+    Arguments:
+        clusters(dict): Sparse clusters
+    Returns:
+        cluster_data(numpy array): N x M x P numpy array of enumerated clusters (0 = background)
+    '''
+    
+    n_clusters = len(clusters["offsets"]) - 1
+    
+    cluster_data = np.zeros(clusters["shape"],dtype=np.min_scalar_type(n_clusters))
+    cluster_data.reshape(-1)[clusters["index"]] = cluster_ids(clusters).astype(cluster_data.dtype)
+    
+    return cluster_data
+
+def cluster_ids(clusters):
+    '''
+    Expands the cluster offsets of some sparse clusters (see sparse_clusters) to the cluster index of each voxel.
+    
+    Arguments:
+        clusters(dict): Sparse clusters
+    Returns:
+        ids(numpy array): Cluster index of each voxel (in the order of the voxel index array)
+    '''
+    
+    offsets = np.asarray(clusters["offsets"])
+    
+    return np.repeat(np.arange(1,len(offsets)),np.diff(offsets))
+
+def sample_voxels(data,index):
+    '''
+    Fetches the values of some (e.g. memory-mapped) volume at several voxels, without reading the rest of the volume.
+    
+    Arguments:
+        data(numpy array): N x M x P numpy array
+        index(numpy array): (C order) flat voxel indices
+    Returns:
+        values(numpy array): Values of the voxels
+    '''
+    
+    if isinstance(data,np.ndarray) and data.flags.c_contiguous:
+        return data.reshape(-1)[index]
+    
+    return np.asarray(data[np.unravel_index(index,data.shape[:3])])
+
+def cluster_cache_keys(nii_file,volumes,thresh=0.95,connectivity=26):
+    '''
+    Constructs the cluster cache keys of several volumes of some input file, keyed by the file contents and the clustering parameters.
+    
+    Arguments:
+        nii_file(NIFTI file): Input NIFTI file
+        volumes(list): List of volume indices (None for 3D input files)
+        thresh(float): Minimum threshold
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+    Returns:
+        keys(dict): Dictionary of volume index -> cache key
+    '''
+    
+    digest = file_hash(nii_file)
+    
+    keys = {volume:"clusters-" + hashlib.sha1(json.dumps([digest,volume,float(thresh),connectivity]).encode()).hexdigest() for volume in volumes}
+    
+    return keys
+
+def load_clusters(key):
+    '''
+    Reads some sparse clusters (see sparse_clusters) from the cluster cache, where they are stored (as a .npz file)
+    in their sparse form.
+    
+    Arguments:
+        key(str): Cache key (see cluster_cache_keys)
+    Returns:
+        clusters(dict): Sparse clusters, or None if they are not cached
+    '''
+    
+    file = cache_path(key,".npz")
+    
+    if not os.path.exists(file):
+        return None
+    
+    try:
+        with np.load(file) as npz:
+            clusters = {name:npz[name] for name in ["shape","offsets","index","peak_val","peak_idx","cog_vox"]}
+    except (OSError,ValueError,KeyError,zipfile.BadZipFile):
+        return None
+    
+    clusters["shape"] = tuple(int(dim) for dim in clusters["shape"])
+    touch_cache(file)
+    
+    return clusters
+
+def save_clusters(key,clusters):
+    '''
+    Writes some sparse clusters (see sparse_clusters) to the cluster cache.
+    
+    Arguments:
+        key(str): Cache key (see cluster_cache_keys)
+        clusters(dict): Sparse clusters
+    Returns:
+        file(file): Cache file path. An empty string is returned if the clusters could not be written.
+    '''
+    return write_cache(key,".npz",lambda f: np.savez(f,**clusters))
+
+def find_clusters(img_data,thresh=0.95,connectivity=26,affine=None):
+    '''
+    Identifies clusters of suprathreshold voxels in a 3D array (in-process equivalent of FSL's `cluster`).
+    Clusters are enumerated by size, such that the largest cluster has the highest cluster index (as with
+    FSL's `--oindex` output), and the cluster table is sorted by descending cluster size. See sparse_clusters
+    to avoid the (dense) cluster volume.
+    
+    Arguments:
+        img_data(numpy array): N x M x P numpy array of (statistical) image data
+        thresh(float): Minimum threshold (voxels >= thresh are included)
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+        affine(numpy array): 4 x 4 voxel to mm affine. If provided, peak and center of gravity coordinates are reported in mm, otherwise in voxels.
+    Returns:
+        cluster_data(numpy array): N x M x P numpy array of enumerated clusters (0 = background)
+        clust_table(DataFrame): Cluster table with FSL `cluster` style columns
+    '''
+    
+    clusters = sparse_clusters(img_data,thresh,connectivity)
+    
+    cluster_data = dense_clusters(clusters)
+    clust_table = sparse_table(clusters,affine)
+    
+    return cluster_data,clust_table
+
+def make_clust_table(sizes,peak_val,peak_vox,cog_vox,affine=None):
+    '''
+    Constructs an FSL `cluster` style table (largest cluster first) from per-cluster statistics, where the
+    statistics of cluster index i are stored at position i - 1.
+    
+    Arguments:
+        sizes(numpy array): Number of voxels in each cluster
+        peak_val(numpy array): Peak (maximum) value of each cluster
+        peak_vox(numpy array): K x 3 array of the peak voxel coordinates of each cluster
+        cog_vox(numpy array): K x 3 array of the (intensity weighted) center of gravity voxel coordinates of each cluster
+        affine(numpy array): 4 x 4 voxel to mm affine. If provided, coordinates are reported in mm, otherwise in voxels.
+    Returns:
+        clust_table(DataFrame): Cluster table with FSL `cluster` style columns
+    '''
+    
+    n_clusters = len(sizes)
+    peak_vox = np.asarray(peak_vox,dtype=np.float64).reshape(-1,3)
+    cog_vox = np.asarray(cog_vox,dtype=np.float64).reshape(-1,3)
+    
+    if affine is not None:
+        unit = "mm"
+        peak_xyz = nib.affines.apply_affine(affine,peak_vox)
+        cog_xyz = nib.affines.apply_affine(affine,cog_vox)
+    else:
+        unit = "vox"
+        peak_xyz = peak_vox
+        cog_xyz = cog_vox
+    
+    # Construct cluster table (largest cluster first)
+    idx = np.arange(n_clusters)[::-1]
+    clust_table = pd.DataFrame({"Cluster Index":idx + 1,
+                                "Voxels":np.asarray(sizes)[idx],
+                                "MAX":np.asarray(peak_val)[idx],
+                                f"MAX X ({unit})":peak_xyz[idx,0],
+                                f"MAX Y ({unit})":peak_xyz[idx,1],
+                                f"MAX Z ({unit})":peak_xyz[idx,2],
+                                f"COG X ({unit})":cog_xyz[idx,0],
+                                f"COG Y ({unit})":cog_xyz[idx,1],
+                                f"COG Z ({unit})":cog_xyz[idx,2]})
+    
+    return clust_table
+
+def find_peaks(img_data,clusters,affine=None,dist=0):
+    '''
+    Identifies the local maxima of each cluster of some sparse clusters (see sparse_clusters), i.e. the in-process
+    equivalent of FSL `cluster`'s local maxima (`--olmax`) table with `--peakdist`. A maximum filter (over the 26
+    neighbourhood) is applied within the bounding box of each cluster, such that voxels of other clusters and of the
+    background are never compared, and voxels not below any of their neighbours are local maxima. Local maxima that
+    are closer than some minimum distance to a higher local maximum of the same cluster are then suppressed (greedily,
+    highest value first), using a KD-tree of the local maxima rather than comparing every pair.
+    
+    Arguments:
+        img_data(numpy array): N x M x P numpy array of (statistical) image data
+        clusters(dict): Sparse clusters of the image data
+        affine(numpy array): 4 x 4 voxel to mm affine. If provided, coordinates (and distances) are in mm, otherwise in voxels.
+        dist(float): Minimum distance between the local maxima of a cluster (0 to keep all local maxima)
+    Returns:
+        peak_table(DataFrame): Local maxima table with FSL `cluster` style columns (largest cluster first, then by descending value)
+    '''
+    
+    shape = clusters["shape"]
+    offsets = np.asarray(clusters["offsets"])
+    index = np.asarray(clusters["index"])
+    
+    ids = cluster_ids(clusters)
+    values = np.asarray(sample_voxels(img_data,index),dtype=np.float64)
+    vox_ijk = np.column_stack(np.unravel_index(index,shape)) if len(index) else np.empty((0,3),dtype=np.int64)
+    
+    # Single voxel clusters are their own local maximum, other clusters are filtered within their bounding box
+    is_peak = np.ones(len(index),dtype=bool)
+    sizes = np.diff(offsets)
+    
+    if len(index):
+        lower = np.minimum.reduceat(vox_ijk,offsets[:-1],axis=0)
+        upper = np.maximum.reduceat(vox_ijk,offsets[:-1],axis=0)
+    
+    for i in np.flatnonzero(sizes > 1):
+        [start,stop] = offsets[i:i + 2]
+        box_ijk = tuple((vox_ijk[start:stop] - lower[i]).T)
+        box = np.full(upper[i] - lower[i] + 1,-np.inf)
+        box[box_ijk] = values[start:stop]
+        is_peak[start:stop] = values[start:stop] >= ndimage.maximum_filter(box,size=3,mode='constant',cval=-np.inf)[box_ijk]
+    
+    # Local maxima ordered by cluster (largest first), then by descending value
+    peaks = np.flatnonzero(is_peak)
+    peaks = peaks[np.lexsort((index[peaks],-values[peaks],-ids[peaks]))]
+    
+    peak_xyz = vox_ijk[peaks].astype(np.float64)
+    if affine is not None:
+        unit = "mm"
+        peak_xyz = nib.affines.apply_affine(affine,peak_xyz)
+    else:
+        unit = "vox"
+    
+    # Suppress local maxima within the minimum distance of a higher (kept) local maximum of the same cluster
+    keep = np.ones(len(peaks),dtype=bool)
+    
+    if dist > 0 and len(peaks) > 1:
+        pairs = spatial.cKDTree(peak_xyz).query_pairs(dist,output_type='ndarray')
+        pairs = pairs[ids[peaks[pairs[:,0]]] == ids[peaks[pairs[:,1]]]]
+        pairs = pairs[np.linalg.norm(peak_xyz[pairs[:,0]] - peak_xyz[pairs[:,1]],axis=1) < dist]
+    
+        # Pairs are (higher, lower) ranked local maxima, grouped by the higher ranked local maximum
+        pairs = pairs[np.lexsort((pairs[:,1],pairs[:,0]))]
+        [heads,starts] = np.unique(pairs[:,0],return_index=True)
+    
+        for head,start,stop in zip(heads,starts,np.append(starts[1:],len(pairs))):
+            if keep[head]:
+                keep[pairs[start:stop,1]] = False
+    
+    peaks = peaks[keep]
+    peak_xyz = peak_xyz[keep]
+    
+    peak_table = pd.DataFrame({"Cluster Index":ids[peaks],
+                               "Value":values[peaks],
+                               f"x ({unit})":peak_xyz[:,0],
+                               f"y ({unit})":peak_xyz[:,1],
+                               f"z ({unit})":peak_xyz[:,2]})
+    
+    return peak_table
+
+def stream_clusters(nii_file,thresh=0.95,connectivity=26,slab=16,atlas_data=None,affine=None,volume=None):
+    '''
+    Identifies clusters of suprathreshold voxels in some NIFTI file by streaming through the volume in z-slabs,
+    such that memory is bounded by the slab size rather than the volume size. Clusters are labelled within each
+    slab, merged across slab boundaries, and then enumerated as with find_clusters (i.e. the results are
+    identical to those of the in-memory path). Cluster x atlas label voxel counts are accumulated slab by slab.
+    
+    Arguments:
+        nii_file(NIFTI file): Input NIFTI file
+        thresh(float): Minimum threshold (voxels >= thresh are included)
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+        slab(int): Number of z-slices per slab
+        atlas_data(numpy array): Optional atlas labels (e.g. memory-mapped, see load_atlas_data) in the same voxel grid as the input,
+                                 or a list of such atlases (all of which are sampled in the same pass)
+        affine(numpy array): 4 x 4 voxel to mm affine used for the cluster table. If not provided, voxel coordinates are reported.
+        volume(int): Volume index of 4D input files
+    Returns:
+        clust_table(DataFrame): Cluster table with FSL `cluster` style columns
+        overlap(tuple): Tuple of (cluster index, atlas label, voxel count) arrays (None if no atlas is provided), or a list
+                        of such tuples (one for each atlas) if a list of atlases is provided
+    '''
+    
+    if connectivity not in conn_rank:
+        raise ValueError(f"Invalid connectivity: {connectivity}. Valid values are: {list(conn_rank)}")
+    
+    img = nib.load(nii_file,keep_file_open=True)
+    shape = img.shape[:3]
+    
+    if img_volumes(img) and volume is None:
+        raise ValueError(f"A volume index is required to stream 4D input files: {nii_file} has shape {img.shape}.")
+    
+    # Slab index of the requested volume
+    vol_idx = (volume,) if img_volumes(img) else (0,)*(len(img.shape) - 3)
+    
+    atlases = list(atlas_data) if isinstance(atlas_data,(list,tuple)) else [] if atlas_data is None else [atlas_data]
+    
+    for data in atlases:
+        if tuple(data.shape[:3]) != tuple(shape):
+            raise ValueError(f"Input volume shape {shape} does not match atlas shape {data.shape}.")
+    
+    structure = ndimage.generate_binary_structure(3,conn_rank[connectivity])
+    slab = max(int(slab),1)
+    
+    # Per provisional (slab) cluster statistics
+    stats = {"size":[],"min_idx":[],"peak_val":[],"peak_idx":[],"w":[],"wi":[],"wj":[],"wk":[]}
+    edges = list()
+    counts = [list() for _ in atlases]
+    n_prov = 0
+    prev_plane = None
+    
+    for z0 in range(0,shape[2],slab):
+        z1 = min(z0 + slab,shape[2])
+        
+        with mem_stage("load input"):
+            data = np.asanyarray(img.dataobj[(slice(None),slice(None),slice(z0,z1)) + vol_idx]).reshape(shape[0],shape[1],z1 - z0)
+        
+        with mem_stage("cluster"):
+            [labels,n] = ndimage.label(data >= np.float64(thresh),structure=structure)
+            
+            # Provisional (0-based, volume-wide) cluster labels of suprathreshold voxels (in C order)
+            vox_idx = np.flatnonzero(labels)
+            [i,j,k] = np.unravel_index(vox_idx,labels.shape)
+            prov = labels.ravel()[vox_idx].astype(np.int64) - 1 + n_prov
+            val = np.asarray(data[i,j,k],dtype=np.float64)
+            k = k + z0
+            gidx = np.ravel_multi_index((i,j,k),shape)
+            
+            # First (i.e. lowest C order index) voxel of each provisional cluster
+            [_,first] = np.unique(prov,return_index=True)
+            stats["min_idx"].append(gidx[first])
+            stats["size"].append(np.bincount(prov - n_prov,minlength=n))
+            
+            # Peak voxel of each provisional cluster (lowest index among ties)
+            peak_order = np.lexsort((gidx,-val,prov))
+            peak_first = np.searchsorted(prov[peak_order],np.arange(n_prov,n_prov + n))
+            stats["peak_val"].append(val[peak_order[peak_first]])
+            stats["peak_idx"].append(gidx[peak_order[peak_first]])
+            
+            # Center of gravity sums
+            stats["w"].append(np.bincount(prov - n_prov,weights=val,minlength=n))
+            stats["wi"].append(np.bincount(prov - n_prov,weights=val*i,minlength=n))
+            stats["wj"].append(np.bincount(prov - n_prov,weights=val*j,minlength=n))
+            stats["wk"].append(np.bincount(prov - n_prov,weights=val*k,minlength=n))
+            
+            # Provisional labels of the first and last planes of the slab (-1 = background)
+            planes = np.where(labels[:,:,[0,-1]] > 0,labels[:,:,[0,-1]].astype(np.int64) - 1 + n_prov,-1)
+            
+            # Connect clusters across the slab boundary
+            if prev_plane is not None:
+                edges.append(plane_edges(prev_plane,planes[:,:,0],structure))
+            prev_plane = planes[:,:,1]
+        
+        # Accumulate (provisional cluster, atlas label) voxel counts
+        for data,atlas_counts in zip(atlases,counts):
+            with mem_stage("overlap"):
+                atlas_labels = np.asarray(data[i,j,k],dtype=np.int64)
+                [pairs,n_pairs] = np.unique(np.column_stack((prov,atlas_labels)),axis=0,return_counts=True)
+                atlas_counts.append((pairs,n_pairs))
+        
+        n_prov += n
+    
+    stats = {key:np.concatenate(val) if val else np.empty(0) for key,val in stats.items()}
+    
+    # Merge provisional clusters connected across slab boundaries
+    edges = np.concatenate(edges) if edges else np.empty((0,2),dtype=np.int64)
+    graph = sparse.coo_matrix((np.ones(len(edges)),(edges[:,0],edges[:,1])),shape=(n_prov,n_prov))
+    [n_clusters,comp] = csgraph.connected_components(graph,directed=False)
+    
+    sizes = np.bincount(comp,weights=stats["size"],minlength=n_clusters).astype(np.int64)
+    min_idx = np.full(n_clusters,np.iinfo(np.int64).max)
+    np.minimum.at(min_idx,comp,stats["min_idx"].astype(np.int64))
+    
+    # Enumerate clusters by size (ties ordered by first voxel, as with scipy.ndimage.label)
+    order = np.lexsort((min_idx,sizes))
+    relabel = np.zeros(n_clusters,dtype=np.int64)
+    relabel[order] = np.arange(1,n_clusters + 1)
+    clust = relabel[comp]
+    
+    # Per-cluster statistics (stored at cluster index - 1)
+    peak_order = np.lexsort((stats["peak_idx"],-stats["peak_val"],clust))
+    peak_first = np.searchsorted(clust[peak_order],np.arange(1,n_clusters + 1))
+    peak_val = stats["peak_val"][peak_order[peak_first]]
+    peak_vox = np.column_stack(np.unravel_index(stats["peak_idx"][peak_order[peak_first]].astype(np.int64),shape)) if n_clusters else np.empty((0,3))
+    
+    w = np.bincount(clust - 1,weights=stats["w"],minlength=n_clusters)
+    cog_vox = np.column_stack([np.bincount(clust - 1,weights=stats[key],minlength=n_clusters) for key in ["wi","wj","wk"]]) if n_clusters else np.empty((0,3))
+    cog_vox = cog_vox / np.where(w == 0,1,w)[:,None]
+    
+    clust_table = make_clust_table(sizes[order],peak_val,peak_vox,cog_vox,affine)
+    
+    # Cluster x atlas label voxel counts
+    overlaps = list()
+    for atlas_counts in counts:
+        pairs = np.concatenate([pair for pair,_ in atlas_counts]) if atlas_counts else np.empty((0,2),dtype=np.int64)
+        n_pairs = np.concatenate([count for _,count in atlas_counts]) if atlas_counts else np.empty(0,dtype=np.int64)
+        pairs[:,0] = clust[pairs[:,0]]
+        [pairs,inverse] = np.unique(pairs,axis=0,return_inverse=True)
+        overlaps.append((pairs[:,0],pairs[:,1],np.bincount(inverse.ravel(),weights=n_pairs,minlength=len(pairs)).astype(np.int64)))
+    
+    if isinstance(atlas_data,(list,tuple)):
+        overlap = overlaps
+    else:
+        overlap = overlaps[0] if overlaps else None
+    
+    return clust_table,overlap
+
+def plane_edges(plane_a,plane_b,structure):
+    '''
+    Finds the pairs of (provisional) cluster labels that are connected across two adjacent z-planes.
+    
+    Arguments:
+        plane_a(numpy array): N x M labels of the lower plane (-1 = background)
+        plane_b(numpy array): N x M labels of the upper plane (-1 = background)
+        structure(numpy array): 3 x 3 x 3 connectivity structuring element
+    Returns:
+        edges(numpy array): K x 2 array of connected (unique) label pairs
+    '''
+    
+    [nx,ny] = plane_a.shape
+    edges = list()
+    
+    for dx in (-1,0,1):
+        for dy in (-1,0,1):
+            if not structure[1 + dx,1 + dy,2]:
+                continue
+            a = plane_a[max(0,-dx):nx - max(0,dx),max(0,-dy):ny - max(0,dy)]
+            b = plane_b[max(0,dx):nx - max(0,-dx),max(0,dy):ny - max(0,-dy)]
+            both = (a >= 0) & (b >= 0)
+            edges.append(np.column_stack((a[both],b[both])))
+    
+    edges = np.unique(np.concatenate(edges),axis=0)
+    
+    return edges
+
+def parse_thresholds(values):
+    '''
+    Parses a list of thresholds, given as values (e.g. '2.3') and/or inclusive ranges (e.g. '2:4:0.5', i.e. start, stop, step).
+    
+    Arguments:
+        values(list): List of threshold values and/or ranges (str)
+    Returns:
+        thresholds(list): Sorted (ascending) list of unique thresholds
+    '''
+    
+    thresholds = set()
+    
+    for value in values:
+        if ":" in value:
+            [start,stop,step] = [float(val) for val in value.split(":")]
+            if step <= 0:
+                raise ValueError(f"Invalid threshold range: {value}. The step must be positive.")
+            thresholds.update(np.round(np.arange(start,stop + step/2,step),10).tolist())
+        else:
+            thresholds.add(float(value))
+    
+    return sorted(thresholds)
+
+def merge_components(n_comp,a,b):
+    '''
+    Merges the components of several pairs of components (i.e. a batch of union-find unions), by labelling the
+    connected components of the graph of components joined by the pairs.
+    
+    Arguments:
+        n_comp(int): Number of components
+        a(numpy array): First component of each pair
+        b(numpy array): Second component of each pair
+    Returns:
+        n_merged(int): Number of merged components
+        merged(numpy array): Merged component of each component (0 to n_merged - 1)
+    '''
+    
+    graph = sparse.coo_matrix((np.ones(len(a),dtype=np.int8),(a,b)),shape=(n_comp,n_comp))
+    [n_merged,merged] = csgraph.connected_components(graph,directed=False)
+    
+    return n_merged,merged
+
+def merge_stats(stats,merged,n_merged):
+    '''
+    Merges the (suprathreshold voxel) statistics of several components (see sweep_clusters).
+    
+    Arguments:
+        stats(dict): Dictionary of component statistics ('size', 'min_idx', 'peak_val', 'peak_idx' and the center of
+                     gravity sums 'w', 'wi', 'wj' and 'wk')
+        merged(numpy array): Merged component of each component (see merge_components)
+        n_merged(int): Number of merged components
+    Returns:
+        merged_stats(dict): Dictionary of merged component statistics
+    '''
+    
+    merged_stats = {key:np.bincount(merged,weights=stats[key],minlength=n_merged) for key in ["size","w","wi","wj","wk"]}
+    
+    merged_stats["min_idx"] = np.full(n_merged,np.inf)
+    np.minimum.at(merged_stats["min_idx"],merged,stats["min_idx"])
+    
+    # Peak (maximum value, lowest index among ties)
+    merged_stats["peak_val"] = np.full(n_merged,-np.inf)
+    np.maximum.at(merged_stats["peak_val"],merged,stats["peak_val"])
+    peak = stats["peak_val"] == merged_stats["peak_val"][merged]
+    merged_stats["peak_idx"] = np.full(n_merged,np.inf)
+    np.minimum.at(merged_stats["peak_idx"],merged[peak],stats["peak_idx"][peak])
+    
+    return merged_stats
+
+def sweep_clusters(img_data,thresholds,connectivity=26,affine=None,atlas_data=None):
+    '''
+    Identifies clusters of suprathreshold voxels in a 3D array at several thresholds in a single pass. Voxels above the
+    lowest threshold, and the edges between neighbouring voxels (each active from the lower of its two voxel values),
+    are found and sorted (by the highest threshold at which they are active) once. Clusters are then grown from the
+    highest threshold down by merging (union-find) the edges that become active at each threshold. Clusters are
+    enumerated as with find_clusters (i.e. the results of each threshold are identical to those of find_clusters at
+    that threshold).
+    
+    Arguments:
+        img_data(numpy array): N x M x P numpy array of (statistical) image data
+        thresholds(list): List of thresholds (voxels >= thresh are included)
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+        affine(numpy array): 4 x 4 voxel to mm affine. If provided, peak and center of gravity coordinates are reported in mm, otherwise in voxels.
+        atlas_data(list): List of N x M x P numpy arrays of atlas labels (in the same voxel grid as the input)
+    Returns:
+        sweep(list): List of (threshold, cluster table, overlaps) tuples (highest threshold first), where overlaps is a list of
+                     (cluster index, atlas label, voxel count) array tuples (see pair_counts), one for each atlas
+    '''
+    
+    atlas_data = atlas_data or []
+    img_data = np.asarray(img_data)
+    shape = img_data.shape
+    
+    if connectivity not in conn_rank:
+        raise ValueError(f"Invalid connectivity: {connectivity}. Valid values are: {list(conn_rank)}")
+    
+    for data in atlas_data:
+        if tuple(data.shape[:3]) != tuple(shape):
+            raise ValueError(f"Input volume shape {shape} does not match atlas shape {data.shape}.")
+    
+    thresholds = np.array(sorted(set(float(thresh) for thresh in thresholds)))
+    
+    # Voxels above the lowest threshold (in C order), their values, atlas labels and level (i.e. the index of the
+    # highest threshold at which they are suprathreshold)
+    vox_idx = np.flatnonzero(img_data >= thresholds[0])
+    vox_ijk = np.unravel_index(vox_idx,shape)
+    vox_val = np.asarray(img_data[vox_ijk],dtype=np.float64)
+    vox_level = np.searchsorted(thresholds,vox_val,side='right') - 1
+    vox_labels = [np.asarray(data[vox_ijk]) for data in atlas_data]
+    
+    node_type = np.int32 if len(vox_idx) < np.iinfo(np.int32).max else np.int64
+    nodes = np.full(shape,-1,dtype=node_type)
+    nodes[vox_ijk] = np.arange(len(vox_idx),dtype=node_type)
+    levels = np.full(shape,-1,dtype=np.int16)
+    levels[vox_ijk] = vox_level
+    
+    # Edges between neighbouring voxels (one of each opposite pair of offsets), active from the lower level of their voxels
+    structure = ndimage.generate_binary_structure(3,conn_rank[connectivity])
+    offsets = [offset for offset in np.argwhere(structure) - 1 if tuple(offset) > (0,0,0)]
+    
+    edge_a = list()
+    edge_b = list()
+    edge_level = list()
+    
+    for offset in offsets:
+        src = tuple(slice(max(-d,0),dim - max(d,0)) for d,dim in zip(offset,shape))
+        dst = tuple(slice(max(d,0),dim - max(-d,0)) for d,dim in zip(offset,shape))
+        level = np.minimum(levels[src],levels[dst])
+        edge = level >= 0
+        edge_a.append(nodes[src][edge])
+        edge_b.append(nodes[dst][edge])
+        edge_level.append(level[edge])
+    
+    edge_level = np.concatenate(edge_level) if edge_level else np.empty(0,dtype=np.int16)
+    order = np.argsort(edge_level,kind='stable')
+    edge_a = np.concatenate(edge_a)[order] if len(order) else np.empty(0,dtype=node_type)
+    edge_b = np.concatenate(edge_b)[order] if len(order) else np.empty(0,dtype=node_type)
+    bounds = np.searchsorted(edge_level[order],np.arange(len(thresholds) + 1))
+    
+    del nodes,levels
+    
+    # Component of each suprathreshold voxel (voxels are added as singletons at the threshold they exceed), and the
+    # statistics of each component
+    comp = np.full(len(vox_idx),-1,dtype=node_type)
+    n_comp = 0
+    stats = {key:np.empty(0) for key in ["size","min_idx","peak_val","peak_idx","w","wi","wj","wk"]}
+    
+    # Voxels by level (highest first)
+    vox_order = np.argsort(-vox_level,kind='stable')
+    vox_bounds = len(vox_idx) - np.searchsorted(vox_level[vox_order][::-1],np.arange(len(thresholds) + 1))
+    
+    sweep = list()
+    
+    for level in range(len(thresholds) - 1,-1,-1):
+        thresh = float(thresholds[level])
+        
+        # Add the voxels that become suprathreshold at this threshold (as singletons)
+        new = vox_order[vox_bounds[level + 1]:vox_bounds[level]]
+        comp[new] = np.arange(n_comp,n_comp + len(new))
+        n_comp += len(new)
+        
+        new_stats = {"size":np.ones(len(new)),
+                     "min_idx":vox_idx[new],
+                     "peak_val":vox_val[new],
+                     "peak_idx":vox_idx[new],
+                     "w":vox_val[new]}
+        for key,ijk in zip(["wi","wj","wk"],vox_ijk):
+            new_stats[key] = vox_val[new]*ijk[new]
+        stats = {key:np.concatenate((stats[key],new_stats[key])) for key in stats}
+        
+        # Merge the components joined by the edges that become active at this threshold
+        active = vox_order[:vox_bounds[level]]
+        a = comp[edge_a[bounds[level]:bounds[level + 1]]]
+        b = comp[edge_b[bounds[level]:bounds[level + 1]]]
+        [a,b] = [a[a != b],b[a != b]]
+        
+        if len(a):
+            [n_comp,merged] = merge_components(n_comp,a,b)
+            comp[active] = merged[comp[active]]
+            stats = merge_stats(stats,merged,n_comp)
+        
+        # Enumerate clusters by size (ties ordered by first voxel, as with scipy.ndimage.label)
+        order = np.lexsort((stats["min_idx"],stats["size"]))
+        relabel = np.zeros(n_comp,dtype=np.int64)
+        relabel[order] = np.arange(1,n_comp + 1)
+        
+        peak_vox = np.column_stack(np.unravel_index(stats["peak_idx"][order].astype(np.int64),shape)) if n_comp else np.empty((0,3))
+        cog_vox = np.column_stack([stats[key][order] for key in ["wi","wj","wk"]]) if n_comp else np.empty((0,3))
+        cog_vox = cog_vox / np.where(stats["w"][order] == 0,1,stats["w"][order])[:,None]
+        
+        clust_table = make_clust_table(stats["size"][order].astype(np.int64),stats["peak_val"][order],peak_vox,cog_vox,affine)
+        
+        # Cluster x atlas label voxel counts of the suprathreshold voxels
+        clust = relabel[comp[active]]
+        overlaps = [pair_counts(clust,labels[active]) for labels in vox_labels]
+        
+        sweep.append((thresh,clust_table,overlaps))
+    
+    return sweep
+
+def load_nii_vol(nii_file,thresh=0.95,dist=0,connectivity=26,dense=True):
+    '''
+    Reads in NIFTI volume information, creates a volume of enumerated clusters, and then stores 
+    those clusters in an N x M x P array. Clusters are computed in-process (see find_clusters).
+    
+    Arguments:
+        nii_file(NIFTI file): Input NIFTI file
+        thresh(float): Minimum threshold
+        dist(float): Minimum distance between local maxima (deprecated and ignored, as it only applies to local maxima, see find_peaks. It will be removed in a future version.)
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+        dense(bool): Return the N x M x P array of the clusters, otherwise sparse clusters (see sparse_clusters)
+    Returns:
+        img_data(numpy array): N x M x P numpy array of the clusters (or sparse clusters)
+    '''
+    
+    warn_dist(dist,"load_nii_vol")
+    
+    # Load/export data as (native data type) numpy array
+    img = nib.load(nii_file)
+    
+    with mem_stage("load input"):
+        img_data = load_img_data(img)
+    
+    # Create volume clusters
+    with mem_stage("cluster"):
+        img_data = sparse_clusters(img_data.reshape(img.shape[:3],order='A'),thresh,connectivity)
+    
+    if dense:
+        img_data = dense_clusters(img_data)
+    
+    return img_data
+
+def make_label_lut(atlas_dict):
+    '''
+    Creates a label -> ROI name lookup array from an atlas dictionary, such that the ROI name of
+    some (non-negative, integer) label is found by indexing (i.e. atlas_lut[label]).
+    
+    Arguments:
+        atlas_dict(dict): Dictionary of label IDs to ROI names
+    Returns:
+        atlas_lut(numpy array): Object array of ROI names indexed by label ID. Labels absent from the atlas dictionary are None.
+    '''
+    
+    keys = [int(key) for key in atlas_dict.keys() if int(key) >= 0]
+    
+    atlas_lut = np.full(max(keys,default=-1) + 1,None,dtype=object)
+    
+    for key in keys:
+        atlas_lut[key] = atlas_dict[key]
+    
+    return atlas_lut
+
+def overlap_labels(cluster_data,atlas_data):
+    '''
+    Finds the (non-zero) atlas labels that overlap with the non-zero voxels of some cluster volume,
+    along with the number of overlapping voxels for each label. Neither input array is modified.
+    
+    Arguments:
+        cluster_data(numpy array): N x M x P numpy array of the clusters, or sparse clusters (see sparse_clusters)
+        atlas_data(numpy array): N x M x P numpy array of atlas labels
+    Returns:
+        labels(numpy array): Sorted array of the overlapped atlas labels
+        counts(numpy array): Number of overlapping voxels for each label
+    '''
+    
+    if isinstance(cluster_data,dict):
+        if tuple(cluster_data["shape"]) != tuple(atlas_data.shape):
+            raise ValueError(f"Cluster volume shape {tuple(cluster_data['shape'])} does not match atlas shape {atlas_data.shape}.")
+        
+        # Atlas labels at the clustered voxels only
+        labels = sample_voxels(atlas_data,cluster_data["index"])
+    else:
+        cluster_data = np.asarray(cluster_data)
+        atlas_data = np.asarray(atlas_data)
+        
+        if cluster_data.shape != atlas_data.shape:
+            raise ValueError(f"Cluster volume shape {cluster_data.shape} does not match atlas shape {atlas_data.shape}.")
+        
+        # Atlas labels under the cluster mask
+        labels = atlas_data[cluster_data != 0]
+    
+    # Excluding the background label
+    labels = labels[labels != 0]
+    
+    if labels.size == 0:
+        return np.empty(0,dtype=np.int64),np.empty(0,dtype=np.int64)
+    
+    # Integer labels from float volumes (e.g. get_fdata) are rounded to their nearest label ID
+    if not np.issubdtype(labels.dtype,np.integer):
+        labels = np.rint(labels).astype(np.int64)
+    
+    if labels.min() >= 0:
+        counts = np.bincount(labels)
+        labels = np.flatnonzero(counts)
+        counts = counts[labels]
+    else:
+        [labels,counts] = np.unique(labels,return_counts=True)
+    
+    return labels,counts
+
+def get_roi_name(cluster_data,atlas_data,atlas_dict,atlas_lut=None):
+    '''
+    Finds ROI names from overlapping clusters in a NIFTI volume by voxel matching.
+    
+    Arguments:
+        cluster_data(numpy array): Input numpy of data, or sparse clusters (see sparse_clusters)
+        atlas_data(numpy array): Numpy array of labeled surface vertices for some specific hemisphere
+        atlas_dict(dict): Dictionary of label IDs to ROI names
+        atlas_lut(numpy array): Optional label -> ROI name lookup array (see make_label_lut). Created from atlas_dict if not provided.
+    Returns:
+        roi_list(list): List of ROIs overlapped by cluster(s)
+    '''
+    
+    [labels,counts] = overlap_labels(cluster_data,atlas_data)
+    
+    if atlas_lut is None:
+        atlas_lut = make_label_lut(atlas_dict)
+    
+    roi_list = label_names(labels,atlas_lut)
+    
+    return roi_list
+
+def label_names(labels,atlas_lut):
+    '''
+    Looks up the ROI names of some atlas labels.
+    
+    Arguments:
+        labels(numpy array): Atlas labels
+        atlas_lut(numpy array): Label -> ROI name lookup array (see make_label_lut)
+    Returns:
+        roi_list(list): List of ROI names (one for each label)
+    '''
+    
+    labels = np.asarray(labels,dtype=np.int64)
+    
+    # Labels without a corresponding ROI name are an error (as with dictionary look-ups)
+    in_lut = (labels >= 0) & (labels < len(atlas_lut))
+    names = np.full(len(labels),None,dtype=object)
+    names[in_lut] = atlas_lut[labels[in_lut]]
+    
+    missing = [label for label,name in zip(labels.tolist(),names) if name is None]
+    
+    if missing:
+        raise KeyError(f"Atlas label(s) not found in atlas information: {missing}")
+    
+    roi_list = names.tolist()
+    
+    return roi_list
+
+def pair_counts(clusters,labels):
+    '''
+    Counts the voxels of each (cluster index, atlas label) pair (i.e. a bincount over a combined cluster, label index).
+    
+    Arguments:
+        clusters(numpy array): Cluster index of each clustered voxel
+        labels(numpy array): Atlas label of each clustered voxel
+    Returns:
+        overlap(tuple): Tuple of (cluster index, atlas label, voxel count) arrays, sorted by cluster index and then label
+    '''
+    
+    clusters = np.asarray(clusters).astype(np.int64)
+    labels = np.asarray(labels)
+    
+    if not np.issubdtype(labels.dtype,np.integer):
+        labels = np.rint(labels)
+    labels = labels.astype(np.int64)
+    
+    if clusters.size == 0:
+        return np.empty(0,dtype=np.int64),np.empty(0,dtype=np.int64),np.empty(0,dtype=np.int64)
+    
+    n_labels = int(labels.max()) + 1
+    n_bins = (int(clusters.max()) + 1)*n_labels
+    
+    if labels.min() >= 0 and n_bins <= 1 << 26:
+        counts = np.bincount(clusters*n_labels + labels,minlength=n_bins)
+        idx = np.flatnonzero(counts)
+        overlap = (idx // n_labels,idx % n_labels,counts[idx])
+    else:
+        [pairs,counts] = np.unique(np.column_stack((clusters,labels)),axis=0,return_counts=True)
+        overlap = (pairs[:,0],pairs[:,1],counts)
+    
+    return overlap
+
+def atlas_overlaps(cluster_data,atlas_data):
+    '''
+    Computes the (sparse) cluster x atlas label voxel count tables of some cluster volume for several atlases. The
+    clustered voxels are found once, and each atlas is only sampled at those voxels.
+    
+    Arguments:
+        cluster_data(numpy array): N x M x P numpy array of enumerated clusters, or sparse clusters (see sparse_clusters)
+        atlas_data(list): List of N x M x P numpy arrays of atlas labels
+    Returns:
+        overlaps(list): List of (cluster index, atlas label, voxel count) array tuples (see pair_counts), one for each atlas
+    '''
+    
+    if isinstance(cluster_data,dict):
+        shape = tuple(cluster_data["shape"])
+    else:
+        cluster_data = np.asarray(cluster_data)
+        shape = cluster_data.shape
+    
+    for data in atlas_data:
+        if shape != tuple(data.shape):
+            raise ValueError(f"Cluster volume shape {shape} does not match atlas shape {data.shape}.")
+    
+    # Clustered voxels (shared by all atlases)
+    if isinstance(cluster_data,dict):
+        index = cluster_data["index"]
+        clusters = cluster_ids(cluster_data)
+        overlaps = [pair_counts(clusters,sample_voxels(data,index)) for data in atlas_data]
+    else:
+        vox = np.nonzero(cluster_data)
+        clusters = cluster_data[vox]
+        overlaps = [pair_counts(clusters,np.asarray(data[vox])) for data in atlas_data]
+    
+    return overlaps
+
+def cluster_overlap(cluster_data,atlas_data):
+    '''
+    Computes the (sparse) cluster x atlas label voxel count table of some cluster volume in a single pass over
+    the clustered voxels (i.e. a bincount over a combined cluster, label index).
+    
+    Arguments:
+        cluster_data(numpy array): N x M x P numpy array of enumerated clusters, or sparse clusters (see sparse_clusters)
+        atlas_data(numpy array): N x M x P numpy array of atlas labels
+    Returns:
+        overlap(tuple): Tuple of (cluster index, atlas label, voxel count) arrays, sorted by cluster index and then label
+    '''
+    
+    overlap = atlas_overlaps(cluster_data,[atlas_data])[0]
+    
+    return overlap
+
+def label_sizes(atlas_data):
+    '''
+    Counts the number of voxels of each (non-negative) atlas label.
+    
+    Arguments:
+        atlas_data(numpy array): Atlas labels
+    Returns:
+        roi_sizes(numpy array): Number of voxels of each label (indexed by label)
+    '''
+    
+    labels = np.asarray(atlas_data)
+    
+    if not np.issubdtype(labels.dtype,np.integer):
+        labels = np.rint(labels).astype(np.int64)
+    
+    roi_sizes = np.bincount(labels[labels > 0].astype(np.int64),minlength=1)
+    
+    return roi_sizes
+
+def overlap_table(overlap,clust_table,atlas_lut,roi_sizes=None,nearest=None):
+    '''
+    Constructs the (long format) cluster x ROI table from some cluster x atlas label voxel count table, with the size and
+    peak of each cluster, the percentage of the cluster in each ROI, and the percentage of each ROI covered by the cluster.
+    Unlabelled (label 0) voxels are excluded.
+    
+    Arguments:
+        overlap(tuple): Tuple of (cluster index, atlas label, voxel count) arrays (see cluster_overlap)
+        clust_table(DataFrame): Cluster table with FSL `cluster` style columns (see find_clusters)
+        atlas_lut(numpy array): Label -> ROI name lookup array (see make_label_lut)
+        roi_sizes(numpy array): Number of voxels of each label (see label_sizes). The '% ROI' column is empty if not provided.
+        nearest(tuple): Tuple of (cluster index, nearest label, distance) arrays of clusters with unlabelled peaks (see nearest_peaks).
+                        If provided, a row (without overlapping voxels) is added for the nearest ROI of each of these clusters,
+                        along with a 'Distance (mm)' column (empty for overlapping ROIs).
+    Returns:
+        table(DataFrame): Cluster x ROI table, with one row for each overlapping cluster and ROI (largest clusters first)
+    '''
+    
+    [clusters,labels,counts] = [np.asarray(arr,dtype=np.int64) for arr in overlap]
+    
+    keep = labels != 0
+    [clusters,labels,counts] = [clusters[keep],labels[keep],counts[keep]]
+    
+    if nearest is not None:
+        near = [np.asarray(nearest[0],dtype=np.int64),np.asarray(nearest[1],dtype=np.int64)]
+        dists = np.concatenate((np.full(len(clusters),np.nan),np.asarray(nearest[2],dtype=np.float64)))
+        [clusters,labels,counts] = [np.concatenate((clusters,near[0])),np.concatenate((labels,near[1])),np.concatenate((counts,np.zeros(len(near[0]),dtype=np.int64)))]
+    
+    peak_cols = [col for col in clust_table.columns if col.startswith("MAX")]
+    clusters_df = clust_table.set_index("Cluster Index").loc[clusters]
+    
+    table = pd.DataFrame({"Cluster Index":clusters,
+                          "Cluster Voxels":clusters_df["Voxels"].values})
+    for col in peak_cols:
+        table[col] = clusters_df[col].values
+    
+    table["Label"] = labels
+    table["ROI"] = label_names(labels,atlas_lut)
+    table["Voxels"] = counts
+    table["% Cluster"] = 100*counts/table["Cluster Voxels"].values
+    
+    if roi_sizes is not None:
+        in_sizes = labels < len(roi_sizes)
+        sizes = np.where(in_sizes,roi_sizes[np.where(in_sizes,labels,0)],0)
+        table["% ROI"] = 100*counts/np.where(sizes == 0,np.nan,sizes)
+    else:
+        table["% ROI"] = np.nan
+    
+    if nearest is not None:
+        table["Distance (mm)"] = dists
+    
+    table = table.sort_values(["Cluster Index","Voxels","Label"],ascending=[False,False,True],kind="stable").reset_index(drop=True)
+    
+    return table
+
+def peak_table(clust_table,roi_lists):
+    '''
+    Constructs the (long format) cluster x ROI table of some FSL atlas from the ROIs at each cluster peak (see
+    peak_roi_lists), with the same columns as overlap_table. Voxel counts and percentages are empty.
+    
+    Arguments:
+        clust_table(DataFrame): Cluster table with FSL `cluster` style columns (see find_clusters)
+        roi_lists(list): List of ROI lists, one for each cluster (in the order of the cluster table)
+    Returns:
+        table(DataFrame): Cluster x ROI table, with one row for each cluster and peak ROI (largest clusters first)
+    '''
+    
+    idx = [i for i,rois in enumerate(roi_lists) for _ in rois]
+    peak_cols = [col for col in clust_table.columns if col.startswith("MAX")]
+    
+    table = clust_table.iloc[idx][["Cluster Index","Voxels"] + peak_cols].rename(columns={"Voxels":"Cluster Voxels"}).reset_index(drop=True)
+    
+    table["Label"] = pd.array([None]*len(idx),dtype="Int64")
+    table["ROI"] = [roi for rois in roi_lists for roi in rois]
+    table["Voxels"] = pd.array([None]*len(idx),dtype="Int64")
+    table["% Cluster"] = np.nan
+    table["% ROI"] = np.nan
+    
+    return table
+
+def write_table(file,table_file,table,volume=None,thresh=None):
+    '''
+    Writes (appends) some cluster x ROI table (see overlap_table) to a tab separated, long format file, with the input
+    file (and volume index) added to each row.
+    
+    Arguments:
+        file (file): Input NIFTI file
+        table_file (file): Output TSV file name and path. This file need not exist at runtime.
+        table (DataFrame): Cluster x ROI table
+        volume(int): Volume index (for 4D input files)
+        thresh(float): Threshold (for threshold sweeps). A 'Threshold' column is added if provided.
+    Returns:
+        table_file (file): Output TSV file name and path.
+    '''
+    
+    table = table.copy()
+    if thresh is not None:
+        table.insert(0,"Threshold",thresh)
+    table.insert(0,"Volume","" if volume is None else volume)
+    table.insert(0,"File",os.path.abspath(file))
+    
+    if os.path.exists(table_file):
+        table.to_csv(table_file, sep="\t", header=False, index=False, mode='a')
+    else:
+        table.to_csv(table_file, sep="\t", header=True, index=False, mode='w')
+    
+    return table_file
+
+def atlas_table(atlases,roi_tables):
+    '''
+    Combines the cluster x ROI tables of several atlases into a single table. An 'Atlas' column is added if
+    more than one atlas is used.
+    
+    Arguments:
+        atlases(list): List of loaded atlases (see load_atlases)
+        roi_tables(list): List of cluster x ROI tables (None if not computed), one for each atlas
+    Returns:
+        table(DataFrame): Combined cluster x ROI table (None if no tables were computed)
+    '''
+    
+    tables = [(atlas["name"],roi_table) for atlas,roi_table in zip(atlases,roi_tables) if roi_table is not None]
+    
+    if len(tables) == 0:
+        return None
+    elif len(tables) == 1:
+        return tables[0][1]
+    
+    table = pd.concat([roi_table.assign(Atlas=name) for name,roi_table in tables],ignore_index=True)
+    table = table[["Atlas"] + [col for col in table.columns if col != "Atlas"]]
+    
+    return table
+
+def write_spread(file,out_file,roi_list,volume=None,thresh=None):
+    '''
+    Writes the contents or roi_list to a spreadsheet (i.e. appends a row to some CSV results store, see CsvStore).
+    
+    Arguments:
+        file (file): Input CIFTI file
+        out_file (file): Output csv file name and path. This file need not exist at runtime.
+        roi_list(list): List of ROIs to write to file, or a dictionary of atlas names to ROI lists (one column per atlas)
+        volume(int): Volume index (for 4D input files)
+        thresh(float): Threshold
+    Returns: 
+        out_file (csv file): Output csv file name and path.
+    '''
+    
+    if not isinstance(roi_list,dict):
+        roi_list = {"ROIs":roi_list}
+    
+    # Write output CSV file (through the results store, such that the row is journaled)
+    store = CsvStore(out_file,list(roi_list),{"thresh":thresh})
+    
+    try:
+        store.write([(file,volume,list(roi_list.values()),"")])
+    finally:
+        store.close()
+    
+    return store.out_file
+
+def write_batch_spread(results,store,table_file="",fingerprints=None):
+    '''
+    Writes batch results to some results store as they arrive (see store_backends). This is the single writer for all
+    batch workers, such that results are never interleaved. Every input file (or volume of 4D input files) is written
+    (including files without any overlapping ROIs), along with any error (empty for successfully processed files).
+    
+    Arguments:
+        results (iterable): Iterable of (rows, tables, records) tuples (i.e. one per input file), where rows is a list of
+                            (file, volume, roi_lists, error) rows (with one ROI list per atlas), tables is a list
+                            of (volume, cluster x ROI table) tuples, and records is a list of profile records (see mem_stage).
+        store (CsvStore): Results store (CsvStore, SqliteStore or ParquetStore)
+        table_file (file): Output (long format) cluster x ROI table TSV file. Tables are not written if not provided.
+        fingerprints (dict): Dictionary of input files to their fingerprints (see input_fingerprint)
+    Returns:
+        n_failed (int): Number of files that failed to process
+    '''
+    
+    n_failed = 0
+    
+    for rows,tables,records in results:
+        prof_stats.extend(records)
+        for volume,roi_table in tables:
+            if table_file and roi_table is not None and len(roi_table) != 0:
+                write_table(rows[0][0],table_file,roi_table,volume)
+        store.write(rows,tables,(fingerprints or {}).get(rows[0][0],""))
+        if any(error for _,_,_,error in rows):
+            n_failed += 1
+    
+    return n_failed
+
+def img_volumes(img):
+    '''
+    Determines the number of volumes of some 4D NIFTI image.
+    
+    Arguments:
+        img(Nifti1Image): Input NIFTI image
+    Returns:
+        n_vols(int): Number of volumes, or None for 3D images (including 4D images with a single volume)
+    '''
+    
+    if len(img.shape) <= 3 or int(np.prod(img.shape[3:])) == 1:
+        return None
+    
+    if len(img.shape) > 4:
+        raise ValueError(f"Input images must be 3D or 4D: image has shape {img.shape}.")
+    
+    return img.shape[3]
+
+def grid_affine(img):
+    '''
+    Returns the voxel to mm affine of some NIFTI image, unless its header has neither a valid sform nor qform (i.e.
+    its affine is only a guess from the voxel sizes).
+    
+    Arguments:
+        img(Nifti1Image): Input NIFTI image
+    Returns:
+        affine(numpy array): 4 x 4 voxel to mm affine (None if the header has no valid affine)
+    '''
+    
+    header = img.header
+    
+    if "sform_code" in header and int(header["sform_code"]) == 0 and int(header["qform_code"]) == 0:
+        return None
+    
+    return img.affine
+
+@functools.lru_cache(maxsize=4)
+def grid_map(shape,affine,atlas_shape,atlas_affine):
+    '''
+    Computes the nearest neighbour mapping of the voxels of some (input) grid to the voxels of some atlas grid, from the
+    voxel to mm affines of both grids. Mappings are cached by grid, such that inputs that share a grid reuse them.
+    
+    Arguments:
+        shape(tuple): Input grid shape
+        affine(tuple): Input grid 4 x 4 voxel to mm affine (as a tuple of rows)
+        atlas_shape(tuple): Atlas grid shape
+        atlas_affine(tuple): Atlas grid 4 x 4 voxel to mm affine (as a tuple of rows)
+    Returns:
+        mapping(numpy array): Input grid shaped (read-only) array of the flat (C order) atlas voxel index of each
+                              input voxel (-1 for voxels outside the atlas grid)
+    '''
+    
+    # Input voxel -> atlas voxel affine
+    vox2vox = np.linalg.inv(np.array(atlas_affine)) @ np.array(affine)
+    
+    index_type = np.int32 if int(np.prod(atlas_shape)) < np.iinfo(np.int32).max else np.int64
+    mapping = np.empty(shape,dtype=index_type)
+    
+    # Atlas voxel coordinates of the first input plane (j, k), shifted along i for each plane
+    [j,k] = np.meshgrid(np.arange(shape[1]),np.arange(shape[2]),indexing='ij')
+    plane = vox2vox[:3,1,None,None]*j + vox2vox[:3,2,None,None]*k + vox2vox[:3,3,None,None]
+    
+    for i in range(shape[0]):
+        ijk = np.floor(plane + vox2vox[:3,0,None,None]*i + 0.5).astype(np.int64)
+        inside = np.logical_and.reduce([(ijk[d] >= 0) & (ijk[d] < atlas_shape[d]) for d in range(3)])
+        mapping[i] = np.where(inside,np.ravel_multi_index(tuple(np.clip(ijk[d],0,atlas_shape[d] - 1) for d in range(3)),atlas_shape),-1)
+    
+    mapping.setflags(write=False)
+    
+    return mapping
+
+def match_atlas_grid(atlas,shape,affine):
+    '''
+    Maps the labels of some (loaded) stand-alone atlas onto the voxel grid of some input (nearest neighbour, see
+    grid_map), unless both already share a grid. Input voxels outside the atlas grid are unlabelled (0).
+    
+    Arguments:
+        atlas(dict): Loaded atlas (see load_atlases)
+        shape(tuple): Input grid shape
+        affine(numpy array): Input grid 4 x 4 voxel to mm affine (None if unknown, see grid_affine)
+    Returns:
+        atlas(dict): Atlas in the input grid (the atlas itself if both share a grid), with its labels ('data'), label
+                     voxel counts ('sizes', if counted) and 'affine' in the input grid
+    '''
+    
+    shape = tuple(shape[:3])
+    
+    if atlas.get("data") is None or atlas.get("affine") is None:
+        return atlas
+    
+    atlas_shape = tuple(atlas["data"].shape[:3])
+    
+    if affine is None:
+        # Inputs without a valid affine can only be matched by shape
+        if shape == atlas_shape:
+            return atlas
+        raise ValueError(f"The input has no valid (sform or qform) affine, and its shape {shape} does not match atlas '{atlas['name']}' shape {atlas_shape}.")
+    
+    if shape == atlas_shape and np.allclose(affine,atlas["affine"],atol=1e-3):
+        return atlas
+    
+    mapping = grid_map(shape,tuple(map(tuple,np.round(affine,6))),atlas_shape,tuple(map(tuple,np.round(atlas["affine"],6))))
+    
+    if not (mapping >= 0).any():
+        raise ValueError(f"The input grid does not overlap the grid of atlas '{atlas['name']}'.")
+    
+    with mem_stage("resample atlas"):
+        labels = np.asarray(atlas["data"]).reshape(-1)
+        data = np.where(mapping >= 0,labels[np.maximum(mapping,0)],0).astype(labels.dtype)
+    
+    return dict(atlas,data=data,affine=affine,sizes=label_sizes(data) if atlas.get("sizes") is not None else None)
+
+def cluster_memberships(clusters,probs,mapping=None):
+    '''
+    Computes the mean and maximum membership probability of each region of some probabilistic atlas across all voxels of
+    each (sparse) cluster. The atlas is sampled once at all clustered voxels (a single voxels x regions gather, in
+    ascending atlas voxel order, such that memory-mapped atlases are read sequentially), and reduced per cluster.
+    Clustered voxels outside the atlas have a probability of 0.
+    
+    Arguments:
+        clusters(dict): Sparse clusters (see sparse_clusters)
+        probs(numpy array): Voxels x regions array of atlas probabilities (see load_prob_atlas)
+        mapping(numpy array): Input grid shaped array of the flat atlas voxel index of each input voxel (see grid_map).
+                              Both grids are assumed to be the same if not provided.
+    Returns:
+        mean(numpy array): K x R array of the mean probability of each region (column) in each cluster (row i - 1 for cluster index i)
+        peak(numpy array): K x R array of the maximum probability of each region in each cluster
+    '''
+    
+    offsets = np.asarray(clusters["offsets"],dtype=np.int64)
+    index = np.asarray(clusters["index"],dtype=np.int64)
+    n_regions = probs.shape[1]
+    
+    if len(offsets) < 2:
+        return np.zeros((0,n_regions)),np.zeros((0,n_regions))
+    
+    if mapping is not None:
+        index = np.asarray(mapping).reshape(-1)[index].astype(np.int64)
+    
+    # Each atlas voxel is read once
+    inside = index >= 0
+    [uniq,inverse] = np.unique(index[inside],return_inverse=True)
+    
+    values = np.zeros((len(index),n_regions),dtype=probs.dtype)
+    values[inside] = np.asarray(probs[uniq])[inverse.reshape(-1)]
+    
+    sizes = np.diff(offsets)
+    mean = np.add.reduceat(values,offsets[:-1],axis=0,dtype=np.float64)/sizes[:,None]
+    peak = np.maximum.reduceat(values,offsets[:-1],axis=0).astype(np.float64)
+    
+    return mean,peak
+
+def atlas_memberships(clusters,affine,atlases):
+    '''
+    Computes the cluster memberships (see cluster_memberships) of every probabilistic atlas loaded with a cutoff (see
+    load_atlases). Clusters are mapped onto the grid of each atlas (nearest neighbour, see grid_map) as required.
+    
+    Arguments:
+        clusters(dict): Sparse clusters (see sparse_clusters)
+        affine(numpy array): Input grid 4 x 4 voxel to mm affine
+        atlases(list): List of loaded atlases (see load_atlases)
+    Returns:
+        memberships(list): List of (mean, peak) array tuples, one for each probabilistic atlas (in order)
+    '''
+    
+    shape = tuple(int(dim) for dim in clusters["shape"])
+    memberships = list()
+    
+    for atlas in atlases:
+        if atlas.get("probs") is None:
+            continue
+        
+        mapping = None
+        if shape != tuple(atlas["prob_shape"]) or not np.allclose(affine,atlas["prob_affine"],atol=1e-3):
+            mapping = grid_map(shape,tuple(map(tuple,np.round(affine,6))),tuple(atlas["prob_shape"]),tuple(map(tuple,np.round(atlas["prob_affine"],6))))
+        
+        memberships.append(cluster_memberships(clusters,atlas["probs"],mapping))
+    
+    return memberships
+
+def membership_table(clust_table,membership,labels,cutoff=0):
+    '''
+    Constructs the (long format) cluster x ROI table of some probabilistic atlas from the cluster memberships (see
+    cluster_memberships), with the same columns as overlap_table (label, ROI, and empty voxel counts and percentages),
+    and the 'Mean Probability' and 'Max Probability' (%) of each ROI in each cluster. ROIs are reported if their mean
+    probability is at least the cutoff (and above 0).
+    
+    Arguments:
+        clust_table(DataFrame): Cluster table with FSL `cluster` style columns (see find_clusters)
+        membership(tuple): Tuple of (mean, peak) K x R probability arrays (see cluster_memberships)
+        labels(dict): Dictionary of region (volume) indices to ROI names
+        cutoff(float): Minimum mean probability (%)
+    Returns:
+        table(DataFrame): Cluster x ROI table, with one row for each cluster and ROI above the cutoff (largest clusters
+                          first, most probable ROIs first). Labels are the region index + 1 (as in FSL's maximum probability images).
+    '''
+    
+    [mean,peak] = membership
+    [rows,regions] = np.nonzero((mean >= cutoff) & (mean > 0))
+    
+    peak_cols = [col for col in clust_table.columns if col.startswith("MAX")]
+    clusters_df = clust_table.set_index("Cluster Index").loc[rows + 1]
+    
+    table = pd.DataFrame({"Cluster Index":rows + 1,
+                          "Cluster Voxels":clusters_df["Voxels"].values})
+    for col in peak_cols:
+        table[col] = clusters_df[col].values
+    
+    table["Label"] = regions + 1
+    table["ROI"] = [labels.get(int(region),"") for region in regions]
+    table["Voxels"] = pd.array([None]*len(rows),dtype="Int64")
+    table["% Cluster"] = np.nan
+    table["% ROI"] = np.nan
+    table["Mean Probability"] = mean[rows,regions]
+    table["Max Probability"] = peak[rows,regions]
+    
+    table = table.sort_values(["Cluster Index","Mean Probability","Label"],ascending=[False,False,True],kind="stable").reset_index(drop=True)
+    
+    return table
+
+def nearest_peaks(clust_table,index):
+    '''
+    Finds the nearest labelled region (see AtlasIndex) of the cluster peaks that are unlabelled (label 0) in some stand-alone atlas.
+    
+    Arguments:
+        clust_table(DataFrame): Cluster table with FSL `cluster` style (mm) columns (see find_clusters)
+        index(AtlasIndex): Atlas spatial index
+    Returns:
+        nearest(tuple): Tuple of (cluster index, nearest label, distance) arrays of the clusters with unlabelled peaks
+    '''
+    
+    peaks = clust_table[['MAX X (mm)','MAX Y (mm)','MAX Z (mm)']].values
+    
+    [labels,dists] = index.region(peaks)
+    unlabelled = (dists > 0) & np.isfinite(dists)
+    
+    nearest = (clust_table["Cluster Index"].values[unlabelled],labels[unlabelled],dists[unlabelled])
+    
+    return nearest
+
+def nearest_names(nearest,atlas_lut,roi_list=None):
+    '''
+    Names the nearest labelled ROIs of the clusters with unlabelled peaks (see nearest_peaks), along with their (shortest)
+    distance, e.g. 'Precentral_L (nearest, 4.5 mm)', such that these clusters are also reported in ROI lists.
+    
+    Arguments:
+        nearest(tuple): Tuple of (cluster index, nearest label, distance) arrays of the clusters with unlabelled peaks
+        atlas_lut(numpy array): Label -> ROI name lookup array (see make_label_lut)
+        roi_list(list): ROIs that are already reported (i.e. overlapped by some cluster), which are not named again
+    Returns:
+        names(list): Nearest ROI names (and distances), in label order
+    '''
+    
+    labels = np.asarray(nearest[1],dtype=np.int64)
+    dists = np.asarray(nearest[2],dtype=np.float64)
+    
+    # Shortest distance of each nearest label
+    order = np.lexsort((dists,labels))
+    [labels,first] = np.unique(labels[order],return_index=True)
+    dists = dists[order][first]
+    
+    names = [f"{name} (nearest, {dist:.1f} mm)" for name,dist in zip(label_names(labels,atlas_lut),dists) if name not in (roi_list or [])]
+    
+    return names
+
+def resolve_atlases(clust_table,atlases,overlaps,table=False,memberships=None):
+    '''
+    Identifies the ROIs of several (FSL and/or stand-alone) atlases that have overlap with the same clusters.
+    Stand-alone atlases are resolved from their cluster x atlas label voxel counts, probabilistic atlases loaded with a
+    cutoff from their cluster memberships (if provided), and other FSL atlases from the cluster peaks.
+    
+    Arguments:
+        clust_table(DataFrame): Cluster table with FSL `cluster` style columns (see find_clusters)
+        atlases(list): List of loaded atlases (see load_atlases)
+        overlaps(list): List of (cluster index, atlas label, voxel count) array tuples, one for each stand-alone atlas (in order)
+        table(bool): Also compute the cluster x ROI tables (see overlap_table and peak_table)
+        memberships(list): List of (mean, peak) probability array tuples, one for each probabilistic atlas loaded with a
+                           cutoff (see atlas_memberships). These atlases are resolved at the cluster peaks if not provided.
+    Returns:
+        roi_lists(list): List of ROI lists, one for each atlas
+        roi_tables(list): List of cluster x ROI tables (None if not computed), one for each atlas
+    '''
+    
+    overlaps = iter(overlaps)
+    memberships = iter(memberships) if memberships is not None else None
+    roi_lists = list()
+    roi_tables = list()
+    
+    for atlas in atlases:
+        roi_table = None
+        
+        if atlas.get("data") is not None:
+            overlap = next(overlaps)
+            labels = np.unique(overlap[1])
+            roi_list = label_names(labels[labels != 0],atlas["lut"])
+            nearest = nearest_peaks(clust_table,atlas["index"]) if atlas.get("nearest") else None
+            if nearest is not None:
+                roi_list = roi_list + nearest_names(nearest,atlas["lut"],roi_list)
+            if table:
+                roi_table = overlap_table(overlap,clust_table,atlas["lut"],atlas.get("sizes"),nearest)
+        elif atlas.get("probs") is not None and memberships is not None:
+            membership = next(memberships)
+            regions = np.flatnonzero(((membership[0] >= atlas["cutoff"]) & (membership[0] > 0)).any(axis=0))
+            roi_list = [atlas["labels"].get(int(region),"") for region in regions]
+            if table:
+                roi_table = membership_table(clust_table,membership,atlas["labels"],atlas["cutoff"])
+        else:
+            peak_lists = peak_roi_lists(clust_table,atlas["num"])
+            roi_list = [roi for rois in peak_lists for roi in rois]
+            if table:
+                roi_table = peak_table(clust_table,peak_lists)
+        
+        roi_lists.append(roi_list)
+        roi_tables.append(roi_table)
+    
+    return roi_lists,roi_tables
+
+def cluster_atlas_rois(img_data,affine,atlases,thresh=0.95,connectivity=26,table=False,clusters=None):
+    '''
+    Identifies ROIs of several (FSL and/or stand-alone) atlases that have overlap with some cluster(s) of a (loaded)
+    3D volume. The volume is clustered once (sparsely), and all stand-alone atlases are sampled at the same clustered voxels.
+    
+    Arguments:
+        img_data(numpy array): N x M x P numpy array of (statistical) image data
+        affine(numpy array): 4 x 4 voxel to mm affine
+        atlases(list): List of loaded atlases (see load_atlases)
+        thresh(float): Threshold values below this value
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+        table(bool): Also compute the cluster x ROI tables (see overlap_table and peak_table)
+        clusters(dict): Sparse clusters of the volume (see sparse_clusters), e.g. from the cluster cache. If provided, the
+                        volume is not clustered again (and img_data is not used).
+    Returns:
+        roi_lists(list): List of ROI lists, one for each atlas
+        roi_tables(list): List of cluster x ROI tables (None if not computed), one for each atlas
+    '''
+    
+    if clusters is None:
+        with mem_stage("cluster"):
+            clusters = sparse_clusters(img_data,thresh,connectivity)
+    
+    clust_table = sparse_table(clusters,affine)
+    
+    # Identify cluster and ROI overlaps (cluster x label counts, and cluster x region probabilities)
+    with mem_stage("overlap"):
+        overlaps = atlas_overlaps(clusters,[atlas["data"] for atlas in atlases if atlas.get("data") is not None])
+        memberships = atlas_memberships(clusters,affine,atlases)
+        [roi_lists,roi_tables] = resolve_atlases(clust_table,atlases,overlaps,table,memberships)
+    
+    return roi_lists,roi_tables
+
+def cluster_rois(img_data,affine,thresh=0.95,vol_atlas_num=3,atlas_data=None,atlas_lut=None,connectivity=26,roi_sizes=None,table=False):
+    '''
+    Identifies ROIs that have overlap with some cluster(s) of a (loaded) 3D volume, using either a stand-alone
+    atlas or some FSL atlas. See cluster_atlas_rois for several atlases.
+    
+    Arguments:
+        img_data(numpy array): N x M x P numpy array of (statistical) image data
+        affine(numpy array): 4 x 4 voxel to mm affine
+        thresh(float): Threshold values below this value
+        vol_atlas_num(int): Atlas to be used in FSL's `atlasquery` (if no stand-alone atlas is provided).
+        atlas_data(numpy array): Stand-alone atlas data (see load_atlas_data)
+        atlas_lut(numpy array): Stand-alone atlas label -> ROI name lookup array (see make_label_lut)
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+        roi_sizes(numpy array): Number of voxels of each stand-alone atlas label (see label_sizes)
+        table(bool): Also compute the cluster x ROI table (see overlap_table and peak_table)
+    Returns:
+        roi_list(list): List of ROIs overlapped by cluster(s)
+        roi_table(DataFrame): Cluster x ROI table (None if not computed)
+    '''
+    
+    if atlas_data is not None:
+        atlases = [{"data":atlas_data,"lut":atlas_lut,"sizes":roi_sizes}]
+    else:
+        atlases = [{"num":vol_atlas_num}]
+    
+    [roi_lists,roi_tables] = cluster_atlas_rois(img_data,affine,atlases,thresh,connectivity,table)
+    
+    return roi_lists[0],roi_tables[0]
+
+def read_input(nii_file,thresh=0.95,connectivity=26,slab=0,use_cache=False):
+    '''
+    Reads some (3D or 4D) input NIFTI file ahead of clustering: the header, the cached (sparse) clusters of each volume
+    and, unless every volume is cached (or the input is streamed), the image data. This is the I/O (and decode) stage
+    of get_file_atlas_rois, such that it may run ahead of the clustering of other inputs (see BatchPipeline).
+    
+    Arguments:
+        nii_file(NIFTI file): Input NIFTI volume file (or loaded NIFTI image)
+        thresh(float): Threshold values below this value
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+        slab(int): Number of z-slices per slab if the input is streamed (see stream_clusters), or 0 to load the whole input into memory
+        use_cache(bool): Read the cluster cache (see load_clusters)
+    Returns:
+        prefetched(dict): Dictionary of the input image ("img"), its volumes ("volumes", None for 3D input files),
+                          cluster cache keys ("keys"), cached clusters ("cached", None if not cached) and
+                          image data ("data", None if not read)
+    '''
+    
+    img = nib.load(nii_file) if isinstance(nii_file,(str,os.PathLike)) else nii_file
+    n_vols = img_volumes(img)
+    
+    volumes = [None] if n_vols is None else list(range(n_vols))
+    
+    # Cached (sparse) clusters of each volume
+    keys = cluster_cache_keys(nii_file,volumes,thresh,connectivity) if use_cache else {}
+    cached = {volume:load_clusters(key) for volume,key in keys.items()}
+    
+    # Read NIFTI data once (unless every volume is cached, or the input is streamed)
+    img_data = None
+    
+    if not slab and any(cached.get(volume) is None for volume in volumes):
+        with mem_stage("load input"):
+            img_data = load_img_data(img)
+        
+        if n_vols is None:
+            img_data = img_data.reshape(img.shape[:3],order='A')
+    
+    return {"img":img, "volumes":volumes, "keys":keys, "cached":cached, "data":img_data}
+
+def get_file_atlas_rois(nii_file,atlases,thresh=0.95,connectivity=26,slab=0,table=False,use_cache=False,prefetched=None):
+    '''
+    Identifies ROIs of several (FSL and/or stand-alone) atlases that have overlap with some cluster(s) from the input
+    (3D or 4D) NIFTI file. Each volume is clustered once (in memory, or streamed), and every atlas is resolved against
+    the same clusters. Nothing is written to file (other than the cluster cache).
+    
+    Arguments:
+        nii_file(NIFTI file): Input NIFTI volume file
+        atlases(list): List of loaded atlases (see load_atlases)
+        thresh(float): Threshold values below this value
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+        slab(int): Number of z-slices per slab if the input is streamed (see stream_clusters), or 0 to load the whole input into memory
+        table(bool): Also compute the cluster x ROI tables (see overlap_table and peak_table)
+        use_cache(bool): Read from/write to the cluster cache, such that the (sparse) clusters of an unchanged input file
+                         are read from the cache rather than decoded and clustered again (see load_clusters)
+        prefetched(dict): Input file that was already read (see read_input). The input file is read if not provided.
+    Returns:
+        vol_rois(list): List of (volume index, ROI lists, cluster x ROI tables) tuples, with one ROI list and table for
+                        each atlas. The volume index is None for 3D input files, and tables are None if not computed.
+    '''
+    
+    if prefetched is None:
+        prefetched = read_input(nii_file,thresh,connectivity,slab,use_cache)
+    
+    img = prefetched["img"]
+    [volumes,keys,cached,img_data] = [prefetched[key] for key in ["volumes","keys","cached","data"]]
+    
+    # Stand-alone atlases in the input grid
+    atlases = [match_atlas_grid(atlas,img.shape,grid_affine(img)) for atlas in atlases]
+    atlas_data = [atlas["data"] for atlas in atlases if atlas.get("data") is not None]
+    
+    if table:
+        atlases = [dict(atlas,sizes=label_sizes(atlas["data"])) if atlas.get("data") is not None and atlas.get("sizes") is None else atlas for atlas in atlases]
+    
+    vol_rois = list()
+    
+    if slab:
+        # Stream each (uncached) volume, accumulating cluster x atlas label counts of every atlas
+        for volume in volumes:
+            if cached.get(volume) is not None:
+                [roi_lists,roi_tables] = cluster_atlas_rois(None,img.affine,atlases,thresh,connectivity,table,cached[volume])
+            else:
+                [clust_table,overlaps] = stream_clusters(nii_file,thresh,connectivity,slab,atlas_data,img.affine,volume)
+                [roi_lists,roi_tables] = resolve_atlases(clust_table,atlases,overlaps,table)
+            vol_rois.append((volume,roi_lists,roi_tables))
+    else:
+        for volume in volumes:
+            clusters = cached.get(volume)
+            
+            if clusters is None:
+                vol_data = img_data if volume is None else img_data[...,volume]
+                with mem_stage("cluster"):
+                    clusters = sparse_clusters(vol_data,thresh,connectivity)
+                if use_cache:
+                    save_clusters(keys[volume],clusters)
+            
+            [roi_lists,roi_tables] = cluster_atlas_rois(None,img.affine,atlases,thresh,connectivity,table,clusters)
+            vol_rois.append((volume,roi_lists,roi_tables))
+    
+    return vol_rois
+
+def get_file_peaks(nii_file,thresh=0.95,dist=0,connectivity=26,use_cache=False,prefetched=None):
+    '''
+    Finds the local maxima (see find_peaks) of the clusters of each volume of some input (3D or 4D) NIFTI file. Cached
+    clusters (see load_clusters) are reused, and the input is read (once) unless it was already read. Nothing is written to file.
+    
+    Arguments:
+        nii_file(NIFTI file): Input NIFTI volume file
+        thresh(float): Threshold values below this value
+        dist(float): Minimum distance (in mm) between the local maxima of a cluster
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+        use_cache(bool): Read the cluster cache (see load_clusters)
+        prefetched(dict): Input file that was already read (see read_input). The input file is read if not provided.
+    Returns:
+        vol_peaks(list): List of (volume index, local maxima table) tuples. The volume index is None for 3D input files.
+    '''
+    
+    if prefetched is None:
+        prefetched = read_input(nii_file,thresh,connectivity,0,use_cache)
+    
+    img = prefetched["img"]
+    img_data = prefetched["data"]
+    
+    # Local maxima are found in the image data (which is not read if every volume is cached, or if the input is streamed)
+    if img_data is None:
+        with mem_stage("load input"):
+            img_data = load_img_data(img)
+        
+        if prefetched["volumes"] == [None]:
+            img_data = img_data.reshape(img.shape[:3],order='A')
+    
+    vol_peaks = list()
+    
+    for volume in prefetched["volumes"]:
+        vol_data = img_data if volume is None else img_data[...,volume]
+        
+        clusters = prefetched["cached"].get(volume)
+        if clusters is None and volume in prefetched["keys"]:
+            clusters = load_clusters(prefetched["keys"][volume])
+        if clusters is None:
+            with mem_stage("cluster"):
+                clusters = sparse_clusters(vol_data,thresh,connectivity)
+        
+        with mem_stage("peaks"):
+            vol_peaks.append((volume,find_peaks(vol_data,clusters,img.affine,dist)))
+    
+    return vol_peaks
+
+def get_file_sweep_rois(nii_file,atlases,thresholds,connectivity=26,table=False):
+    '''
+    Identifies ROIs of several (FSL and/or stand-alone) atlases that have overlap with some cluster(s) from the input
+    (3D or 4D) NIFTI file at several thresholds. Each volume is read and sorted once, and the clusters of every
+    threshold are grown from the clusters of the threshold above it (see sweep_clusters). Nothing is written to file.
+    
+    Arguments:
+        nii_file(NIFTI file): Input NIFTI volume file
+        atlases(list): List of loaded atlases (see load_atlases)
+        thresholds(list): List of thresholds
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+        table(bool): Also compute the cluster x ROI tables (see overlap_table and peak_table)
+    Returns:
+        vol_rois(list): List of (volume index, threshold, ROI lists, cluster x ROI tables) tuples (in ascending order of
+                        threshold for each volume), with one ROI list and table for each atlas. The volume index is None
+                        for 3D input files, and tables are None if not computed.
+    '''
+    
+    img = nib.load(nii_file)
+    n_vols = img_volumes(img)
+    
+    # Stand-alone atlases in the input grid
+    atlases = [match_atlas_grid(atlas,img.shape,grid_affine(img)) for atlas in atlases]
+    atlas_data = [atlas["data"] for atlas in atlases if atlas.get("data") is not None]
+    
+    if table:
+        atlases = [dict(atlas,sizes=label_sizes(atlas["data"])) if atlas.get("data") is not None and atlas.get("sizes") is None else atlas for atlas in atlases]
+    
+    volumes = [None] if n_vols is None else list(range(n_vols))
+    
+    with mem_stage("load input"):
+        img_data = load_img_data(img)
+    
+    if n_vols is None:
+        img_data = img_data.reshape(img.shape[:3],order='A')
+    
+    vol_rois = list()
+    
+    for volume in volumes:
+        vol_data = img_data if volume is None else img_data[...,volume]
+        
+        with mem_stage("cluster"):
+            sweep = sweep_clusters(vol_data,thresholds,connectivity,img.affine,atlas_data)
+        
+        for thresh,clust_table,overlaps in reversed(sweep):
+            with mem_stage("overlap"):
+                [roi_lists,roi_tables] = resolve_atlases(clust_table,atlases,overlaps,table)
+            vol_rois.append((volume,thresh,roi_lists,roi_tables))
+    
+    return vol_rois
+
+def get_file_rois(nii_file,thresh=0.95,dist=0,vol_atlas_num=3,atlas_data=None,atlas_dict=None,connectivity=26,atlas_lut=None,slab=0,table=False,roi_sizes=None,atlas_affine=None):
+    '''
+    Identifies ROIs that have overlap with some cluster(s) from the input (3D or 4D) NIFTI file, using either a
+    (loaded) stand-alone atlas or some FSL atlas. 4D files are decoded once, and each of their volumes is
+    processed in turn. Nothing is written to file. See get_file_atlas_rois for several atlases.
+    
+    Arguments:
+        nii_file(NIFTI file): Input NIFTI volume file
+        thresh(float): Threshold values below this value
+        dist(float): Minimum distance between local maxima (deprecated and ignored, as it only applies to local maxima, see find_peaks. It will be removed in a future version.)
+        vol_atlas_num(int): Atlas to be used in FSL's `atlasquery` (if no stand-alone atlas is provided).
+        atlas_data(numpy array): Stand-alone atlas data (see load_atlas_data)
+        atlas_dict(dict): Stand-alone atlas dictionary of key, value pairs (see load_atlas_data)
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+        atlas_lut(numpy array): Optional label -> ROI name lookup array (see make_label_lut)
+        slab(int): Number of z-slices per slab if the input is streamed (see stream_clusters), or 0 to load the whole input into memory
+        table(bool): Also compute the cluster x ROI table of each volume (see overlap_table and peak_table)
+        roi_sizes(numpy array): Number of voxels of each stand-alone atlas label (see label_sizes). Computed if required and not provided.
+        atlas_affine(numpy array): Stand-alone atlas 4 x 4 voxel to mm affine. If provided, the atlas is mapped onto the input grid
+                                   as required (see match_atlas_grid), otherwise both are assumed to share a grid.
+    Returns:
+        vol_rois(list): List of (volume index, ROI list, cluster x ROI table) tuples. The volume index is None for 3D input
+                        files, and the table is None if not computed.
+    '''
+    
+    warn_dist(dist,"get_file_rois")
+    
+    if atlas_data is None or atlas_dict is None:
+        atlases = [{"name":atlas_name(vol_atlas_num),"num":vol_atlas_num}]
+    else:
+        atlases = [{"name":"ROIs",
+                    "data":atlas_data,
+                    "dict":atlas_dict,
+                    "lut":make_label_lut(atlas_dict) if atlas_lut is None else atlas_lut,
+                    "sizes":roi_sizes,
+                    "affine":atlas_affine}]
+    
+    vol_rois = [(volume,roi_lists[0],roi_tables[0]) for volume,roi_lists,roi_tables in get_file_atlas_rois(nii_file,atlases,thresh,connectivity,slab,table)]
+    
+    return vol_rois
+
+def get_rois(nii_file,thresh=0.95,dist=0,vol_atlas_num=3,atlas_data=None,atlas_dict=None,connectivity=26,atlas_lut=None,slab=0):
+    '''
+    Identifies ROIs that have overlap with some cluster(s) from the input (3D) NIFTI file, using either a (loaded)
+    stand-alone atlas or some FSL atlas. Nothing is written to file. See get_file_rois for 4D input files.
+    
+    Arguments:
+        nii_file(NIFTI file): Input NIFTI volume file
+        thresh(float): Threshold values below this value
+        dist(float): Minimum distance between local maxima (deprecated and ignored, as it only applies to local maxima, see find_peaks. It will be removed in a future version.)
+        vol_atlas_num(int): Atlas to be used in FSL's `atlasquery` (if no stand-alone atlas is provided).
+        atlas_data(numpy array): Stand-alone atlas data (see load_atlas_data)
+        atlas_dict(dict): Stand-alone atlas dictionary of key, value pairs (see load_atlas_data)
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+        atlas_lut(numpy array): Optional label -> ROI name lookup array (see make_label_lut)
+        slab(int): Number of z-slices per slab if the input is streamed (see stream_clusters), or 0 to load the whole input into memory
+    Returns:
+        roi_list(list): List of ROIs overlapped by cluster(s)
+    '''
+    
+    warn_dist(dist,"get_rois")
+    
+    vol_rois = get_file_rois(nii_file,thresh,0,vol_atlas_num,atlas_data,atlas_dict,connectivity,atlas_lut,slab)
     
-    # Define list and output file
-    roi_list = list()
-    out_file = "subcort.rois.txt"
+    if len(vol_rois) > 1:
+        raise ValueError(f"{nii_file} is a 4D file. See get_file_rois for 4D input files.")
     
-    if len(coords) == 3:
-        atlasq_cmd = os.path.join(scripts_dir,"atlasq.sh")
-        atlasq = Command().init_cmd(atlasq_cmd)
-        atlasq.append(f"--coord")
-        atlasq.append(f"\"{coords[0]},{coords[1]},{coords[2]}\"")
-        atlasq.append("--atlas-num")
-        atlasq.append(f"{vol_atlas_num}")
+    roi_list = vol_rois[0][1]
     
-        run(atlasq,out_file)
-
-        with open(out_file,"r") as file:
-            text = file.readlines()
-            for i in range(0,len(text)):
-                text[i] = re.sub(f"<b>{vol_atlas_dict[vol_atlas_num]}</b><br>","",text[i].rstrip())
-
-        os.remove(out_file)
-        
-        if len(text) == 0:
-            pass
-        else:
-            roi_list.extend(text) 
-        
     return roi_list
 
-def vol_clust(nii_file,thresh=0.95,dist=0,vol_atlas_num=3):
+def proc_vol(nii_file,out_file,thresh = 0.95, dist = 0, vol_atlas_num = 3, nii_atlas = "", atlas_info = "", connectivity = 26, use_cache = True, slab = 0, table_file = "", atlases = None, nearest = False, prob_cutoff = None, olmax_file = ""):
     '''
-    Identifies clusters in a volumetric (NIFTI) file.
+    Identifies ROIs that have overlap with some cluster(s) from the input NIFTI file. For 4D input files,
+    one row is written for each volume (along with its volume index). If several atlases are provided, the
+    input is clustered once and one column is written for each atlas.
     
     Arguments:
-        nii_file(file): Input NIFTI file
-        thresh(float): Cluster minimum threshold
-        dist(float): Minimum distance between clusters
+        nii_file(NIFTI file): Input NIFTI volume file
+        out_file(file): Name for output CSV
+        thresh(float): Threshold values below this value
+        dist(float): Minimum distance (in mm) between the local maxima of a cluster (see 'olmax_file')
         vol_atlas_num(int): Atlas to be used in FSL's `atlasquery`. Number corresponds to an atlas. See FSL's `atlasquery` help menu for details.
+        nii_atlas(NIFTI file): NIFTI atlas file
+        atlas_info(file): Corresponding CSV key, value pairs of ROIs for atlas file
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+        use_cache(bool): Read from/write to the decoded atlas and cluster caches
+        slab(int): Number of z-slices per slab if the input is streamed (see stream_clusters), or 0 to load the whole input into memory
+        table_file(file): Output (long format) cluster x ROI table TSV file (see overlap_table and peak_table)
+        atlases(list): List of FSL atlas numbers (int) and/or (NIFTI atlas, CSV file) tuples, used instead of
+                       'vol_atlas_num', 'nii_atlas' and 'atlas_info' if provided.
+        nearest(bool): Report the nearest labelled ROI of unlabelled cluster peaks in the cluster x ROI tables of stand-alone atlases (see nearest_peaks)
+        prob_cutoff(float): Resolve probabilistic FSL atlases over whole clusters, reporting ROIs whose mean membership
+                            probability (%) is at least this value (see cluster_memberships). Requires a 'slab' of 0.
+        olmax_file(file): Output (long format) local maxima TSV file (see find_peaks), e.g. for '--coord-table'
     Returns:
-        roi_list(list): List of ROIs that overlap with some given cluster
+      out_filefile(file): Output CSV file (or results store, see store_backends)
     '''
     
-    out_file = "vol.cluster.tsv"
+    if atlases is None:
+        atlases = [(nii_atlas,atlas_info)] if nii_atlas and atlas_info else [vol_atlas_num]
     
-    roi_list = list()
-    tmp_list = list()
-    
-    vol_clust = Command().init_cmd("cluster")
+    # Results stores (other than CSV) record each cluster and ROI
+    backend = store_backend(out_file)
+    table = bool(table_file) or backend is not CsvStore
     
-    vol_clust.append(f"--in={nii_file}")
-    vol_clust.append(f"--thresh={thresh}")
-    vol_clust.append(f"--peakdist={dist}")
-    vol_clust.append("--mm")
+    # Read atlas data and info
+    atlases = load_atlases(atlases,use_cache,table,nearest,prob_cutoff)
     
-    run(vol_clust,out_file)
+    # The input is read once for the ROIs and local maxima
+    prefetched = read_input(nii_file,thresh,connectivity,slab,use_cache) if olmax_file else None
     
-    df_tmp = pd.read_csv(out_file,sep="\t")
+    vol_rois = get_file_atlas_rois(nii_file,atlases,thresh,connectivity,slab,table,use_cache,prefetched)
     
-    os.remove(out_file)
+    if backend is not CsvStore:
+        store = backend(out_file,[atlas["name"] for atlas in atlases],{"thresh":thresh,"dist":dist,"connectivity":connectivity})
+        try:
+            with mem_stage("write"):
+                store.write([(nii_file,volume,roi_lists,"") for volume,roi_lists,_ in vol_rois],
+                            [(volume,atlas_table(atlases,roi_tables)) for volume,_,roi_tables in vol_rois])
+        finally:
+            store.close()
     
-    df = df_tmp[['MAX X (mm)','MAX Y (mm)','MAX Z (mm)']].copy()
+    # Write spreadsheet to file (one row per volume for 4D files, one column per atlas for several atlases)
+    for volume,roi_lists,roi_tables in vol_rois:
+        if backend is CsvStore and any(len(roi_list) != 0 for roi_list in roi_lists):
+            rois = roi_lists[0] if len(atlases) == 1 else {atlas["name"]:roi_list for atlas,roi_list in zip(atlases,roi_lists)}
+            with mem_stage("write"):
+                out_file = write_spread(nii_file,out_file,rois,volume,thresh)
+        roi_table = atlas_table(atlases,roi_tables)
+        if table_file and roi_table is not None and len(roi_table) != 0:
+            with mem_stage("write"):
+                write_table(nii_file,table_file,roi_table,volume)
     
-    for i in range(0,len(df)):
-        coord_list=[df['MAX X (mm)'][i],df['MAX Y (mm)'][i],df['MAX Z (mm)'][i]]
-        tmp_list = roi_loc(coord_list,vol_atlas_num)
-        if len(tmp_list) == 0:
-            pass
-        else:
-            roi_list.extend(tmp_list)
+    if olmax_file:
+        for volume,peak_table in get_file_peaks(nii_file,thresh,dist,connectivity,use_cache,prefetched):
+            if len(peak_table) != 0:
+                with mem_stage("write"):
+                    write_table(nii_file,olmax_file,peak_table,volume)
     
-    return roi_list
+    return out_file
 
-def read_atlas_file(atlas_info):
+def proc_sweep(nii_file,out_file,thresholds,dist = 0, connectivity = 26, use_cache = True, table_file = "", atlases = None, nearest = False):
     '''
-    Reads CSV of key, value pairs of enumerated ROIs for some corresponding atlas.
+    Identifies ROIs that have overlap with some cluster(s) from the input NIFTI file at several thresholds (see
+    get_file_sweep_rois). One row is written for each threshold (and volume of 4D input files), along with its threshold.
     
     Arguments:
-        atlas_info(file): Input CSV file of enumerated ROI key, value pairs
+        nii_file(NIFTI file): Input NIFTI volume file
+        out_file(file): Name for output CSV
+        thresholds(list): List of thresholds
+        dist(float): Minimum distance between local maxima (recorded in results stores, this does not affect the ROIs)
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+        use_cache(bool): Read from/write to the decoded atlas cache
+        table_file(file): Output (long format) cluster x ROI table TSV file (see overlap_table and peak_table)
+        atlases(list): List of FSL atlas numbers (int) and/or (NIFTI atlas, CSV file) tuples [default: FSL atlas 3]
+        nearest(bool): Report the nearest labelled ROI of unlabelled cluster peaks in the cluster x ROI tables of stand-alone atlases (see nearest_peaks)
     Returns:
-        atlas_dict(dict): Dictionary of atlas key, value pairs
+      out_file(file): Output CSV file (or results store, see store_backends)
     '''
     
-    atlas_info = os.path.abspath(atlas_info)
-    df = pd.read_csv(atlas_info,header=None); df.columns = ['key', 'id']
-    # df = pd.read_csv(atlas_info,header=None,error_bad_lines=False); df.columns = ['key', 'id']
-    atlas_dict = df.set_index('key').to_dict(orient='dict')['id']
+    if atlases is None:
+        atlases = [3]
     
-    return atlas_dict
+    # Results stores (other than CSV) record each cluster and ROI
+    backend = store_backend(out_file)
+    table = bool(table_file) or backend is not CsvStore
+    
+    # Read atlas data and info
+    atlases = load_atlases(atlases,use_cache,table,nearest)
+    
+    vol_rois = get_file_sweep_rois(nii_file,atlases,thresholds,connectivity,table)
+    
+    # A single store records every threshold (along with the threshold of each run)
+    store = backend(out_file,[atlas["name"] for atlas in atlases],{"dist":dist,"connectivity":connectivity})
+    
+    try:
+        for volume,thresh,roi_lists,roi_tables in vol_rois:
+            roi_table = atlas_table(atlases,roi_tables)
+            with mem_stage("write"):
+                # CSV files only record the thresholds with overlapping ROIs
+                if backend is not CsvStore or any(len(roi_list) != 0 for roi_list in roi_lists):
+                    store.write([(nii_file,volume,roi_lists,"")],[(volume,roi_table)],thresh=thresh)
+                if table_file and roi_table is not None and len(roi_table) != 0:
+                    write_table(nii_file,table_file,roi_table,volume,thresh)
+    finally:
+        store.close()
+    
+    return store.out_file
 
-def remove_ext(file):
+def expand_inputs(inputs):
     '''
-    Removes extension of some input file string. Primarily intended for NIFTI files.
+    Expands batch inputs into a list of NIFTI files. Each input may be a glob pattern (e.g. 'sub-*/stats.nii.gz'),
+    a text file list (one NIFTI file per line), a CSV/TSV manifest (with a 'File' column, or files in the first
+    column), or a NIFTI file.
     
     Arguments:
-        file(str): Input file name string
+        inputs(list): List of glob patterns, file lists, manifests and/or NIFTI files
     Returns:
-        name(str): File name string with extension removed
+        nii_files(list): List of NIFTI files
     '''
     
-    if '.nii.gz' in file:
-        name = file[:-7]
-    elif '.nii' in file:
-        name = file[:-4]
-    elif '.txt' in file or '.tsv' in file or '.csv' in file:
-        name = file
-    else:
-        name = file
+    nii_files = list()
     
-    return name
+    for item in inputs:
+        if glob.has_magic(item):
+            nii_files.extend(sorted(glob.glob(item)))
+        elif item.endswith(('.csv','.tsv')):
+            with open(item,"r",newline="") as f:
+                rows = [row for row in csv.reader(f,delimiter="\t" if item.endswith('.tsv') else ",") if row]
+            col = rows[0].index("File") if rows and "File" in rows[0] else 0
+            rows = rows[1:] if rows and "File" in rows[0] else rows
+            nii_files.extend(row[col].strip() for row in rows)
+        elif item.endswith(('.txt','.list')):
+            with open(item,"r") as f:
+                nii_files.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+        else:
+            nii_files.append(item)
+    
+    return nii_files
 
-def convert_img_dtype(img,data_type="int"):
+def init_batch_worker(atlases=None,use_cache=True,table=False,profile=False,nearest=False,prob_cutoff=None):
     '''
-    Converts image data type to some other arbitrary data type. See fslmaths help menu for further details.
+    Initializes the atlases of some batch worker process. Atlases inherited from the parent process (i.e. forked
+    workers) are used as-is, otherwise stand-alone atlases are memory-mapped from the decoded atlas cache, such that
+    all workers share a single read-only copy.
     
     Arguments:
-        img(NIFTI file): Input NIFTI file
-        data_type(str): Output data type (e.g. 'int','float','char','float','double')
-    Returns:
-        out_file(NIFTI file): NIFTI file with desired data type
+        atlases(list): List of FSL atlas numbers (int) and/or (NIFTI atlas, CSV file) tuples
+        use_cache(bool): Read from/write to the decoded atlas and cluster caches
+        table(bool): Also count the voxels of each atlas label (for cluster x ROI tables)
+        profile(bool): Record the profile of each processing stage (see start_profile)
+        nearest(bool): Report the nearest labelled ROI of unlabelled cluster peaks (see nearest_peaks)
+        prob_cutoff(float): Resolve probabilistic FSL atlases over whole clusters with this cutoff (see load_atlases)
     '''
     
-    img = os.path.abspath(img)
-    out_dir = os.path.dirname(img)
-    
-    img = remove_ext(img)
-    name = os.path.basename(img)
-    
-    out_file = os.path.join(out_dir,name + ".int" + ".nii.gz")
+    if profile:
+        prof_state["enabled"] = True
     
-    img_dtype = Command().init_cmd("fslmaths")
-    img_dtype.append("-dt")
-    img_dtype.append(data_type)
-    img_dtype.append(img)
-    img_dtype.append(out_file)
-    img_dtype.append("-odt")
-    img_dtype.append(data_type)
+    atlases = atlases or []
+    key = (tuple(atlases),table,nearest,prob_cutoff)
     
-    run(img_dtype)
+    if batch_atlas.get("key") != key:
+        batch_atlas.update(key=key,atlases=load_atlases(atlases,use_cache,table,nearest,prob_cutoff))
     
-    return out_file
+    batch_atlas["use_cache"] = use_cache
 
-def load_atlas_data(nii_atlas,atlas_info,data_type="int"):
+def proc_batch_file(nii_file,thresh=0.95,connectivity=26,slab=0,table=False,prefetched=None,detach=True):
     '''
-    Loads atlas data from input NIFTI neuroimage atlas and it's corresponding
-    enumerated key, value paired atlas CSV file.
+    Identifies the ROIs of a single batch input file using the batch worker's atlases (see init_batch_worker).
+    Errors are returned rather than raised.
     
     Arguments:
-        nii_atlas(NIFTI file): Input NIFTI atlas
-        atlas_info(file): Corresponding atlas CSV file
-        data_type(str): Output data type (e.g. 'int','float','char','float','double')
+        nii_file(NIFTI file): Input NIFTI volume file
+        thresh(float): Threshold values below this value
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+        slab(int): Number of z-slices per slab if the input is streamed (see stream_clusters), or 0 to load the whole input into memory
+        table(bool): Also compute the cluster x ROI tables of each volume
+        prefetched(dict): Input file that was already read (see read_input), or the error raised while reading it.
+                          The input file is read if not provided.
+        detach(bool): Detach the profile records of this file from the profile of this process (i.e. to return them to
+                      the writer process). Threads of a single process (see BatchPipeline) share its profile.
     Returns:
-        atlas_data(numpy array): Atlas data represented as an N x M x P array
-        atlas_dict(dict): Atlas dictionary of key, value pairs
+        rows(list): List of (file, volume, roi_lists, error) rows, one for each volume (with one ROI list per atlas).
+                    The volume is None for 3D input files, and the error message is empty if successful.
+        tables(list): List of (volume, cluster x ROI table) tuples
+        records(list): List of the profile records of this file (see mem_stage), which are returned to the writer process
     '''
     
-    # Load atlas key/ID information
-    atlas_dict = read_atlas_file(atlas_info)
+    atlases = batch_atlas["atlases"]
+    n_records = len(prof_stats)
     
-    # Convert input image from float to int
-    int_data = convert_img_dtype(nii_atlas,data_type)
+    try:
+        if isinstance(prefetched,Exception):
+            raise prefetched
+        vol_rois = get_file_atlas_rois(nii_file,atlases,thresh,connectivity,slab,table,batch_atlas.get("use_cache",False),prefetched)
+        rows = [(nii_file,volume,roi_lists,"") for volume,roi_lists,_ in vol_rois]
+        tables = [(volume,atlas_table(atlases,roi_tables)) for volume,_,roi_tables in vol_rois]
+    except Exception as err:
+        rows = [(nii_file,None,[[] for _ in atlases],f"{type(err).__name__}: {err}")]
+        tables = []
     
-    # Load/export data as numpy array
-    img = nib.load(int_data)
-    atlas_data = img.get_fdata()
+    records = list()
     
-    # Clean-up
-    os.remove(int_data)
+    if detach:
+        records = prof_stats[n_records:]
+        del prof_stats[n_records:]
     
-    return atlas_data,atlas_dict
+    return rows,tables,records
 
-def make_cluster_vol(nii_file,thresh=0.95,dist=0):
+def proc_batch(nii_files,out_file,thresh = 0.95, dist = 0, vol_atlas_num = 3, nii_atlas = "", atlas_info = "", connectivity = 26, use_cache = True, n_procs = 1, slab = 0, table_file = "", atlases = None, force = False, content_hash = False, nearest = False, prefetch = 0, readers = 2, prefetch_mem = 1 << 30, prob_cutoff = None):
     '''
-    Creates enumerated clusters from input NIFTI file and writes the enumerated clusters to a separate NIFTI volume.
+    Identifies ROIs that have overlap with some cluster(s) for several input NIFTI files. The atlases are loaded once,
+    files are processed across a pool of worker processes, and results are written to a single output CSV file
+    (by a single writer) as they are completed. Alternatively, files are processed in a pipeline of threads (see
+    BatchPipeline), in which reader threads read the next files ahead of the compute workers.
+    
+    Runs are incremental: each input file is fingerprinted along with the atlases and clustering parameters (see
+    input_fingerprint), and files whose results are already in the output are skipped (e.g. files added to a group
+    analysis are processed alone, and interrupted runs resume where they stopped).
     
     Arguments:
-        nii_file(NIFTI file): Input NIFTI file
-        thresh(float): Minimum threshold 
-        dist(float): Minimum distance between clusters
+        nii_files(list): List of input NIFTI volume files
+        out_file(file): Name for output CSV
+        thresh(float): Threshold values below this value
+        dist(float): Minimum distance between local maxima (recorded in results stores, this does not affect the ROIs)
+        vol_atlas_num(int): Atlas to be used in FSL's `atlasquery`. Number corresponds to an atlas. See FSL's `atlasquery` help menu for details.
+        nii_atlas(NIFTI file): NIFTI atlas file
+        atlas_info(file): Corresponding CSV key, value pairs of ROIs for atlas file
+        connectivity(int): Voxel connectivity used to form clusters (6, 18, or 26)
+        use_cache(bool): Read from/write to the decoded atlas and cluster caches
+        n_procs(int): Number of worker processes
+        slab(int): Number of z-slices per slab if inputs are streamed (see stream_clusters), or 0 to load whole inputs into memory
+        table_file(file): Output (long format) cluster x ROI table TSV file (see overlap_table and peak_table)
+        atlases(list): List of FSL atlas numbers (int) and/or (NIFTI atlas, CSV file) tuples, used instead of
+                       'vol_atlas_num', 'nii_atlas' and 'atlas_info' if provided (one column is written per atlas).
+        force(bool): Reprocess all files, including files whose results are already in the output
+        content_hash(bool): Fingerprint the contents of input files, rather than their size and modification time
+        nearest(bool): Report the nearest labelled ROI of unlabelled cluster peaks in the cluster x ROI tables of stand-alone atlases (see nearest_peaks)
+        prefetch(int): Number of files read ahead of the compute workers in a pipeline (in which 'n_procs' is the number
+                       of compute worker threads), or 0 to process files across a pool of worker processes.
+                       Pipeline metrics are kept in 'pipe_stats' (see print_pipeline_stats).
+        readers(int): Number of reader threads of the pipeline
+        prefetch_mem(int): Maximum memory (in bytes) of files that are read ahead (but not yet processed) in the pipeline
+        prob_cutoff(float): Resolve probabilistic FSL atlases over whole clusters, reporting ROIs whose mean membership
+                            probability (%) is at least this value (see cluster_memberships). Requires a 'slab' of 0.
     Returns:
-        out_file(NIFTI file): Output NIFTI file of enumerated clusters
-        out_stat(file): Corresponding table of enumerated clusters with MNI space mm and vox coordinates
+        out_file(file): Output CSV file (or results store, see store_backends)
+        n_failed(int): Number of files that failed to process
+        n_skipped(int): Number of (unchanged) files that were skipped
     '''
     
-    # Construct file paths
-    nii_file = os.path.abspath(nii_file)
-    out_dir = os.path.dirname(nii_file)
+    if atlases is None:
+        atlases = [(nii_atlas,atlas_info)] if nii_atlas and atlas_info else [vol_atlas_num]
     
-    nii_file = remove_ext(nii_file)
-    name = os.path.basename(nii_file)
-    out_prefix = os.path.join(out_dir,name + ".cluster")
+    # Results stores (other than CSV) record each cluster and ROI
+    backend = store_backend(out_file)
+    table = bool(table_file) or backend is not CsvStore
     
-    out_file = out_prefix + ".nii.gz"
-    out_stat = out_prefix + ".txt"
+    # Load the atlases once (workers inherit them, or memory-map them from the cache)
+    init_batch_worker(atlases,use_cache,table,nearest=nearest,prob_cutoff=prob_cutoff)
     
-    # Make cluster(s) from input data
-    clust_cmd = Command().init_cmd("cluster")
-    clust_cmd.append(f"--in={nii_file}")
-    clust_cmd.append(f"--thresh={thresh}")
-    clust_cmd.append(f"--peakdist={dist}")
-    clust_cmd.append(f"--oindex={out_file}")
-    # clust_cmd.append(f"--othresh={out_file}")
+    params = {"thresh":thresh,"dist":dist,"connectivity":connectivity}
+    store = backend(out_file,[atlas["name"] for atlas in batch_atlas["atlases"]],params)
     
-    run(clust_cmd,out_stat)
+    try:
+        # Skip unchanged files (same contents, atlases and parameters) that are already in the output
+        with mem_stage("fingerprint"):
+            atlas_key = atlas_fingerprint(atlases)
+            # The minimum distance between local maxima does not affect the ROIs
+            fp_params = dict({key:value for key,value in params.items() if key != "dist"},**({"nearest":True} if nearest else {}),**({"prob_cutoff":prob_cutoff} if prob_cutoff is not None else {}))
+            fingerprints = {nii_file:input_fingerprint(nii_file,atlas_key,fp_params,content_hash) for nii_file in dict.fromkeys(nii_files)}
+            done = set() if force else store.done()
+        
+        todo = [nii_file for nii_file in dict.fromkeys(nii_files) if force or not fingerprints[nii_file] or fingerprints[nii_file] not in done]
+        n_skipped = len(set(nii_files)) - len(todo)
+        
+        # Files that are processed again (e.g. with 'force', or after changes or errors) replace their previous CSV rows
+        if backend is CsvStore:
+            store.drop(todo)
+        
+        func = functools.partial(proc_batch_file,thresh=thresh,connectivity=connectivity,slab=slab,table=table)
+        
+        if prefetch > 0 and len(todo) > 0:
+            # Pipeline: reader threads read ahead, worker threads compute, and this thread writes (in input order)
+            pipeline = BatchPipeline(readers,n_procs,prefetch,prefetch_mem)
+            read = functools.partial(read_input,thresh=thresh,connectivity=connectivity,slab=slab,use_cache=use_cache)
+            compute = lambda nii_file,prefetched: func(nii_file,prefetched=prefetched,detach=False)
+            write = lambda results: write_batch_spread(results,store,table_file,fingerprints)
+            size = lambda nii_file: 0 if slab else img_nbytes(nib.load(nii_file))
+            try:
+                n_failed = pipeline.run(todo,read,compute,write,size)
+            finally:
+                pipe_stats.clear()
+                pipe_stats.update(pipeline.stats())
+        elif n_procs > 1 and len(todo) > 1:
+            with multiprocessing.Pool(min(n_procs,len(todo)),initializer=init_batch_worker,initargs=(atlases,use_cache,table,prof_state["enabled"],nearest,prob_cutoff)) as pool:
+                n_failed = write_batch_spread(pool.imap(func,todo),store,table_file,fingerprints)
+        else:
+            n_failed = write_batch_spread(map(func,todo),store,table_file,fingerprints)
+    finally:
+        store.close()
     
-    return out_file,out_stat
+    return store.out_file,n_failed,n_skipped
 
-def load_nii_vol(nii_file,thresh=0.95,dist=0):
+def coord_rois(coords,atlas_data,atlas_lut,affine,index=None):
     '''
-    Reads in NIFTI volume information, creates a volume of enumerated clusters, and then stores 
-    those clusters in an N x M x P array.
+    Identifies the ROIs of several XYZ mm coordinates using some stand-alone atlas. Coordinates are converted to
+    voxel coordinates through the atlas affine in a single matrix operation.
     
     Arguments:
-        nii_file(NIFTI file): Input NIFTI file
-        thresh(float): Minimum threshold
-        dist(float): Minimum distance between clusters
+        coords(numpy array): N x 3 array of mm coordinates
+        atlas_data(numpy array): Atlas labels (see load_atlas_data)
+        atlas_lut(numpy array): Label -> ROI name lookup array (see make_label_lut)
+        affine(numpy array): 4 x 4 atlas voxel to mm affine
+        index(AtlasIndex): Atlas spatial index. If provided, unlabelled coordinates report their nearest labelled ROI (see AtlasIndex.region).
     Returns:
-        img_data(numpy array): N x M x P numpy array of the clusters
+        roi_lists(list): List of ROI lists (empty for unlabelled coordinates), one for each coordinate
+        dists(list): Distance (in mm) to the nearest labelled voxel of each coordinate (0 for labelled coordinates). Only returned if an index is provided.
     '''
     
-    # Create volume clusters
-    [clust_file,clust_stat] = make_cluster_vol(nii_file,thresh,dist)
+    coords = np.asarray(coords,dtype=np.float64).reshape(-1,3)
     
-    # Load/export data as numpy array
-    img = nib.load(clust_file)
-    img_data = img.get_fdata()
+    if index is not None:
+        [labels,dists] = index.region(coords)
+    else:
+        vox = np.rint(nib.affines.apply_affine(np.linalg.inv(affine),coords)).astype(np.int64)
+        in_fov = np.all((vox >= 0) & (vox < np.array(atlas_data.shape[:3])),axis=1)
+        vox[~in_fov] = 0
+        
+        labels = np.asarray(atlas_data[vox[:,0],vox[:,1],vox[:,2]]).astype(np.int64)
+        labels[~in_fov] = 0
     
-    # Clean-up
-    os.remove(clust_file)
-    os.remove(clust_stat)
+    roi_lists = [[atlas_lut[label]] if 0 < label < len(atlas_lut) and atlas_lut[label] is not None else [] for label in labels.tolist()]
     
-    return img_data
+    if index is not None:
+        return roi_lists,[float(dist) if np.isfinite(dist) else None for dist in dists]
+    
+    return roi_lists
 
-def get_roi_name(cluster_data,atlas_data,atlas_dict):
+def read_coord_table(coord_file):
     '''
-    Finds ROI names from overlapping clusters in a NIFTI volume by voxel matching.
+    Reads a CSV/TSV table of XYZ mm coordinates (e.g. a peak table, or meta-analysis foci). Coordinates are read from
+    'X', 'Y' and 'Z' columns (case-insensitive, optionally with an ' (mm)' suffix or a 'MAX '/'MNI ' prefix), or
+    otherwise from the first three numeric columns. Tables without a header are read as such.
     
     Arguments:
-        cluster_data(numpy array): Input numpy of data
-        atlas_data(numpy array): Numpy array of labeled surface vertices for some specific hemisphere
-        atlas_dict(dict): Dictionary of label IDs to ROI names
+        coord_file(file): Input CSV or TSV (.tsv/.txt) file
     Returns:
-        roi_list(list): List of ROIs overlapped by cluster(s)
+        df(DataFrame): Coordinate table
+        coords(numpy array): N x 3 array of mm coordinates
     '''
     
-    # Flatten matrices
-    cluster_data = cluster_data.flatten(order='C')
-    atlas_data = atlas_data.flatten(order='C')
+    sep = "\t" if coord_file.endswith(('.tsv','.txt')) else ","
     
-    tmp_list = list()
-    roi_list = list()
+    df = pd.read_csv(coord_file,sep=sep)
     
-    for idx,val in enumerate(cluster_data):
-        if cluster_data[idx] == 0:
-            atlas_data[idx] = 0
-            
-    for i in np.unique(atlas_data)[1:]:
-        tmp_list = atlas_dict[i]
-        roi_list.append(tmp_list)
+    # Headerless tables (i.e. numeric column names)
+    try:
+        [float(col) for col in df.columns]
+        df = pd.read_csv(coord_file,sep=sep,header=None)
+    except ValueError:
+        pass
+    
+    names = {str(col).strip().lower(): col for col in df.columns}
+    cols = None
+    
+    for prefix in ["","max ","mni "]:
+        for suffix in [""," (mm)"]:
+            keys = [f"{prefix}{axis}{suffix}" for axis in "xyz"]
+            if cols is None and all(key in names for key in keys):
+                cols = [names[key] for key in keys]
+    
+    if cols is None:
+        cols = [col for col in df.columns if pd.api.types.is_numeric_dtype(df[col])][:3]
+    
+    if len(cols) != 3:
+        raise ValueError(f"Unable to find X, Y and Z (mm) coordinate columns in {coord_file}.")
+    
+    coords = df[cols].to_numpy(dtype=np.float64)
+    
+    return df,coords
+
+def label_coords(coords,atlases):
+    '''
+    Labels several (e.g. tens of thousands of) XYZ mm coordinates with several (FSL and/or stand-alone) atlases.
+    Coordinates are mapped through each atlas affine in a single matrix operation, and repeated coordinates (i.e.
+    coordinates in the same atlas voxel) are looked up once. For each atlas, the 'Label' and 'ROI' of each coordinate are
+    reported. Probabilistic atlases report their most probable ROI (with a label of its volume index + 1, as in FSL's
+    maximum probability images), its 'Probability' (%) and all non-zero 'Probabilities'. Stand-alone atlases loaded
+    with 'nearest' report the nearest labelled ROI of unlabelled coordinates, and its 'Distance (mm)'. Coordinates outside
+    of the atlas field of view are unlabelled (label 0, empty ROI).
+    
+    Arguments:
+        coords(numpy array): N x 3 array of mm coordinates
+        atlases(list): List of loaded atlases (see load_atlases)
+    Returns:
+        df(DataFrame): Table of N rows, with '<atlas name> <column>' columns for each atlas
+    '''
+    
+    coords = np.asarray(coords,dtype=np.float64).reshape(-1,3)
+    columns = dict()
+    
+    for atlas in atlases:
+        name = atlas["name"]
         
-    return roi_list
+        if atlas.get("data") is not None:
+            [data,affine,lut] = [atlas["data"],atlas["affine"],atlas["lut"]]
+        else:
+            fsl = load_fsl_atlas(atlas["num"])
+            [data,affine] = [fsl.load(),fsl.affine]
+            lut = make_label_lut(fsl.labels)
+        
+        # Voxel coordinates, and the unique voxels of coordinates in the field of view
+        shape = np.array(data.shape[:3])
+        vox = np.rint(nib.affines.apply_affine(np.linalg.inv(affine),coords)).astype(np.int64)
+        in_fov = np.all((vox >= 0) & (vox < shape),axis=1)
+        
+        flat = np.full(len(coords),-1,dtype=np.int64)
+        flat[in_fov] = np.ravel_multi_index(tuple(vox[in_fov].T),tuple(shape))
+        [uniq,inverse] = np.unique(flat,return_inverse=True)
+        
+        inside = uniq >= 0
+        uniq_vox = np.unravel_index(uniq[inside],tuple(shape))
+        
+        with mem_stage("label coords"):
+            if atlas.get("data") is None and fsl.atlas_type == "probabilistic":
+                # Probabilities of each region (voxels x regions)
+                probs = np.zeros((len(uniq),data.shape[3]),dtype=np.float64)
+                probs[inside] = np.asarray(data[uniq_vox])
+                top = np.argmax(probs,axis=1)
+                top_prob = probs[np.arange(len(uniq)),top]
+                roi_names = np.full(len(uniq),"",dtype=object)
+                texts = np.full(len(uniq),"",dtype=object)
+                for i in np.flatnonzero(top_prob > 0):
+                    roi_names[i] = fsl.labels.get(int(top[i]),"")
+                    texts[i] = fsl.prob_text(probs[i])
+                
+                columns[f"{name} Label"] = np.where(top_prob > 0,top + 1,0)[inverse]
+                columns[f"{name} ROI"] = roi_names[inverse]
+                columns[f"{name} Probability"] = top_prob[inverse]
+                columns[f"{name} Probabilities"] = texts[inverse]
+                continue
+            
+            labels = np.zeros(len(uniq),dtype=np.int64)
+            labels[inside] = np.asarray(data[uniq_vox]).astype(np.int64)
+            labels = labels[inverse]
+            
+            if atlas.get("nearest") and atlas.get("index") is not None:
+                # Nearest labelled ROI of unlabelled coordinates (one query per unique coordinate)
+                dists = np.zeros(len(coords),dtype=np.float64)
+                unlabelled = np.flatnonzero(labels == 0)
+                [uniq_coords,coord_inverse] = np.unique(coords[unlabelled],axis=0,return_inverse=True)
+                [near_labels,near_dists] = atlas["index"].region(uniq_coords)
+                labels[unlabelled] = near_labels[coord_inverse.reshape(-1)]
+                dists[unlabelled] = np.where(np.isfinite(near_dists),near_dists,np.nan)[coord_inverse.reshape(-1)]
+                columns[f"{name} Distance (mm)"] = dists
+            
+            in_lut = (labels > 0) & (labels < len(lut))
+            roi_names = np.full(len(coords),"",dtype=object)
+            roi_names[in_lut] = lut[labels[in_lut]]
+            roi_names[roi_names == None] = ""
+            
+            columns[f"{name} Label"] = labels
+            columns[f"{name} ROI"] = roi_names
+    
+    df = pd.DataFrame(columns)
+    
+    # Distance columns follow the ROI columns
+    df = df[[col for col in df.columns if not col.endswith(" Distance (mm)")] + [col for col in df.columns if col.endswith(" Distance (mm)")]]
+    
+    return df
 
-def write_spread(file,out_file,roi_list):
+def proc_coords(coord_file,out_file,atlases = None, use_cache = True, nearest = False):
     '''
-    Writes the contents or roi_list to a spreadsheet.
+    Labels the XYZ mm coordinates of some CSV/TSV table (see read_coord_table) with several (FSL and/or stand-alone)
+    atlases (see label_coords), and writes the table with the label columns of each atlas appended.
     
     Arguments:
-        file (file): Input CIFTI file
-        out_file (file): Output csv file name and path. This file need not exist at runtime.
-        roi_list(list): List of ROIs to write to file
-    Returns: 
-        out_file (csv file): Output csv file name and path.
+        coord_file(file): Input CSV or TSV coordinate table
+        out_file(file): Output table (TSV for '.tsv'/'.txt' files, CSV otherwise)
+        atlases(list): List of FSL atlas numbers (int) and/or (NIFTI atlas, CSV file) tuples [default: FSL atlas 3]
+        use_cache(bool): Read from/write to the decoded atlas cache
+        nearest(bool): Report the nearest labelled ROI (and its distance) of unlabelled coordinates for stand-alone atlases
+    Returns:
+        out_file(file): Output table
     '''
     
-    # Strip csv file extension from output file name
-    if '.csv' in out_file:
-        out_file = os.path.splitext(out_file)[0]
-        out_file = out_file + '.csv'
-    elif '.tsv' in out_file:
-        out_file = os.path.splitext(out_file)[0]
-        out_file = out_file + '.csv'
-    elif '.txt' in out_file:
-        out_file = os.path.splitext(out_file)[0]
-        out_file = out_file + '.csv'
-    else:
-        out_file = out_file + '.csv'
+    atlases = load_atlases(atlases or [3],use_cache,False,nearest)
     
-    # Construct image dictionary
-    file = os.path.abspath(file)
-    img_dict = {"File":file,
-         "ROIs":[roi_list]}
+    with mem_stage("load input"):
+        [df,coords] = read_coord_table(coord_file)
     
-    # Create dataframe from image dictionary
-    df = pd.DataFrame.from_dict(img_dict,orient='columns')
+    labels = label_coords(coords,atlases)
+    labels.index = df.index
     
-    # Write output CSV file
-    if os.path.exists(out_file):
-        df.to_csv(out_file, sep=",", header=False, index=False, mode='a')
-    else:
-        df.to_csv(out_file, sep=",", header=True, index=False, mode='w')
+    with mem_stage("write"):
+        pd.concat([df,labels],axis=1).to_csv(out_file,sep="\t" if out_file.endswith(('.tsv','.txt')) else ",",index=False)
     
     return out_file
 
-def proc_vol(nii_file,out_file,thresh = 0.95, dist = 0, vol_atlas_num = 3, nii_atlas = "", atlas_info = ""):
+def parse_atlas_spec(spec):
     '''
-    Identifies ROIs that have overlap with some cluster(s) from the input NIFTI file.
+    Parses some atlas specification, as an FSL atlas number (e.g. '3'), or a comma separated NIFTI atlas and
+    CSV file pair (e.g. 'atlas.nii.gz,atlas.csv').
     
     Arguments:
-        nii_file(NIFTI file): Input NIFTI volume file
-        out_file(file): Name for output CSV
-        thresh(float): Threshold values below this value
-        dist(float): Minimum distance between two or more clusters
-        vol_atlas_num(int): Atlas to be used in FSL's `atlasquery`. Number corresponds to an atlas. See FSL's `atlasquery` help menu for details.
-        nii_atlas(NIFTI file): NIFTI atlas file
-        atlas_info(file): Corresponding CSV key, value pairs of ROIs for atlas file
+        spec(str): Atlas specification
     Returns:
-      out_filefile(file): Output CSV file
+        atlas(int or tuple): FSL atlas number, or (NIFTI atlas, CSV file) tuple
     '''
     
-    if nii_atlas and atlas_info:
-        # Read atlas data and info
-        [atlas_data,atlas_dict] = load_atlas_data(nii_atlas,atlas_info)
-
-        # Read NIFTI data and find clusters
-        img_data = load_nii_vol(nii_file,thresh,dist)
-
-        # Identify cluster and ROI overlaps
-        roi_list = get_roi_name(img_data,atlas_data,atlas_dict)
-    else:
-        roi_list = vol_clust(nii_file,thresh,dist,vol_atlas_num)
+    if spec.isdigit():
+        return int(spec)
     
-    # Write spreadsheet to file
-    if len(roi_list) != 0:
-        out_file = write_spread(nii_file,out_file,roi_list)
+    [nii_atlas,_,atlas_info] = spec.partition(",")
     
-    return out_file
+    if not atlas_info:
+        raise ValueError(f"Invalid atlas specification: {spec}. Expected an atlas number or 'ATLAS.nii.gz,ATLAS.csv'.")
+    
+    return nii_atlas,atlas_info
 
 def print_atlases():
     '''
@@ -549,36 +4492,147 @@ formatter_class=argparse.RawTextHelpFormatter)
                             metavar="STATS.nii.gz",
                             required=False,
                             help="NIFTI image file.")
+    reqoptions.add_argument('--coord-table',
+                            type=str,
+                            dest="coord_table",
+                            metavar="COORDS.csv",
+                            required=False,
+                            help="CSV/TSV table of XYZ mm coordinates to label (instead of '-i'), e.g. peak tables or meta-analysis\nfoci. Coordinates are read from X/Y/Z columns (or the first three numeric columns), and the table\nis written to '-o' with the label, ROI (and probabilities) of each atlas appended.")
     reqoptions.add_argument('-o', '-out', '--output',
                             type=str,
                             dest="out_file",
                             metavar="OUTPUT.csv",
                             required=False,
-                            help="Output spreadsheet name.")
+                            help="Output spreadsheet name. Results are instead stored in an SQLite database (one row per file,\ncluster and ROI) for '.db'/'.sqlite' outputs, or a Parquet dataset for '.parquet' outputs.")
+
+    # Batch options
+    batchoptions = parser.add_argument_group('Batch options')
+    batchoptions.add_argument('-b', '--batch',
+                            type=str,
+                            nargs='+',
+                            dest="batch",
+                            metavar="INPUT",
+                            required=False,
+                            help="Process several NIFTI files (instead of '-i'). Inputs may be quoted glob patterns, text file lists\n(one file per line), CSV/TSV manifests (with a 'File' column) or NIFTI files.")
+    batchoptions.add_argument('-j', '--jobs',
+                            type=int,
+                            dest="jobs",
+                            metavar="INT",
+                            default=1,
+                            required=False,
+                            help="Number of worker processes used in batch mode (or worker threads, see '--prefetch'). [default: 1]")
+    batchoptions.add_argument('--prefetch',
+                            type=int,
+                            dest="prefetch",
+                            metavar="INT",
+                            default=0,
+                            required=False,
+                            help="Pipeline batch mode: reader threads read (and decode) up to INT files ahead of the compute\nworkers ('-j' threads), while results are written in input order. Pipeline metrics (I/O and compute\noverlap) are printed at the end. [default: 0, i.e. no pipeline]")
+    batchoptions.add_argument('--readers',
+                            type=int,
+                            dest="readers",
+                            metavar="INT",
+                            default=2,
+                            required=False,
+                            help="Number of reader threads of the pipeline (see '--prefetch'). [default: 2]")
+    batchoptions.add_argument('--prefetch-mem',
+                            type=float,
+                            dest="prefetch_mem",
+                            metavar="MiB",
+                            default=1024,
+                            required=False,
+                            help="Maximum memory (MiB) of files read ahead, but not yet processed, in the pipeline (see '--prefetch').\nA larger file is read alone. [default: 1024]")
+    batchoptions.add_argument('--force',
+                            action="store_true",
+                            dest="force",
+                            required=False,
+                            help="Reprocess all files. By default, files whose results (for the same atlases and parameters) are\nalready in the output are skipped, such that batches may be extended or resumed. Files are\nfingerprinted by size and modification time (see '--hash').")
+    batchoptions.add_argument('--hash',
+                            action="store_true",
+                            dest="content_hash",
+                            required=False,
+                            help="Fingerprint files by their contents (SHA-1) rather than their size and modification time.")
+
+    # Server options
+    srvoptions = parser.add_argument_group('Server options')
+    srvoptions.add_argument('--serve',
+                            type=str,
+                            dest="serve",
+                            metavar="[HOST:]PORT",
+                            required=False,
+                            help="Start a resident ROI query server on some localhost address (e.g. 8700). Other hosts require\n'--allow-remote'.")
+    srvoptions.add_argument('--preload',
+                            type=str,
+                            nargs='+',
+                            dest="preload",
+                            metavar="ATLAS",
+                            default=[],
+                            required=False,
+                            help="Atlases to preload in the server, as atlas numbers (e.g. 3) or 'ATLAS.nii.gz,ATLAS.csv' pairs.\nThe '--atlas-num' and '--atlas'/'--atlas-info' atlases are also preloaded.")
+    srvoptions.add_argument('--allow-remote',
+                            dest="allow_remote",
+                            action="store_true",
+                            required=False,
+                            help="Allow '--serve' on hosts other than loopback addresses (e.g. '0.0.0.0:8700'). The server is not\nauthenticated, and reads any input file in its root directory (see '--serve-root').")
+    srvoptions.add_argument('--serve-root',
+                            type=str,
+                            dest="serve_root",
+                            metavar="DIR",
+                            default="",
+                            required=False,
+                            help="Directory of the input (and atlas) files that queries may name (preloaded atlases excepted).\n[default: current working directory]")
+    srvoptions.add_argument('--connect',
+                            type=str,
+                            dest="connect",
+                            metavar="[HOST:]PORT",
+                            required=False,
+                            help="Send the query to a running ROI query server instead of processing it in this process.")
+    srvoptions.add_argument('--coord',
+                            type=str,
+                            action='append',
+                            dest="coords",
+                            metavar="X,Y,Z",
+                            required=False,
+                            help="MNI space mm coordinates to query (with '--connect'). May be repeated, negative coordinates\nmust be given as '--coord=X,Y,Z'. ROIs are printed as JSON.")
 
     # Atlasquery options
     atlqoptions = parser.add_argument_group('Atlasquery options')
     atlqoptions.add_argument('--atlas-num',
                             type=int,
+                            nargs='+',
                             dest="atlas_num",
                             metavar="INT",
                             required=False,
-                            help="Atlas number. See '--dump-atlases' for details.")
+                            help="Atlas number(s). See '--dump-atlases' for details. Several atlases (including stand-alone atlases)\nare resolved against the same clusters, with one output column per atlas.")
+    atlqoptions.add_argument('--prob-cutoff',
+                            type=float,
+                            dest="prob_cutoff",
+                            metavar="PCT",
+                            default=None,
+                            required=False,
+                            help="Resolve probabilistic atlases over whole clusters (rather than at cluster peaks): ROIs whose mean\nmembership probability (%%) across all cluster voxels is at least PCT are reported, and the mean\nand max probability of each cluster and ROI are added to the cluster x ROI table ('--table').\nNot supported with '--slab' or '--sweep'.")
 
     # Stand-alone atlas options
     atlsoptions = parser.add_argument_group('Stand-alone atlas options')
     atlsoptions.add_argument('-a', '-atlas', '--atlas',
                             type=str,
+                            nargs='+',
                             dest="atlas",
                             metavar="ATLAS.nii.gz",
                             required=False,
-                            help="NIFTI atlas file.")
+                            help="NIFTI atlas file(s).")
     atlsoptions.add_argument('-info', '--atlas-info',
                             type=str,
+                            nargs='+',
                             dest="info",
                             metavar="ATLAS.info.csv",
                             required=False,
-                            help="Atlas information file.")
+                            help="Atlas information file(s) (one for each NIFTI atlas file, in the same order).")
+    atlsoptions.add_argument('--nearest',
+                            dest="nearest",
+                            required=False,
+                            action="store_true",
+                            help="Report the nearest labelled ROI (and its distance in mm) of cluster peaks in unlabelled (label 0)\nvoxels of stand-alone atlases: in the ROI lists (e.g. 'Precentral_L (nearest, 4.5 mm)'), and as rows\nwithout overlapping voxels in the cluster x ROI table ('Distance (mm)' column).")
 
     # Optional Arguments
     optoptions = parser.add_argument_group('Optional arguments')
@@ -589,13 +4643,71 @@ formatter_class=argparse.RawTextHelpFormatter)
                             default=0.95,
                             required=False,
                             help="Cluster threshold. [default: 0.95]")
+    optoptions.add_argument('--sweep',
+                            type=str,
+                            nargs='+',
+                            dest="sweep",
+                            metavar="THRESH",
+                            required=False,
+                            help="Identify ROIs at several thresholds (instead of '-t') in a single pass, given as values and/or\ninclusive START:STOP:STEP ranges (e.g. '--sweep 0.9 0.95 0.99 2:4:0.5'). One row is written\nper threshold, with a 'Threshold' column. Inputs are loaded into memory (i.e. '--slab' is ignored).")
     optoptions.add_argument('-d', '-dist', '--distance',
                             type=float,
                             dest="dist",
                             metavar="FLOAT",
                             default=0,
                             required=False,
-                            help="Minimum distance between clusters. [default: 0]")
+                            help="Minimum distance (in mm) between the local maxima of a cluster in the local maxima table\n('--olmax'). This does not affect the ROIs. [default: 0]")
+    optoptions.add_argument('-c', '--connectivity',
+                            type=int,
+                            dest="connectivity",
+                            metavar="INT",
+                            default=26,
+                            choices=[6,18,26],
+                            required=False,
+                            help="Voxel connectivity used to form clusters (6, 18, or 26). [default: 26]")
+    optoptions.add_argument('--slab',
+                            type=int,
+                            dest="slab",
+                            metavar="INT",
+                            default=0,
+                            required=False,
+                            help="Stream the input in z-slabs of INT slices, such that memory is bounded by the slab size.\n[default: 0, the whole input is loaded into memory]")
+    optoptions.add_argument('--table',
+                            type=str,
+                            dest="table_file",
+                            metavar="TABLE.tsv",
+                            default="",
+                            required=False,
+                            help="Also write the (long format) cluster x ROI table, with the size and peak of each cluster, and the\npercentage of each cluster in each ROI (and of each ROI covered by each cluster).\nFSL atlases report the ROIs at each cluster peak.")
+    optoptions.add_argument('--olmax',
+                            type=str,
+                            dest="olmax_file",
+                            metavar="PEAKS.tsv",
+                            default="",
+                            required=False,
+                            help="Also write the local maxima of each cluster (as FSL's `cluster --olmax`), at least '-d' mm apart\nwithin each cluster. The table may be labelled with '--coord-table'. Only supported with '-i'.")
+    optoptions.add_argument('--no-cache',
+                            dest="use_cache",
+                            required=False,
+                            action="store_false",
+                            help="Do not read from or write to the decoded atlas and cluster caches ($NIFTI_ROI_CACHE).")
+    optoptions.add_argument('--mem-report',
+                            dest="mem_report",
+                            required=False,
+                            action="store_true",
+                            help="Prints the peak memory of each processing stage.")
+    optoptions.add_argument('--profile',
+                            dest="profile",
+                            required=False,
+                            action="store_true",
+                            help="Prints the wall time, CPU time, peak RSS increase, bytes read/written and number of subprocesses\nof each processing stage.")
+    optoptions.add_argument('--profile-out',
+                            type=str,
+                            dest="profile_out",
+                            metavar="TRACE.json",
+                            default="",
+                            required=False,
+                            help="Also write the profile to a JSON file (Chrome trace event format). Implies '--profile'.")
     optoptions.add_argument('--dump-atlases',
                             dest="dump_atlases",
                             required=False,
@@ -612,15 +4724,140 @@ formatter_class=argparse.RawTextHelpFormatter)
         if err.code == 2:
             parser.print_help()
 
+    if args.mem_report:
+        start_mem_report()
+    
+    if args.profile or args.profile_out:
+        start_profile()
+    
+    exit_code = 0
+    
+    # Atlases (FSL atlases, then stand-alone atlases)
+    atlases = list(args.atlas_num or [])
+    
+    if args.atlas and args.info:
+        if len(args.atlas) != len(args.info):
+            print("")
+            print("The number of atlas files (-a) and atlas information files (-info) must match.")
+            print("")
+            sys.exit(1)
+        atlases.extend(zip(args.atlas,args.info))
+    
+    if args.prob_cutoff is not None and (args.slab or args.sweep or args.serve or args.connect or args.coord_table):
+        print("")
+        print("Cluster membership probabilities (--prob-cutoff) require whole clusters, and are not supported with '--slab', '--sweep',\nthe query server or '--coord-table'.")
+        print("")
+        sys.exit(1)
+    
+    if args.olmax_file and (args.batch or args.sweep or args.serve or args.connect or args.coord_table):
+        print("")
+        print("Local maxima tables (--olmax) are only supported for single input files (-i).")
+        print("")
+        sys.exit(1)
+    
+    if args.sweep and (args.batch or args.serve or args.connect):
+        print("")
+        print("Threshold sweeps (--sweep) are only supported for single input files (-i).")
+        print("")
+        sys.exit(1)
+    
     # Run
     if args.dump_atlases:
         print_atlases()
-    elif args.nii and args.out_file and args.atlas and args.info:
-        args.out_file = proc_vol(nii_file=args.nii,out_file=args.out_file,thresh=args.thresh,dist=args.dist,nii_atlas=args.atlas,atlas_info=args.info)
-    elif args.nii and args.out_file and args.atlas_num:
-        args.out_file = proc_vol(nii_file=args.nii,out_file=args.out_file,thresh=args.thresh,dist=args.dist,vol_atlas_num=args.atlas_num)
+    elif args.serve:
+        try:
+            server.parse_address(args.serve,args.allow_remote)
+        except ValueError as err:
+            print("")
+            print(f"{err}")
+            print("")
+            sys.exit(1)
+        preload = [parse_atlas_spec(spec) for spec in args.preload] + atlases
+        server.serve(args.serve,RoiServer(preload,args.use_cache,args.serve_root),args.allow_remote)
+    elif args.connect and (args.coords or (args.nii and args.out_file)):
+        request = {"atlases":[atlas if isinstance(atlas,int) else [os.path.abspath(atlas[0]),os.path.abspath(atlas[1])] for atlas in atlases or [3]],
+                   "thresh":args.thresh,
+                   "connectivity":args.connectivity,
+                   "slab":args.slab,
+                   "nearest":args.nearest}
+        try:
+            if args.coords:
+                request["coords"] = [[float(c) for c in coord.split(",")] for coord in args.coords]
+                response = server.query_server(args.connect,request)
+                [rois,dists] = [response["rois"],response.get("distances")]
+                # ROI lists of a single atlas are printed as such, those of several atlases by atlas name
+                if len(request["atlases"]) == 1:
+                    [rois,dists] = [list(rois.values())[0],list(dists.values())[0] if dists else None]
+                print(json.dumps({"rois":rois,"distances":dists} if args.nearest else rois))
+            else:
+                request["input"] = os.path.abspath(args.nii)
+                response = server.query_server(args.connect,request)
+                for vol in response.get("volumes",[{"volume":None,"rois":response.get("rois",dict())}]):
+                    if any(len(roi_list) != 0 for roi_list in vol["rois"].values()):
+                        args.out_file = write_spread(args.nii,args.out_file,vol["rois"],vol["volume"],args.thresh)
+        except (RuntimeError,OSError,ValueError) as err:
+            print("")
+            print(f"{err}")
+            print("")
+            sys.exit(1)
+    elif args.coord_table and args.out_file and atlases:
+        try:
+            args.out_file = proc_coords(coord_file=args.coord_table,out_file=args.out_file,atlases=atlases,use_cache=args.use_cache,nearest=args.nearest)
+        except ValueError as err:
+            print("")
+            print(f"{err}")
+            print("")
+            sys.exit(1)
+    elif args.batch and args.out_file and atlases:
+        nii_files = expand_inputs(args.batch)
+        try:
+            [args.out_file,n_failed,n_skipped] = proc_batch(nii_files=nii_files,out_file=args.out_file,thresh=args.thresh,dist=args.dist,connectivity=args.connectivity,use_cache=args.use_cache,n_procs=args.jobs,slab=args.slab,table_file=args.table_file,atlases=atlases,force=args.force,content_hash=args.content_hash,nearest=args.nearest,prefetch=args.prefetch,readers=args.readers,prefetch_mem=int(args.prefetch_mem*2**20),prob_cutoff=args.prob_cutoff)
+        except ValueError as err:
+            print("")
+            print(f"{err}")
+            print("")
+            sys.exit(1)
+        if args.prefetch:
+            print_pipeline_stats()
+        if n_skipped:
+            print(f"Skipped {n_skipped} unchanged file(s) already in {args.out_file} (see '--force').")
+        if n_failed:
+            print(f"{n_failed} of {len(nii_files)} file(s) failed. See the 'Error' column of {args.out_file} for details.")
+            exit_code = 1
+    elif args.sweep and args.nii and args.out_file and atlases:
+        try:
+            thresholds = parse_thresholds(args.sweep)
+        except ValueError as err:
+            print("")
+            print(f"Invalid threshold sweep (--sweep): {err}")
+            print("")
+            sys.exit(1)
+        try:
+            args.out_file = proc_sweep(nii_file=args.nii,out_file=args.out_file,thresholds=thresholds,dist=args.dist,connectivity=args.connectivity,use_cache=args.use_cache,table_file=args.table_file,atlases=atlases,nearest=args.nearest)
+        except ValueError as err:
+            print("")
+            print(f"{err}")
+            print("")
+            sys.exit(1)
+    elif args.nii and args.out_file and atlases:
+        try:
+            args.out_file = proc_vol(nii_file=args.nii,out_file=args.out_file,thresh=args.thresh,dist=args.dist,connectivity=args.connectivity,use_cache=args.use_cache,slab=args.slab,table_file=args.table_file,atlases=atlases,nearest=args.nearest,prob_cutoff=args.prob_cutoff,olmax_file=args.olmax_file)
+        except ValueError as err:
+            print("")
+            print(f"{err}")
+            print("")
+            sys.exit(1)
     else:
         print("")
         print("No valid options specified. Please see help menu for details.")
         print("")
         sys.exit(1)
+
+    if args.mem_report:
+        print_mem_report()
+    
+    if args.profile or args.profile_out:
+        print_profile(args.profile_out)
+    
+    if exit_code:
+        sys.exit(exit_code)
@@ -0,0 +1,7 @@
+'''
+Supporting modules of nifti_roi (the command line interface):
+
+- stores: Results stores (CSV, SQLite and Parquet outputs)
+- pipeline: Pipelined (threaded) batch execution
+- server: HTTP transport of the resident ROI query server (see nifti_roi.RoiServer), and its client
+'''
@@ -0,0 +1,31 @@
+'''
+Deferred (heavy) module imports, shared by nifti_roi and the roilib modules.
+'''
+
+# Import modules
+import importlib
+
+class LazyModule():
+    '''
+    Module placeholder that imports some module on first attribute access, and then replaces itself (i.e. the module
+    global of the same name) with the imported module. Heavy modules are thus only imported by the code paths that
+    use them, such that '--help', '--dump-atlases' and argument errors do not pay for their import time.
+    '''
+    
+    def __init__(self, module, name, namespace):
+        '''
+        Init doc-string for LazyModule class.
+        
+        Arguments:
+            module (str): Module to import (e.g. 'scipy.ndimage')
+            name (str): Module global name (e.g. 'ndimage')
+            namespace (dict): Module globals the placeholder is bound in (i.e. globals())
+        '''
+        self.module = module
+        self.name = name
+        self.namespace = namespace
+    
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.module)
+        self.namespace[self.name] = module
+        return getattr(module,attr)
@@ -0,0 +1,254 @@
+'''
+Pipelined (threaded) batch execution of nifti_roi, overlapping input reads with compute.
+'''
+
+# Import modules
+import threading
+import queue
+import time
+
+# Define classes
+
+class BatchPipeline():
+    '''
+    Pipelined (threaded) batch execution. Reader threads read (and decode) the next inputs ahead of the compute workers
+    through a bounded read-ahead queue, while compute worker threads process the current inputs and a single writer
+    (the calling thread, such that results stores need not be shared across threads) drains the results in input
+    order. The read-ahead is bounded both by its depth (number of queued inputs) and by the memory of the inputs that
+    are read but not yet processed, such that reading never runs away from compute. The busy (and waiting) time of
+    every stage is recorded, such that the overlap of I/O and compute is reported (see stats).
+    
+    Attributes:
+        n_readers: Number of reader threads
+        n_workers: Number of compute worker threads
+        depth: Maximum number of read-ahead (queued) inputs
+        max_bytes: Maximum memory (in bytes) of inputs that are read but not yet processed. An input larger than this is read alone.
+        intervals: List of (stage, start, end) busy intervals of every thread, for the 'read', 'compute' and 'write' stages
+        waits: Total time (in seconds) that readers waited for queue space or memory ('read'), that workers waited for
+               inputs ('compute') and that the writer waited for results ('write')
+        held: Memory (in bytes) of inputs that are read but not yet processed
+        peak_bytes: Peak memory (in bytes) of inputs that are read but not yet processed
+        peak_items: Peak number of queued inputs
+    '''
+    
+    def __init__(self, n_readers=2, n_workers=1, depth=2, max_bytes=1 << 30):
+        '''
+        Init doc-string for BatchPipeline class.
+        
+        Arguments:
+            n_readers (int): Number of reader threads
+            n_workers (int): Number of compute worker threads
+            depth (int): Maximum number of read-ahead (queued) inputs
+            max_bytes (int): Maximum memory (in bytes) of inputs that are read but not yet processed
+        '''
+        self.n_readers = max(int(n_readers),1)
+        self.n_workers = max(int(n_workers),1)
+        self.depth = max(int(depth),1)
+        self.max_bytes = int(max_bytes)
+        self.intervals = list()
+        self.waits = {"read":0.0, "compute":0.0, "write":0.0}
+        self.held = 0
+        self.peak_bytes = 0
+        self.peak_items = 0
+        self.errors = list()
+        self.budget = threading.Condition()
+        self.stop = threading.Event()
+        self.start = self.end = None
+    
+    def wait(self, stage, func, *args):
+        '''
+        Calls some (blocking) function, and adds its duration to the waiting time of some stage.
+        '''
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            with self.budget:
+                self.waits[stage] += time.perf_counter() - start
+    
+    def reserve(self, nbytes):
+        '''
+        Blocks until some input (of nbytes bytes) fits in the read-ahead memory, and then holds its memory (see release).
+        '''
+        with self.budget:
+            self.budget.wait_for(lambda: self.held == 0 or self.held + nbytes <= self.max_bytes)
+            self.held += nbytes
+            self.peak_bytes = max(self.peak_bytes,self.held)
+    
+    def release(self, nbytes):
+        '''
+        Releases the read-ahead memory of some (processed) input.
+        '''
+        with self.budget:
+            self.held -= nbytes
+            self.budget.notify_all()
+    
+    def read(self, todo, inputs, read_func, size_func):
+        '''
+        Reader thread: reads inputs (in input order) until none are left. Read errors are passed on to the compute
+        workers in place of the read input.
+        '''
+        while not self.stop.is_set():
+            try:
+                [seq,item] = todo.get_nowait()
+            except queue.Empty:
+                return
+            
+            try:
+                nbytes = int(size_func(item)) if size_func is not None else 0
+            except Exception:
+                nbytes = 0
+            
+            self.wait("read",self.reserve,nbytes)
+            
+            start = time.perf_counter()
+            try:
+                data = read_func(item)
+            except Exception as err:
+                data = err
+            self.intervals.append(("read",start,time.perf_counter()))
+            
+            self.wait("read",inputs.put,(seq,item,data,nbytes))
+            with self.budget:
+                self.peak_items = max(self.peak_items,inputs.qsize())
+    
+    def compute(self, inputs, results, compute_func):
+        '''
+        Compute worker thread: processes read inputs until the end of the inputs (None) is reached.
+        '''
+        while True:
+            task = self.wait("compute",inputs.get)
+            if task is None:
+                return
+            
+            [seq,item,data,nbytes] = task
+            result = None
+            
+            start = time.perf_counter()
+            try:
+                result = compute_func(item,data)
+            except Exception as err:
+                self.errors.append(err)
+            finally:
+                del data
+                self.release(nbytes)
+            self.intervals.append(("compute",start,time.perf_counter()))
+            
+            results.put((seq,result))
+    
+    def drain(self, results, n_items):
+        '''
+        Yields the results in input order (reordering results that are completed out of order). The time that the
+        consumer (i.e. the writer) spends on each result is recorded as busy time of the 'write' stage.
+        '''
+        pending = dict()
+        
+        for seq in range(n_items):
+            while seq not in pending:
+                [done,result] = self.wait("write",results.get)
+                pending[done] = result
+            
+            result = pending.pop(seq)
+            if result is None:
+                continue
+            
+            start = time.perf_counter()
+            yield result
+            self.intervals.append(("write",start,time.perf_counter()))
+    
+    def run(self, items, read_func, compute_func, write_func, size_func=None):
+        '''
+        Runs the pipeline over some inputs, writing results in this thread. Errors of the compute function or of the
+        writer are raised once all threads are done (inputs are no longer read after a writer error).
+        
+        Arguments:
+            items (list): Inputs
+            read_func (function): Reads some input (I/O stage)
+            compute_func (function): Processes some input, given the input and its read data (or read error)
+            write_func (function): Writes an iterable of results (in input order), and returns some value
+            size_func (function): Estimates the memory (in bytes) of some input once read. Memory is not bounded if not provided.
+        Returns:
+            written: Return value of the write function
+        '''
+        items = list(items)
+        todo = queue.Queue()
+        for seq,item in enumerate(items):
+            todo.put((seq,item))
+        
+        inputs = queue.Queue(maxsize=self.depth)
+        results = queue.Queue()
+        
+        self.start = time.perf_counter()
+        
+        readers = [threading.Thread(target=self.read,args=(todo,inputs,read_func,size_func),name=f"reader-{i}",daemon=True) for i in range(self.n_readers)]
+        workers = [threading.Thread(target=self.compute,args=(inputs,results,compute_func),name=f"worker-{i}",daemon=True) for i in range(self.n_workers)]
+        
+        for thread in readers + workers:
+            thread.start()
+        
+        try:
+            written = write_func(self.drain(results,len(items)))
+        finally:
+            self.stop.set()
+            for thread in readers:
+                thread.join()
+            for _ in workers:
+                inputs.put(None)
+            for thread in workers:
+                thread.join()
+            self.end = time.perf_counter()
+        
+        if self.errors:
+            raise self.errors[0]
+        
+        return written
+    
+    def active(self, stage):
+        '''
+        Returns the merged (sorted, non-overlapping) busy intervals of some stage, across all of its threads.
+        '''
+        merged = list()
+        for _,start,end in sorted(interval for interval in self.intervals if interval[0] == stage):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1],end)
+            else:
+                merged.append([start,end])
+        return merged
+    
+    def stats(self):
+        '''
+        Returns the pipeline metrics: the wall time, and the busy time (summed over threads), active time (during which
+        any thread of the stage is busy) and waiting time of each stage, along with the time during which reading and
+        compute overlap and the peak read-ahead (number of queued inputs and memory).
+        '''
+        stats = {"inputs":len([interval for interval in self.intervals if interval[0] == "read"]),
+                 "readers":self.n_readers,
+                 "workers":self.n_workers,
+                 "depth":self.depth,
+                 "max_bytes":self.max_bytes,
+                 "wall":(self.end or time.perf_counter()) - (self.start or time.perf_counter()),
+                 "peak_items":self.peak_items,
+                 "peak_bytes":self.peak_bytes}
+        
+        active = dict()
+        for stage in ["read","compute","write"]:
+            active[stage] = self.active(stage)
+            stats[stage] = {"busy":sum(end - start for name,start,end in self.intervals if name == stage),
+                            "active":sum(end - start for start,end in active[stage]),
+                            "wait":self.waits[stage]}
+        
+        # Time during which some input is read while another is processed
+        overlap = 0.0
+        [i,j] = [0,0]
+        [read,compute] = [active["read"],active["compute"]]
+        while i < len(read) and j < len(compute):
+            overlap += max(min(read[i][1],compute[j][1]) - max(read[i][0],compute[j][0]),0.0)
+            if read[i][1] < compute[j][1]:
+                i += 1
+            else:
+                j += 1
+        
+        stats["overlap"] = overlap
+        stats["hidden"] = overlap/stats["read"]["active"] if stats["read"]["active"] > 0 else 0.0
+        
+        return stats
@@ -0,0 +1,168 @@
+'''
+HTTP transport of the resident ROI query server (see serve) and its client (see query_server). Queries are answered
+by some query object (e.g. nifti_roi.RoiServer), such that this module does not depend on nifti_roi.
+'''
+
+# Import modules
+import sys
+import json
+import time
+import socket
+import ipaddress
+import http.server
+import urllib.request
+import urllib.error
+
+# Define classes and functions
+
+def is_loopback(host):
+    '''
+    Determines whether some host (name or address) is a loopback address.
+    
+    Arguments:
+        host(str): Host name or address
+    Returns:
+        loopback(bool): True if the host resolves to a loopback address
+    '''
+    
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError,ValueError):
+        return False
+
+def parse_address(address,allow_remote=False):
+    '''
+    Parses some server address string. Only loopback hosts are accepted, unless remote hosts are explicitly allowed,
+    as the server reads the files named in its queries.
+    
+    Arguments:
+        address(str): Server address, as 'HOST:PORT' or 'PORT' (the host defaults to 127.0.0.1)
+        allow_remote(bool): Accept hosts other than loopback addresses (e.g. '0.0.0.0')
+    Returns:
+        host(str): Server host
+        port(int): Server port
+    '''
+    
+    [host,_,port] = address.rpartition(":")
+    host = host or "127.0.0.1"
+    
+    if not port.isdigit():
+        raise ValueError(f"Invalid server address: {address}. Expected '[HOST:]PORT'.")
+    
+    if not allow_remote and not is_loopback(host):
+        raise ValueError(f"Refusing to serve on {host}, which is not a loopback address. Use '--allow-remote' to serve on other hosts.")
+    
+    return host,int(port)
+
+class RoiRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    HTTP request handler for the ROI query server (see serve). Queries are JSON POST requests to '/query',
+    and the loaded atlases are listed by GET requests to '/atlases'.
+    '''
+    
+    def send_json(self, code, response):
+        '''
+        Sends some JSON response.
+        '''
+        body = json.dumps(response).encode()
+        self.send_response(code)
+        self.send_header("Content-Type","application/json")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def do_GET(self):
+        '''
+        Lists the loaded atlases.
+        '''
+        roi_server = self.server.roi_server
+        if self.path.rstrip("/") == "/atlases":
+            self.send_json(200,{"atlases":[list(key) for key in roi_server.atlases],
+                                "fsl_atlases":roi_server.fsl_atlases})
+        else:
+            self.send_json(404,{"error":f"Unknown path: {self.path}"})
+    
+    def do_POST(self):
+        '''
+        Performs some ROI query, and logs its latency.
+        '''
+        start = time.perf_counter()
+        
+        if self.path.rstrip("/") != "/query":
+            self.send_json(404,{"error":f"Unknown path: {self.path}"})
+            return
+        
+        request = dict()
+        
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length",0))) or b"{}")
+            response = self.server.roi_server.query(request)
+            code = 200
+        except Exception as err:
+            response = {"error":f"{type(err).__name__}: {err}"}
+            code = 400
+        
+        response["elapsed_ms"] = (time.perf_counter() - start)*1000
+        self.send_json(code,response)
+        
+        target = request.get("input") or f"{len(request.get('coords') or [])} coordinate(s)"
+        print(f"{self.log_date_time_string()} {code} {target} {response['elapsed_ms']:.1f} ms",file=sys.stderr,flush=True)
+    
+    def log_message(self, format, *args):
+        '''
+        Suppresses the default request logging (queries are logged with their latency instead).
+        '''
+        pass
+
+def serve(address,roi_server,allow_remote=False):
+    '''
+    Starts the (blocking) resident ROI query server on some (by default, loopback) address.
+    
+    Arguments:
+        address(str): Server address, as 'HOST:PORT' or 'PORT'
+        roi_server(object): Query object, with a 'query' method (request to response dictionaries) and the loaded
+                            'atlases' and 'fsl_atlases' (e.g. nifti_roi.RoiServer)
+        allow_remote(bool): Serve on hosts other than loopback addresses
+    '''
+    
+    httpd = http.server.ThreadingHTTPServer(parse_address(address,allow_remote),RoiRequestHandler)
+    httpd.roi_server = roi_server
+    
+    print(f"Serving ROI queries on http://{httpd.server_address[0]}:{httpd.server_address[1]}/query",file=sys.stderr,flush=True)
+    
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+def query_server(address,request,timeout=None):
+    '''
+    Sends some ROI query to a running ROI query server (see serve).
+    
+    Arguments:
+        address(str): Server address, as 'HOST:PORT' or 'PORT'
+        request(dict): Query request (see nifti_roi.RoiServer.query)
+        timeout(float): Request timeout (in seconds)
+    Returns:
+        response(dict): Query response
+    '''
+    
+    [host,_,port] = address.rpartition(":")
+    host = host or "127.0.0.1"
+    
+    req = urllib.request.Request(f"http://{host}:{port}/query",
+                                 data=json.dumps(request).encode(),
+                                 headers={"Content-Type":"application/json"})
+    
+    try:
+        with urllib.request.urlopen(req,timeout=timeout) as resp:
+            response = json.loads(resp.read())
+    except urllib.error.HTTPError as err:
+        response = json.loads(err.read())
+    
+    if "error" in response:
+        raise RuntimeError(f"ROI query server error: {response['error']}")
+    
+    return response
@@ -0,0 +1,539 @@
+'''
+Results stores, i.e. the output backends of nifti_roi (by output file extension): append-only CSV files (with a
+write-ahead journal), SQLite databases and Parquet datasets.
+'''
+
+# Import modules
+import os
+import csv
+import fcntl
+import glob
+import uuid
+import time
+import contextlib
+
+from roilib.lazy import LazyModule
+
+# Deferred (heavy) module imports
+pd = LazyModule("pandas","pd",globals())
+sqlite3 = LazyModule("sqlite3","sqlite3",globals())
+
+# Define classes and functions
+
+def csv_name(out_file):
+    '''
+    Constructs the output CSV file name from some output file name (i.e. replaces .tsv/.txt extensions or appends .csv).
+    
+    Arguments:
+        out_file (file): Output file name
+    Returns:
+        out_file (csv file): Output csv file name
+    '''
+    
+    # Strip csv file extension from output file name
+    if '.csv' in out_file:
+        out_file = os.path.splitext(out_file)[0]
+        out_file = out_file + '.csv'
+    elif '.tsv' in out_file:
+        out_file = os.path.splitext(out_file)[0]
+        out_file = out_file + '.csv'
+    elif '.txt' in out_file:
+        out_file = os.path.splitext(out_file)[0]
+        out_file = out_file + '.csv'
+    else:
+        out_file = out_file + '.csv'
+    
+    return out_file
+
+def table_records(table,atlas=""):
+    '''
+    Converts some (combined) cluster x ROI table into database records, grouped by atlas.
+    
+    Arguments:
+        table(DataFrame): Cluster x ROI table (see overlap_table, peak_table and atlas_table)
+        atlas(str): Atlas name of tables without an 'Atlas' column
+    Returns:
+        records(dict): Dictionary of atlas names to lists of (cluster index, cluster voxels, peak, peak X, peak Y, peak Z,
+                       label, ROI, voxels, % cluster, % ROI) tuples (with None for empty values)
+    '''
+    
+    records = dict()
+    
+    if table is None or len(table) == 0:
+        return records
+    
+    peak_cols = [col for col in table.columns if col.startswith("MAX")]
+    cols = ["Cluster Index","Cluster Voxels"] + peak_cols + ["Label","ROI","Voxels","% Cluster","% ROI"]
+    atlases = table["Atlas"].tolist() if "Atlas" in table.columns else [atlas]*len(table)
+    
+    for name,row in zip(atlases,table[cols].astype(object).itertuples(index=False,name=None)):
+        row = tuple(None if pd.isna(val) else val.item() if hasattr(val,"item") else val for val in row)
+        records.setdefault(name,[]).append(row)
+    
+    return records
+
+class CsvStore():
+    '''
+    CSV results store (the default output backend). One row is written for each input file (or volume of 4D input
+    files, or threshold of threshold sweeps), with one (stringified) ROI list column per atlas and an error column.
+    New CSV outputs have the same columns ('File', 'Volume', 'Threshold', the ROI column(s) and 'Error'), whichever
+    mode writes them. Rows are also appended to CSV files of earlier versions ('File' and the ROI column(s) only), in
+    their own layout (i.e. without the volume, threshold and error of each row, and without the rows of failed files).
+    Rows are never appended to CSV files with other columns.
+    
+    Each write is also recorded (with the fingerprint of the written file, see input_fingerprint) in a '.fingerprints'
+    journal alongside the output file, along with the size of the output file once its rows were written. Rows written
+    after the last journal entry (i.e. by an interrupted run) are removed when the store is reopened. The store holds
+    an exclusive lock ('.lock' file) on the output file while it is open, such that several processes writing to
+    the same output file take turns, rather than removing (or overwriting) each other's rows.
+    
+    Attributes:
+        out_file: Output CSV file
+        columns: ROI column names (one per atlas)
+        legacy: Whether rows are appended in the layout of earlier versions ('File' and the ROI column(s) only)
+        params: Clustering parameters (the threshold of each row, unless given)
+        journal_file: Fingerprint journal file
+        fingerprints: Fingerprints of the files successfully written to the output file
+    '''
+    
+    def __init__(self, out_file, atlases=None, params=None):
+        '''
+        Init doc-string for CsvStore class.
+        
+        Arguments:
+            out_file (file): Output CSV file name and path. This file need not exist at runtime.
+            atlases (list): Atlas names (one per ROI list of each written row)
+            params (dict): Clustering parameters ('thresh', 'dist' and 'connectivity')
+        '''
+        atlases = atlases or ["ROIs"]
+        
+        self.out_file = csv_name(out_file)
+        self.columns = ["ROIs"] if len(atlases) == 1 else list(atlases)
+        self.params = params or dict()
+        self.journal_file = self.out_file + ".fingerprints"
+        self.fingerprints = set()
+        self.legacy = False
+        
+        # Exclusive lock for the lifetime of the store (released by close)
+        self.lock = open(self.out_file + ".lock","a")
+        fcntl.flock(self.lock,fcntl.LOCK_EX)
+        
+        try:
+            header = ["File","Volume","Threshold"] + self.columns + ["Error"]
+            
+            # Rows are only appended under the header of this layout, or of the layout of earlier versions
+            if os.path.exists(self.out_file) and os.path.getsize(self.out_file) > 0:
+                with open(self.out_file,"r",newline="") as f:
+                    columns = next(csv.reader(f),[])
+                if columns == ["File"] + self.columns:
+                    self.legacy = True
+                elif columns != header:
+                    raise ValueError(f"The output file {self.out_file} has the columns {columns}, rather than {header}. Please use a new output file.")
+            
+            self.recover()
+            
+            new_file = not os.path.exists(self.out_file) or os.path.getsize(self.out_file) == 0
+            
+            self.file = open(self.out_file,"a",newline="")
+            self.writer = csv.writer(self.file,lineterminator="\n")
+            self.journal = open(self.journal_file,"a")
+            
+            if new_file:
+                self.writer.writerow(header)
+                self.file.flush()
+        except Exception:
+            self.lock.close()
+            raise
+    
+    def recover(self):
+        '''
+        Reads the fingerprint journal, and removes any (partially) written rows of an interrupted run from the output
+        file (and any partially written journal entry). As the store holds the lock of the output file, such rows
+        cannot belong to another (running) writer.
+        '''
+        if not os.path.exists(self.journal_file):
+            return
+        
+        with open(self.journal_file,"r") as f:
+            lines = f.readlines()
+        
+        # Complete entries only
+        entries = [line.rstrip("\n").split("\t") for line in lines if line.endswith("\n")]
+        entries = [entry for entry in entries if len(entry) == 3 and entry[2].isdigit()]
+        
+        if len(entries) != len(lines):
+            with open(self.journal_file,"w") as f:
+                f.writelines("\t".join(entry) + "\n" for entry in entries)
+        
+        self.fingerprints = {entry[0] for entry in entries if entry[0]}
+        
+        if entries and os.path.exists(self.out_file) and os.path.getsize(self.out_file) > int(entries[-1][2]):
+            os.truncate(self.out_file,int(entries[-1][2]))
+    
+    def done(self):
+        '''
+        Returns the fingerprints of the files successfully written to the output file.
+        '''
+        return self.fingerprints
+    
+    def drop(self, files):
+        '''
+        Removes the rows of some files from the output file, along with their journal entries, such that files that
+        are processed again replace their previous rows (as in SqliteStore) rather than being appended twice. The
+        journal offsets of the remaining entries are rebuilt from the rewritten rows.
+        
+        Arguments:
+            files (list): Input files
+        '''
+        files = {os.path.abspath(file) for file in files}
+        
+        self.file.flush()
+        
+        with open(self.out_file,"r",newline="") as f:
+            rows = list(csv.reader(f))
+        with open(self.journal_file,"r") as f:
+            entries = [line.rstrip("\n").split("\t") for line in f]
+        
+        if not any(row and row[0] in files for row in rows[1:]) and not any(entry[1] in files for entry in entries):
+            return
+        
+        self.file.close()
+        self.journal.close()
+        
+        # End offset of the last (remaining) row of each file
+        ends = dict()
+        
+        with open(self.out_file + ".tmp","w",newline="") as f:
+            writer = csv.writer(f,lineterminator="\n")
+            writer.writerow(rows[0])
+            header_end = f.tell()
+            for row in rows[1:]:
+                if row and row[0] not in files:
+                    writer.writerow(row)
+                    ends[row[0]] = f.tell()
+            end = f.tell()
+        
+        # Journal entries follow the order of their rows (entries without rows, e.g. failed files of earlier layouts,
+        # end where the previous entry ended)
+        kept = list()
+        start = header_end
+        
+        for fingerprint,file,_ in entries:
+            if file not in files:
+                start = max(start,ends.get(file,start))
+                kept.append((fingerprint,file,min(start,end)))
+        
+        with open(self.journal_file + ".tmp","w") as f:
+            f.writelines(f"{fingerprint}\t{file}\t{end}\n" for fingerprint,file,end in kept)
+        
+        os.replace(self.out_file + ".tmp",self.out_file)
+        os.replace(self.journal_file + ".tmp",self.journal_file)
+        
+        self.fingerprints = {fingerprint for fingerprint,_,_ in kept if fingerprint}
+        
+        self.file = open(self.out_file,"a",newline="")
+        self.writer = csv.writer(self.file,lineterminator="\n")
+        self.journal = open(self.journal_file,"a")
+    
+    def write(self, rows, tables=None, fingerprint="", thresh=None):
+        '''
+        Writes the results of some input file, then records them in the fingerprint journal.
+        
+        Arguments:
+            rows (list): List of (file, volume, roi_lists, error) rows (with one ROI list per atlas)
+            tables (list): List of (volume, cluster x ROI table) tuples (unused)
+            fingerprint (str): Input file fingerprint (see input_fingerprint). Not recorded for failed files.
+            thresh (float): Threshold of the rows (e.g. of threshold sweeps), rather than that of the clustering parameters
+        '''
+        thresh = self.params.get("thresh") if thresh is None else thresh
+        
+        for file,volume,roi_lists,error in rows:
+            if not self.legacy:
+                self.writer.writerow([os.path.abspath(file),"" if volume is None else volume,"" if thresh is None else thresh] + list(roi_lists) + [error])
+            elif not error:
+                self.writer.writerow([os.path.abspath(file)] + list(roi_lists))
+        self.file.flush()
+        
+        if any(error for _,_,_,error in rows):
+            fingerprint = ""
+        
+        # The journal records the size of the output file (rather than the position of this writer)
+        self.journal.write(f"{fingerprint}\t{os.path.abspath(rows[0][0])}\t{os.fstat(self.file.fileno()).st_size}\n")
+        self.journal.flush()
+        
+        if fingerprint:
+            self.fingerprints.add(fingerprint)
+    
+    def close(self):
+        '''
+        Closes the output file, and releases its lock.
+        '''
+        self.file.close()
+        self.journal.close()
+        self.lock.close()
+
+class SqliteStore():
+    '''
+    SQLite results store. Each input file (volume and atlas) is recorded in a 'runs' table, along with the clustering
+    parameters and any error. Each overlapping cluster and ROI is recorded in a 'rois' table, one row per file,
+    cluster and ROI. Both tables are indexed (by file and parameters, and by ROI). The results of each input file
+    are inserted in a single transaction (along with their fingerprint, see input_fingerprint), and rerunning a file
+    with the same threshold and connectivity replaces its previous results (the recorded 'dist' does not affect the
+    ROIs). Concurrent writers (e.g. cluster jobs that share a
+    database) are serialized by SQLite's database lock.
+    
+    Attributes:
+        out_file: SQLite database file
+        atlases: Atlas names (one per ROI list of each written row)
+        params: Clustering parameters ('thresh', 'dist' and 'connectivity')
+    '''
+    
+    schema = [
+        """CREATE TABLE IF NOT EXISTS runs (
+               id INTEGER PRIMARY KEY,
+               file TEXT NOT NULL,
+               volume INTEGER,
+               atlas TEXT NOT NULL,
+               thresh REAL,
+               dist REAL,
+               connectivity INTEGER,
+               error TEXT,
+               created REAL,
+               fingerprint TEXT)""",
+        """CREATE TABLE IF NOT EXISTS rois (
+               run INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+               cluster INTEGER,
+               cluster_voxels INTEGER,
+               peak REAL,
+               peak_x REAL,
+               peak_y REAL,
+               peak_z REAL,
+               label INTEGER,
+               roi TEXT,
+               voxels INTEGER,
+               pct_cluster REAL,
+               pct_roi REAL)""",
+        "CREATE INDEX IF NOT EXISTS runs_file ON runs (file, atlas, thresh, dist, connectivity)",
+        "CREATE INDEX IF NOT EXISTS runs_fingerprint ON runs (fingerprint)",
+        "CREATE INDEX IF NOT EXISTS rois_run ON rois (run)",
+        "CREATE INDEX IF NOT EXISTS rois_roi ON rois (roi)"]
+    
+    def __init__(self, out_file, atlases=None, params=None, timeout=600):
+        '''
+        Init doc-string for SqliteStore class.
+        
+        Arguments:
+            out_file (file): SQLite database file. This file need not exist at runtime.
+            atlases (list): Atlas names (one per ROI list of each written row)
+            params (dict): Clustering parameters ('thresh', 'dist' and 'connectivity')
+            timeout (float): Time (in seconds) to wait for other writers to release the database lock
+        '''
+        params = params or dict()
+        
+        self.out_file = out_file
+        self.atlases = list(atlases or ["ROIs"])
+        self.params = [params.get("thresh"),params.get("dist"),params.get("connectivity")]
+        
+        # Transactions are explicit (see transaction)
+        self.conn = sqlite3.connect(out_file,timeout=timeout,isolation_level=None)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        
+        with self.transaction():
+            self.conn.execute(self.schema[0])
+            # Databases written before fingerprints were recorded
+            if "fingerprint" not in [row[1] for row in self.conn.execute("PRAGMA table_info(runs)")]:
+                self.conn.execute("ALTER TABLE runs ADD COLUMN fingerprint TEXT")
+            for statement in self.schema[1:]:
+                self.conn.execute(statement)
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Runs some statements in a single (immediate, i.e. write-locked) transaction, which is rolled back on error.
+        '''
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+    
+    def done(self):
+        '''
+        Returns the fingerprints of the files successfully written to the database.
+        '''
+        return {row[0] for row in self.conn.execute("SELECT DISTINCT fingerprint FROM runs WHERE fingerprint IS NOT NULL AND (error IS NULL OR error = '')")}
+    
+    def write(self, rows, tables=None, fingerprint="", thresh=None):
+        '''
+        Writes the results of some input file (in a single transaction).
+        
+        Arguments:
+            rows (list): List of (file, volume, roi_lists, error) rows (with one ROI list per atlas)
+            tables (list): List of (volume, cluster x ROI table) tuples (see atlas_table)
+            fingerprint (str): Input file fingerprint (see input_fingerprint)
+            thresh (float): Threshold of the rows (e.g. of threshold sweeps), rather than that of the clustering parameters
+        '''
+        params = self.params if thresh is None else [thresh] + self.params[1:]
+        
+        rois = dict()
+        for volume,roi_table in tables or []:
+            for atlas,table_rows in table_records(roi_table,self.atlases[0]).items():
+                rois[(volume,atlas)] = table_rows
+        
+        created = time.time()
+        
+        with self.transaction():
+            for file,volume,roi_lists,error in rows:
+                file = os.path.abspath(file)
+                for atlas in self.atlases:
+                    self.conn.execute("DELETE FROM runs WHERE file = ? AND volume IS ? AND atlas = ? AND thresh IS ? AND connectivity IS ?",
+                                      [file,volume,atlas,params[0],params[2]])
+                    run_id = self.conn.execute("INSERT INTO runs (file, volume, atlas, thresh, dist, connectivity, error, created, fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                               [file,volume,atlas] + params + [error,created,fingerprint or None]).lastrowid
+                    self.conn.executemany("INSERT INTO rois VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                          [(run_id,) + row for row in rois.get((volume,atlas),[])])
+    
+    def close(self):
+        '''
+        Closes the database connection.
+        '''
+        self.conn.close()
+
+class ParquetStore():
+    '''
+    Parquet results store (for analytics), written as a Parquet dataset directory with one part file per writer, such
+    that concurrent writers never share a file. Each part file has one row per input file, cluster and ROI (or a single
+    row without ROIs for input files without overlapping clusters), with the clustering parameters and any error.
+    Rerunning some file appends new rows (i.e. readers should keep the latest 'Created' rows of each file).
+    Part files are written every 'flush_files' input files, such that interrupted runs keep their completed files.
+    Requires pyarrow (or fastparquet).
+    
+    Attributes:
+        out_file: Parquet dataset directory
+        atlases: Atlas names (one per ROI list of each written row)
+        params: Clustering parameters ('thresh', 'dist' and 'connectivity')
+        flush_files: Number of input files per part file
+    '''
+    
+    columns = ["Cluster Index","Cluster Voxels","MAX","MAX X","MAX Y","MAX Z","Label","ROI","Voxels","% Cluster","% ROI"]
+    
+    # Column types of every part file (such that part files without ROIs, or without errors, share the dataset schema)
+    dtypes = {"File":"string","Volume":"Int64","Atlas":"string","Thresh":"float64","Dist":"float64","Connectivity":"Int64",
+              "Error":"string","Created":"float64","Fingerprint":"string","Cluster Index":"Int64","Cluster Voxels":"Int64",
+              "MAX":"float64","MAX X":"float64","MAX Y":"float64","MAX Z":"float64","Label":"Int64","ROI":"string",
+              "Voxels":"Int64","% Cluster":"float64","% ROI":"float64"}
+    
+    def __init__(self, out_file, atlases=None, params=None, flush_files=256):
+        '''
+        Init doc-string for ParquetStore class.
+        
+        Arguments:
+            out_file (file): Parquet dataset directory. This directory need not exist at runtime.
+            atlases (list): Atlas names (one per ROI list of each written row)
+            params (dict): Clustering parameters ('thresh', 'dist' and 'connectivity')
+            flush_files (int): Number of input files per part file
+        '''
+        self.out_file = out_file
+        self.atlases = list(atlases or ["ROIs"])
+        self.params = params or dict()
+        self.flush_files = flush_files
+        self.records = list()
+        self.n_files = 0
+    
+    def done(self):
+        '''
+        Returns the fingerprints of the files successfully written to the dataset.
+        '''
+        fingerprints = set()
+        
+        for part in glob.glob(os.path.join(glob.escape(self.out_file),"part-*.parquet")):
+            try:
+                df = pd.read_parquet(part,columns=["Fingerprint","Error"])
+            except (KeyError,ValueError):
+                continue
+            fingerprints.update(df["Fingerprint"][df["Fingerprint"].notna() & (df["Error"].fillna("") == "")])
+        
+        return fingerprints
+    
+    def write(self, rows, tables=None, fingerprint="", thresh=None):
+        '''
+        Adds the results of some input file (written every 'flush_files' files, and on close).
+        
+        Arguments:
+            rows (list): List of (file, volume, roi_lists, error) rows (with one ROI list per atlas)
+            tables (list): List of (volume, cluster x ROI table) tuples (see atlas_table)
+            fingerprint (str): Input file fingerprint (see input_fingerprint)
+            thresh (float): Threshold of the rows (e.g. of threshold sweeps), rather than that of the clustering parameters
+        '''
+        rois = dict()
+        for volume,roi_table in tables or []:
+            for atlas,table_rows in table_records(roi_table,self.atlases[0]).items():
+                rois[(volume,atlas)] = table_rows
+        
+        created = time.time()
+        
+        for file,volume,roi_lists,error in rows:
+            for atlas in self.atlases:
+                run = {"File":os.path.abspath(file),
+                       "Volume":volume,
+                       "Atlas":atlas,
+                       "Thresh":self.params.get("thresh") if thresh is None else thresh,
+                       "Dist":self.params.get("dist"),
+                       "Connectivity":self.params.get("connectivity"),
+                       "Error":error,
+                       "Created":created,
+                       "Fingerprint":fingerprint or None}
+                for row in rois.get((volume,atlas)) or [(None,)*len(self.columns)]:
+                    self.records.append(dict(run,**dict(zip(self.columns,row))))
+        
+        self.n_files += 1
+        if self.n_files % self.flush_files == 0:
+            self.flush()
+    
+    def flush(self):
+        '''
+        Writes (atomically) the pending rows of this writer to a new part file.
+        '''
+        if len(self.records) == 0:
+            return
+        
+        os.makedirs(self.out_file,exist_ok=True)
+        
+        part = os.path.join(self.out_file,f"part-{int(time.time())}-{os.getpid()}-{uuid.uuid4().hex[:8]}.parquet")
+        df = pd.DataFrame.from_records(self.records).astype(self.dtypes)
+        
+        try:
+            df.to_parquet(part + ".tmp",index=False)
+        except ImportError as err:
+            raise ImportError(f"Parquet output requires pyarrow (or fastparquet): {err}")
+        
+        os.replace(part + ".tmp",part)
+        self.records = list()
+    
+    def close(self):
+        '''
+        Writes the pending rows of this writer.
+        '''
+        self.flush()
+
+# Output backends (by output file extension, CSV otherwise)
+store_backends = {".db": SqliteStore,
+                  ".sqlite": SqliteStore,
+                  ".sqlite3": SqliteStore,
+                  ".parquet": ParquetStore}
+
+def store_backend(out_file):
+    '''
+    Finds the output backend of some output file (see store_backends), by its extension.
+    
+    Arguments:
+        out_file(file): Output file
+    Returns:
+        backend(class): Output backend class (CsvStore for unknown extensions)
+    '''
+    
+    backend = store_backends.get(os.path.splitext(out_file.rstrip(os.sep))[1].lower(),CsvStore)
+    
+    return backend
@@ -0,0 +1,29 @@
+'''
+Shared pytest configuration: nifti_roi (and roilib) are imported from the repository root, and the decoded atlas
+and cluster caches are kept in a temporary directory. Also provides the stat maps shared by the clustering tests.
+'''
+
+# Import modules
+import os
+import sys
+import tempfile
+
+import numpy as np
+from scipy import ndimage
+
+# Define global variable(s)
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+sys.path.insert(0,repo_dir)
+os.environ.setdefault("NIFTI_ROI_CACHE",tempfile.mkdtemp(prefix="nifti_roi.cache."))
+
+# Define functions
+
+def make_stat(shape=(24,20,18),seed=0):
+    '''
+    Returns some smooth random (statistical) image data, with clusters of many sizes.
+    '''
+    rng = np.random.default_rng(seed)
+    data = ndimage.gaussian_filter(rng.standard_normal(shape),1.2)
+    
+    return (data/data.std()).astype(np.float32)
@@ -0,0 +1,96 @@
+'''
+Tests of the decoded atlas cache: atlas decoding (decode_atlas), cached labels (load_atlas_vol) that are keyed by the
+atlas contents, header and affine, and the cache size cap (evict_cache).
+'''
+
+# Import modules
+import os
+import time
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import nifti_roi
+
+# Define functions
+
+@pytest.fixture
+def cache(tmp_path,monkeypatch):
+    '''
+    Keeps the atlas cache in the test directory.
+    '''
+    monkeypatch.setattr(nifti_roi,"cache_dir",str(tmp_path / "cache"))
+    return str(tmp_path / "cache")
+
+def test_decode_atlas_scaled_int16(tmp_path):
+    '''
+    Scaled integer labels spanning (nearly) the whole int16 range are decoded without overflow.
+    '''
+    raw = np.array([-30000,0,100,5000],dtype=np.int16).reshape(2,2,1)
+    img = nib.Nifti1Image(raw,np.eye(4))
+    img.header.set_slope_inter(2,1)
+    nib.save(img,tmp_path / "atlas.nii.gz")
+    
+    atlas_data = nifti_roi.decode_atlas(str(tmp_path / "atlas.nii.gz"))
+    
+    assert atlas_data.ravel().tolist() == [-59999,1,201,10001]
+    assert np.issubdtype(atlas_data.dtype,np.integer)
+
+def test_decode_atlas_float_labels(tmp_path):
+    '''
+    Float labels are rounded to their nearest integer label.
+    '''
+    raw = np.array([0,0.9999,2.0001,3],dtype=np.float32).reshape(2,2,1)
+    nib.save(nib.Nifti1Image(raw,np.eye(4)),tmp_path / "atlas.nii.gz")
+    
+    atlas_data = nifti_roi.decode_atlas(str(tmp_path / "atlas.nii.gz"))
+    
+    assert atlas_data.ravel().tolist() == [0,1,2,3]
+    assert atlas_data.dtype == np.uint8
+
+def test_atlas_cache(tmp_path,cache,monkeypatch):
+    '''
+    Decoded labels are memory-mapped from the cache, rather than decoded again, until the atlas changes.
+    '''
+    data = np.random.default_rng(0).integers(0,50,(12,10,8)).astype(np.int16)
+    nib.save(nib.Nifti1Image(data,np.eye(4)),tmp_path / "atlas.nii.gz")
+    nii_atlas = str(tmp_path / "atlas.nii.gz")
+    
+    atlas_data = nifti_roi.load_atlas_vol(nii_atlas)
+    
+    assert np.array_equal(atlas_data,data)
+    assert len(os.listdir(cache)) == 1
+    
+    decode_atlas = nifti_roi.decode_atlas
+    monkeypatch.setattr(nifti_roi,"decode_atlas",lambda *args,**kwargs: pytest.fail("the cached atlas was decoded again"))
+    atlas_data = nifti_roi.load_atlas_vol(nii_atlas)
+    
+    assert isinstance(atlas_data,np.memmap) and not atlas_data.flags.writeable
+    assert np.array_equal(atlas_data,data)
+    
+    # Other affines (or labels) are other cache entries
+    monkeypatch.setattr(nifti_roi,"decode_atlas",decode_atlas)
+    key = nifti_roi.atlas_cache_key(nii_atlas)
+    nib.save(nib.Nifti1Image(data,np.diag([2.0,2.0,2.0,1.0])),tmp_path / "atlas.nii.gz")
+    
+    assert nifti_roi.atlas_cache_key(nii_atlas) != key
+    assert np.array_equal(nifti_roi.load_atlas_vol(nii_atlas),data)
+    assert len(os.listdir(cache)) == 2
+
+def test_evict_cache(cache):
+    '''
+    The least recently used cache files are removed until the cache is within its size cap.
+    '''
+    os.makedirs(cache)
+    for i,name in enumerate(["a","b","c","d"]):
+        with open(os.path.join(cache,name + ".npy"),"wb") as f:
+            f.write(bytes(100))
+        os.utime(os.path.join(cache,name + ".npy"),(time.time() - 100 + i,)*2)
+    
+    # Reading 'a' marks it as recently used
+    nifti_roi.touch_cache(os.path.join(cache,"a.npy"))
+    removed = nifti_roi.evict_cache(250,keep=os.path.join(cache,"b.npy"))
+    
+    assert sorted(os.path.basename(file) for file in removed) == ["c.npy","d.npy"]
+    assert sorted(os.listdir(cache)) == ["a.npy","b.npy"]
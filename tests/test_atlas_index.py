@@ -0,0 +1,126 @@
+'''
+Tests of the atlas spatial index (AtlasIndex): its label statistics and block grid, nearest labelled regions (block
+rings and label boundaries) against a brute force search, the cached index, and the nearest ROIs of unlabelled peaks.
+'''
+
+# Import modules
+import numpy as np
+import nibabel as nib
+import pandas as pd
+import pytest
+
+import nifti_roi
+
+# Define functions
+
+def make_atlas(shape=(20,18,16),seed=0):
+    '''
+    Returns some atlas of scattered (box shaped) labels, with unlabelled space between them.
+    '''
+    rng = np.random.default_rng(seed)
+    data = np.zeros(shape,dtype=np.int16)
+    
+    for label in range(1,9):
+        lo = rng.integers(0,np.array(shape) - 3)
+        size = rng.integers(1,4,3)
+        data[lo[0]:lo[0] + size[0],lo[1]:lo[1] + size[1],lo[2]:lo[2] + size[2]] = label
+    
+    return data
+
+def brute_nearest(data,affine,coords):
+    '''
+    Returns the label of (and the distance to) the nearest labelled voxel of each coordinate (ties to the lowest label).
+    '''
+    vox = np.argwhere(data > 0)
+    mm = nib.affines.apply_affine(affine,vox)
+    vox_labels = data[tuple(vox.T)]
+    
+    labels = list()
+    dists = list()
+    for coord in np.asarray(coords):
+        vox_dists = np.linalg.norm(mm - coord,axis=1)
+        best = np.lexsort((vox_labels,vox_dists))[0]
+        labels.append(int(vox_labels[best]))
+        dists.append(float(vox_dists[best]))
+    
+    return np.array(labels),np.array(dists)
+
+def test_atlas_index_build():
+    data = make_atlas()
+    index = nifti_roi.AtlasIndex(data,np.eye(4),block=4)
+    labels = np.unique(data[data > 0])
+    
+    assert np.array_equal(index.labels,labels)
+    assert np.array_equal(index.counts,[(data == label).sum() for label in labels])
+    
+    for label,bbox,centroid in zip(labels,index.bbox,index.centroids):
+        vox = np.argwhere(data == label)
+        assert np.array_equal(bbox,np.concatenate([vox.min(axis=0),vox.max(axis=0)]))
+        assert np.allclose(centroid,vox.mean(axis=0))
+    
+    assert index.grid_shape == (5,5,4)
+    for block in range(int(np.prod(index.grid_shape))):
+        lo = np.array(np.unravel_index(block,index.grid_shape))*4
+        expected = np.unique(data[lo[0]:lo[0] + 4,lo[1]:lo[1] + 4,lo[2]:lo[2] + 4])
+        assert index.block_labels[index.block_offsets[block]:index.block_offsets[block + 1]].tolist() == expected[expected > 0].tolist()
+
+@pytest.mark.parametrize("n_coords",[10,200])
+@pytest.mark.parametrize("oblique",[False,True])
+def test_atlas_index_nearest(n_coords,oblique):
+    '''
+    Nearest labelled regions match a brute force search, through block rings (few coordinates, or oblique voxel axes)
+    and through the label boundaries (many coordinates).
+    '''
+    data = make_atlas(seed=1)
+    affine = np.diag([1.5,2.0,2.5,1.0])
+    if oblique:
+        affine[:3,:3] = nib.eulerangles.euler2mat(0.4,0.2,0.1) @ affine[:3,:3]
+    affine[:3,3] = [-15,-18,-20]
+    
+    # Random coordinates (in and around the field of view), and labelled voxels
+    vox = np.random.default_rng(2).uniform(-3,np.array(data.shape) + 3,(n_coords,3))
+    vox = np.concatenate([vox,np.argwhere(data > 0)[:5]])
+    coords = nib.affines.apply_affine(affine,vox)
+    index = nifti_roi.AtlasIndex(data,affine,block=4)
+    
+    [labels,dists] = index.region(coords)
+    [expected_labels,expected_dists] = brute_nearest(data,affine,coords)
+    
+    labelled = index.label_at(coords) > 0
+    
+    assert np.allclose(dists,np.where(labelled,0,expected_dists))
+    assert np.array_equal(labels[~labelled],expected_labels[~labelled])
+    assert labelled.any() and not labelled.all()
+
+def test_atlas_index_cache(tmp_path,monkeypatch):
+    '''
+    Cached indices are read rather than built again.
+    '''
+    monkeypatch.setattr(nifti_roi,"cache_dir",str(tmp_path / "cache"))
+    data = make_atlas(seed=3)
+    nib.save(nib.Nifti1Image(data,np.eye(4)),tmp_path / "atlas.nii.gz")
+    
+    built = nifti_roi.load_atlas_index(str(tmp_path / "atlas.nii.gz"),data)
+    
+    monkeypatch.setattr(nifti_roi.AtlasIndex,"build",lambda self: pytest.fail("the cached index was built again"))
+    cached = nifti_roi.load_atlas_index(str(tmp_path / "atlas.nii.gz"),data)
+    
+    for name in ["labels","counts","bbox","centroids","block_offsets","block_labels"]:
+        assert np.array_equal(getattr(cached,name),getattr(built,name))
+    assert np.array_equal(cached.sizes(),nifti_roi.label_sizes(data))
+
+def test_nearest_peaks():
+    '''
+    Only clusters with unlabelled peaks report their nearest label.
+    '''
+    data = np.zeros((10,10,10),dtype=np.uint8)
+    data[:3] = 1
+    data[7:] = 2
+    index = nifti_roi.AtlasIndex(data,np.eye(4))
+    
+    clust_table = pd.DataFrame({"Cluster Index":[3,2,1],"MAX X (mm)":[1.0,4.0,5.0],"MAX Y (mm)":[5.0]*3,"MAX Z (mm)":[5.0]*3})
+    [clusters,labels,dists] = nifti_roi.nearest_peaks(clust_table,index)
+    
+    assert clusters.tolist() == [2,1]
+    assert labels.tolist() == [1,2]
+    assert dists.tolist() == [2,2]
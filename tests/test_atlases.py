@@ -0,0 +1,102 @@
+'''
+Tests of the in-process FSL atlases (FslAtlas): label values, probabilistic indices and batched lookups, along with a
+parity check of FslAtlas against FSL's `atlasquery` (only run if $FSLDIR and `atlasquery` are available).
+'''
+
+# Import modules
+import os
+import re
+import shutil
+import subprocess
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import nifti_roi
+
+# Define functions
+
+def write_atlas_xml(xml_file,name,atlas_type,labels,image="test_atlas"):
+    '''
+    Writes some FSL atlas XML description (with 'index' attributes only, as FSL's own atlases).
+    '''
+    with open(xml_file,"w") as f:
+        f.write(f"<atlas><header><name>{name}</name><type>{atlas_type}</type>")
+        f.write(f"<images><imagefile>/{image}</imagefile></images></header><data>")
+        for index,label in enumerate(labels):
+            f.write(f'<label index="{index}" x="0" y="0" z="0">{label}</label>')
+        f.write("</data></atlas>")
+
+def test_fsl_label_atlas_values(tmp_path):
+    '''
+    Label atlases without 'value' attributes map the label of index i to the image value i + 1 (0 is unlabelled).
+    '''
+    data = np.array([0,1,2,3],dtype=np.int16).reshape(4,1,1)
+    nib.save(nib.Nifti1Image(data,np.eye(4)),tmp_path / "test_atlas.nii.gz")
+    write_atlas_xml(tmp_path / "atlas.xml","Test Labels","Label",["A","B","C"])
+    
+    atlas = nifti_roi.FslAtlas(str(tmp_path / "atlas.xml"))
+    
+    assert atlas.labels == {1:"A",2:"B",3:"C"}
+    assert atlas.query_text([[0,0,0],[1,0,0],[3,0,0]]) == ["<b>Test Labels</b><br>No label found!",
+                                                           "<b>Test Labels</b><br>A",
+                                                           "<b>Test Labels</b><br>C"]
+
+def test_fsl_prob_atlas_indices(tmp_path):
+    '''
+    Probabilistic atlas labels refer to volume indices, and are reported in decreasing order of probability.
+    '''
+    data = np.zeros((2,1,1,3),dtype=np.uint8)
+    data[0] = [10,0,60]
+    nib.save(nib.Nifti1Image(data,np.eye(4)),tmp_path / "test_atlas.nii.gz")
+    write_atlas_xml(tmp_path / "atlas.xml","Test Probabilities","Probabilistic",["A","B","C"])
+    
+    atlas = nifti_roi.FslAtlas(str(tmp_path / "atlas.xml"))
+    
+    assert atlas.labels == {0:"A",1:"B",2:"C"}
+    assert atlas.query_text([[0,0,0],[1,0,0]]) == ["<b>Test Probabilities</b><br>60% C, 10% A",
+                                                   "<b>Test Probabilities</b><br>No label found!"]
+
+@pytest.mark.parametrize("atlas_type,shape",[("Label",(9,8,7)),("Probabilistic",(9,8,7,3))])
+def test_fsl_atlas_batched_query(tmp_path,atlas_type,shape):
+    '''
+    Many coordinates (including repeated and out of view coordinates) are looked up at once, with the same results as
+    looking up each coordinate alone.
+    '''
+    data = np.random.default_rng(0).integers(0,4,shape).astype(np.uint8)
+    affine = np.diag([2.0,2.0,2.0,1.0])
+    affine[:3,3] = [-8,-7,-6]
+    nib.save(nib.Nifti1Image(data,affine),tmp_path / "test_atlas.nii.gz")
+    write_atlas_xml(tmp_path / "atlas.xml","Test",atlas_type,["A","B","C"])
+    
+    atlas = nifti_roi.FslAtlas(str(tmp_path / "atlas.xml"))
+    coords = np.random.default_rng(1).uniform(-12,12,(200,3))
+    coords = np.concatenate([coords,coords[:20]])
+    
+    values = atlas.values(coords)
+    texts = atlas.query_text(coords)
+    
+    assert len(values) == len(texts) == len(coords)
+    for coord,value,text in zip(coords,values,texts):
+        assert np.array_equal(atlas.values([coord])[0],value)
+        assert atlas.query_text([coord]) == [text]
+    assert any("No label found!" in text for text in texts)
+
+@pytest.mark.skipif(not (os.environ.get("FSLDIR") and shutil.which("atlasquery")),reason="requires FSL's atlasquery")
+@pytest.mark.parametrize("vol_atlas_num",[3,4,9,19])
+def test_fsl_atlas_atlasquery_parity(vol_atlas_num):
+    '''
+    In-process FSL atlas queries match those of FSL's `atlasquery`.
+    '''
+    if not nifti_roi.find_fsl_atlas(vol_atlas_num):
+        pytest.skip(f"atlas {vol_atlas_num} is not installed")
+    
+    name = nifti_roi.vol_atlas_dict[vol_atlas_num]
+    coords = [[0,0,0],[24,-28,-10],[-44,-20,50],[10,20,30],[-30,-60,-30],[2,-80,10],[100,100,100]]
+    
+    for coord,roi_list in zip(coords,nifti_roi.roi_loc_batch(coords,vol_atlas_num)):
+        result = subprocess.run(["atlasquery",f"--coord={coord[0]},{coord[1]},{coord[2]}",f"--atlas={name}"],
+                                capture_output=True,text=True,check=True)
+        text = [re.sub(f"<b>{name}</b><br>","",line.rstrip()) for line in result.stdout.splitlines() if line.strip()]
+        assert roi_list == text, coord
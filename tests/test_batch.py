@@ -0,0 +1,88 @@
+'''
+Tests of the multi-subject batch mode (proc_batch): batches across worker processes write the same rows (in input
+order) and tables as serial batches, one row per volume of 4D inputs, and error rows for inputs that fail.
+'''
+
+# Import modules
+import os
+import csv
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import nifti_roi
+
+# Define functions
+
+@pytest.fixture
+def inputs(tmp_path):
+    '''
+    Writes a stand-alone atlas, several (3D and 4D) stat maps and a corrupt input, and returns the atlases and inputs.
+    '''
+    atlas = np.zeros((8,8,8),dtype=np.uint8)
+    atlas[:4] = 1
+    atlas[4:] = 2
+    nib.save(nib.Nifti1Image(atlas,np.eye(4)),tmp_path / "atlas.nii.gz")
+    with open(tmp_path / "atlas.csv","w") as f:
+        f.write("1,Left\n2,Right\n")
+    
+    nii_files = list()
+    for i in range(6):
+        data = np.zeros((8,8,8),dtype=np.float32)
+        data[1 + (i % 2)*4:3 + (i % 2)*4,1:3,1:3] = 3
+        data[1:3,5:7,5:6] = 2 if i % 3 == 0 else 0
+        nii_files.append(str(tmp_path / f"s{i}.nii.gz"))
+        nib.save(nib.Nifti1Image(data,np.eye(4)),nii_files[-1])
+    
+    data = np.zeros((8,8,8,2),dtype=np.float32)
+    data[1:3,1:3,1:3,0] = 3
+    data[5:7,1:3,1:3,1] = 3
+    nii_files.insert(2,str(tmp_path / "four.nii.gz"))
+    nib.save(nib.Nifti1Image(data,np.eye(4)),nii_files[2])
+    
+    nii_files.insert(4,str(tmp_path / "bad.nii.gz"))
+    with open(nii_files[4],"wb") as f:
+        f.write(b"not a NIFTI file")
+    
+    return [(str(tmp_path / "atlas.nii.gz"),str(tmp_path / "atlas.csv"))],nii_files
+
+def test_batch_processes(tmp_path,inputs):
+    [atlases,nii_files] = inputs
+    outputs = list()
+    
+    for n_procs in [1,3]:
+        out_file = str(tmp_path / f"out-{n_procs}.csv")
+        table_file = str(tmp_path / f"table-{n_procs}.tsv")
+        [out_file,n_failed,n_skipped] = nifti_roi.proc_batch(nii_files,out_file,thresh=1,atlases=atlases,use_cache=False,n_procs=n_procs,table_file=table_file)
+        
+        assert (n_failed,n_skipped) == (1,0)
+        
+        with open(out_file,"r",newline="") as f:
+            rows = list(csv.DictReader(f))
+        with open(table_file,"r") as f:
+            outputs.append((rows,f.read()))
+    
+    assert outputs[0] == outputs[1]
+    
+    rows = outputs[0][0]
+    
+    assert [(os.path.basename(row["File"]),row["Volume"]) for row in rows] == [("s0.nii.gz",""),("s1.nii.gz",""),("four.nii.gz","0"),("four.nii.gz","1"),
+                                                                              ("s2.nii.gz",""),("bad.nii.gz",""),("s3.nii.gz",""),("s4.nii.gz",""),("s5.nii.gz","")]
+    assert [row["ROIs"] for row in rows] == ["['Left']","['Right']","['Left']","['Right']","['Left']","[]","['Left', 'Right']","['Left']","['Right']"]
+    assert rows[5]["Error"] != "" and all(row["Error"] == "" for row in rows if row is not rows[5])
+
+def test_batch_worker_profiles(tmp_path,inputs):
+    '''
+    The profile records of worker processes are returned to (and reported by) the writer process.
+    '''
+    [atlases,nii_files] = inputs
+    
+    nifti_roi.start_profile()
+    try:
+        nifti_roi.proc_batch(nii_files,str(tmp_path / "out.csv"),thresh=1,atlases=atlases,use_cache=False,n_procs=2)
+        pids = {rec["pid"] for rec in nifti_roi.prof_stats}
+    finally:
+        nifti_roi.prof_state["enabled"] = False
+    
+    assert len(pids - {os.getpid()}) >= 1
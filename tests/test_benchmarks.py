@@ -0,0 +1,58 @@
+'''
+Tests of the stage-level benchmark suite (benchmarks/bench_stages.py): a minimal run times every stage, and runs are
+compared against a saved baseline, failing on regressions.
+'''
+
+# Import modules
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+# Define global variable(s)
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+script = os.path.join(repo_dir,"benchmarks","bench_stages.py")
+
+# Define functions
+
+@pytest.fixture(scope="module")
+def saved(tmp_path_factory):
+    '''
+    Runs a minimal benchmark (one grid, density and repeat), and returns its saved results.
+    '''
+    save_file = str(tmp_path_factory.mktemp("bench") / "bench.json")
+    result = subprocess.run([sys.executable,script,"--grids","2mm","--densities","0.01","--repeats","1","--save",save_file],capture_output=True,text=True)
+    
+    assert result.returncode == 0, result.stderr
+    
+    with open(save_file,"r") as f:
+        return json.load(f)
+
+def test_bench_stages(saved):
+    stages = ["atlas load","atlas load (cached)","label coords"] + [f"0.01/{stage}" for stage in ["cluster","overlap","cluster (sparse)","overlap (sparse)",
+                                                                                                 "peaks","label lookup","table","fsl lookup","write"]]
+    
+    assert sorted(saved["results"]) == sorted(f"2mm/{stage}" for stage in stages)
+    assert all(value > 0 for value in saved["results"].values())
+    assert saved["repeats"] == 1
+
+def test_bench_baseline(saved):
+    '''
+    Stages that are slower than the baseline by more than the threshold (and by more than 1 ms) are regressions.
+    '''
+    sys.path.insert(0,os.path.dirname(script))
+    try:
+        import bench_stages
+    finally:
+        sys.path.remove(os.path.dirname(script))
+    
+    results = saved["results"]
+    baseline = dict(results)
+    baseline["2mm/0.01/cluster"] = results["2mm/0.01/cluster"]/2 - 0.001
+    baseline["2mm/0.01/table"] = results["2mm/0.01/table"] - 0.0005
+    
+    assert bench_stages.compare(results,baseline,0.25) == ["2mm/0.01/cluster"]
+    assert "2mm/0.01/table" not in bench_stages.compare(results,baseline,0)
+    assert bench_stages.compare(results,results,0) == []
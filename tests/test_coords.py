@@ -0,0 +1,123 @@
+'''
+Tests of bulk coordinate labelling (--coord-table): coordinate table parsing (read_coord_table), labelling with
+stand-alone and probabilistic FSL atlases (label_coords), and the written tables (proc_coords).
+'''
+
+# Import modules
+import numpy as np
+import nibabel as nib
+import pandas as pd
+import pytest
+
+import nifti_roi
+
+# Define functions
+
+@pytest.fixture
+def atlas_files(tmp_path):
+    '''
+    Writes a stand-alone 2 mm atlas with a 'Left' (x <= -2 mm) and 'Right' (x >= 4 mm) ROI, separated by unlabelled planes.
+    '''
+    atlas = np.zeros((10,8,8),dtype=np.uint8)
+    atlas[:5] = 1
+    atlas[7:] = 2
+    affine = np.diag([2.0,2.0,2.0,1.0])
+    affine[:3,3] = [-10,-8,-8]
+    nib.save(nib.Nifti1Image(atlas,affine),tmp_path / "atlas.nii.gz")
+    with open(tmp_path / "atlas.csv","w") as f:
+        f.write("1,Left\n2,Right\n")
+    
+    return str(tmp_path / "atlas.nii.gz"),str(tmp_path / "atlas.csv")
+
+@pytest.mark.parametrize("header,sep,ext",[("X,Y,Z",",",".csv"),
+                                           ("Peak\tMNI X (mm)\tMNI Y (mm)\tMNI Z (mm)","\t",".tsv"),
+                                           ("Study,max x,max y,max z",",",".csv"),
+                                           ("Study,a,b,c",",",".csv"),
+                                           ("","\t",".txt")])
+def test_read_coord_table(tmp_path,header,sep,ext):
+    coords = [[1.5,-2,3],[-4,5,-6.25]]
+    coord_file = str(tmp_path / f"coords{ext}")
+    
+    with open(coord_file,"w") as f:
+        if header:
+            f.write(header + "\n")
+        n_extra = len(header.split(sep)) - 3 if header else 0
+        for i,coord in enumerate(coords):
+            f.write(sep.join([f"s{i}"]*n_extra + [str(val) for val in coord]) + "\n")
+    
+    [df,read] = nifti_roi.read_coord_table(coord_file)
+    
+    assert np.array_equal(read,coords)
+    assert len(df) == 2
+
+def test_read_coord_table_missing(tmp_path):
+    with open(tmp_path / "coords.csv","w") as f:
+        f.write("Study,X\na,1\n")
+    
+    with pytest.raises(ValueError):
+        nifti_roi.read_coord_table(str(tmp_path / "coords.csv"))
+
+def test_label_coords(atlas_files):
+    '''
+    Bulk labels match labelling each coordinate alone (see coord_rois), also for repeated and out of view coordinates.
+    '''
+    [atlas] = nifti_roi.load_atlases([atlas_files],use_cache=False)
+    
+    coords = np.random.default_rng(0).uniform(-14,14,(500,3))
+    coords = np.concatenate([coords,coords[:50]])
+    
+    df = nifti_roi.label_coords(coords,[atlas])
+    expected = [nifti_roi.coord_rois(coord,atlas["data"],atlas["lut"],atlas["affine"])[0] for coord in coords]
+    
+    assert list(df.columns) == [f"{atlas['name']} Label",f"{atlas['name']} ROI"]
+    assert df[f"{atlas['name']} ROI"].tolist() == [rois[0] if rois else "" for rois in expected]
+    assert {"","Left","Right"} == set(df[f"{atlas['name']} ROI"])
+    assert df[f"{atlas['name']} Label"].tolist() == [{"":0,"Left":1,"Right":2}[roi] for roi in df[f"{atlas['name']} ROI"]]
+
+def test_label_coords_nearest(atlas_files):
+    '''
+    Unlabelled coordinates report their nearest labelled ROI, and its distance.
+    '''
+    [atlas] = nifti_roi.load_atlases([atlas_files],use_cache=False,nearest=True)
+    name = atlas["name"]
+    
+    df = nifti_roi.label_coords([[-4,0,0],[0,0,0],[2.5,0,0]],[atlas])
+    
+    assert list(df.columns) == [f"{name} Label",f"{name} ROI",f"{name} Distance (mm)"]
+    assert df[f"{name} ROI"].tolist() == ["Left","Left","Right"]
+    assert df[f"{name} Distance (mm)"].tolist() == pytest.approx([0,2,1.5])
+
+def test_label_coords_prob(tmp_path,monkeypatch):
+    '''
+    Probabilistic FSL atlases report the most probable ROI (label of volume index + 1) and all non-zero probabilities.
+    '''
+    data = np.zeros((2,1,1,3),dtype=np.uint8)
+    data[0] = [10,0,60]
+    nib.save(nib.Nifti1Image(data,np.eye(4)),tmp_path / "test_atlas.nii.gz")
+    with open(tmp_path / "atlas.xml","w") as f:
+        f.write("<atlas><header><name>Test</name><type>Probabilistic</type><images><imagefile>/test_atlas</imagefile></images></header><data>")
+        f.write("".join(f'<label index="{index}" x="0" y="0" z="0">{label}</label>' for index,label in enumerate("ABC")))
+        f.write("</data></atlas>")
+    
+    monkeypatch.setitem(nifti_roi.fsl_atlas_cache,("atlas",99,""),nifti_roi.FslAtlas(str(tmp_path / "atlas.xml")))
+    
+    df = nifti_roi.label_coords([[0,0,0],[1,0,0],[5,0,0],[0,0,0]],[{"name":"Test","num":99}])
+    
+    assert df["Test Label"].tolist() == [3,0,0,3]
+    assert df["Test ROI"].tolist() == ["C","","","C"]
+    assert df["Test Probability"].tolist() == [60,0,0,60]
+    assert df["Test Probabilities"].tolist() == ["60% C, 10% A","","","60% C, 10% A"]
+
+def test_proc_coords(tmp_path,atlas_files):
+    '''
+    The label columns of the atlas are appended to the input table (as TSV for '.tsv' outputs).
+    '''
+    coord_file = str(tmp_path / "peaks.csv")
+    pd.DataFrame({"Study":["a","b"],"x":[-6,6],"y":[0,0],"z":[0,0]}).to_csv(coord_file,index=False)
+    
+    out_file = nifti_roi.proc_coords(coord_file,str(tmp_path / "labels.tsv"),[atlas_files],use_cache=False)
+    df = pd.read_csv(out_file,sep="\t")
+    
+    assert len(df.columns) == 6
+    assert df["Study"].tolist() == ["a","b"]
+    assert df.iloc[:,5].tolist() == ["Left","Right"]
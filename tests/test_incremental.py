@@ -0,0 +1,128 @@
+'''
+Tests of incremental batch runs (proc_batch): input fingerprints (see input_fingerprint), and the skipping of
+unchanged inputs, reprocessing of changed or failed inputs, and '--force'.
+'''
+
+# Import modules
+import os
+import csv
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import nifti_roi
+
+# Define functions
+
+def write_stat(nii_file,side):
+    '''
+    Writes a stat map with a single cluster in the 'Left' (x < 4) or 'Right' half of the test atlas.
+    '''
+    data = np.zeros((8,8,8),dtype=np.float32)
+    if side == "Left":
+        data[1:3,1:3,1:3] = 3
+    else:
+        data[5:7,5:7,5:7] = 3
+    nib.save(nib.Nifti1Image(data,np.eye(4)),nii_file)
+
+def read_rois(out_file):
+    '''
+    Returns the ROIs of each file of some CSV output file.
+    '''
+    with open(out_file,"r",newline="") as f:
+        return {row["File"].rsplit("/",1)[1]:row["ROIs"] for row in csv.DictReader(f)}
+
+@pytest.fixture
+def batch(tmp_path):
+    '''
+    Writes a stand-alone atlas and three stat maps, and returns a function that runs a batch on them.
+    '''
+    atlas = np.zeros((8,8,8),dtype=np.uint8)
+    atlas[:4] = 1
+    atlas[4:] = 2
+    nib.save(nib.Nifti1Image(atlas,np.eye(4)),tmp_path / "atlas.nii.gz")
+    with open(tmp_path / "atlas.csv","w") as f:
+        f.write("1,Left\n2,Right\n")
+    
+    for name in ["a","b","c"]:
+        write_stat(tmp_path / f"{name}.nii.gz","Left")
+    
+    atlases = [(str(tmp_path / "atlas.nii.gz"),str(tmp_path / "atlas.csv"))]
+    
+    def run(names,**kwargs):
+        nii_files = [str(tmp_path / f"{name}.nii.gz") for name in names]
+        return nifti_roi.proc_batch(nii_files,str(tmp_path / "out.csv"),thresh=1,atlases=atlases,use_cache=False,**kwargs)
+    
+    return run
+
+def test_input_fingerprint(tmp_path):
+    nii_file = str(tmp_path / "a.nii.gz")
+    write_stat(nii_file,"Left")
+    
+    digest = nifti_roi.input_fingerprint(nii_file,"atlas",{"thresh":1})
+    content = nifti_roi.input_fingerprint(nii_file,"atlas",{"thresh":1},content=True)
+    
+    assert digest == nifti_roi.input_fingerprint(nii_file,"atlas",{"thresh":1})
+    assert digest != nifti_roi.input_fingerprint(nii_file,"atlas",{"thresh":2})
+    assert digest != nifti_roi.input_fingerprint(nii_file,"other",{"thresh":1})
+    assert nifti_roi.input_fingerprint(str(tmp_path / "missing.nii.gz")) == ""
+    
+    # Touching a file changes its (size and modification time) fingerprint, but not its content fingerprint
+    stat = os.stat(nii_file)
+    os.utime(nii_file,ns=(stat.st_atime_ns,stat.st_mtime_ns + 10**9))
+    
+    assert digest != nifti_roi.input_fingerprint(nii_file,"atlas",{"thresh":1})
+    assert content == nifti_roi.input_fingerprint(nii_file,"atlas",{"thresh":1},content=True)
+
+def test_batch_incremental(batch, tmp_path):
+    '''
+    Unchanged files are skipped, while changed and new files are processed (replacing their previous rows).
+    '''
+    [out_file,n_failed,n_skipped] = batch(["a","b"])
+    
+    assert (n_failed,n_skipped) == (0,0)
+    assert read_rois(out_file) == {"a.nii.gz":"['Left']","b.nii.gz":"['Left']"}
+    
+    [out_file,n_failed,n_skipped] = batch(["a","b"])
+    
+    assert (n_failed,n_skipped) == (0,2)
+    
+    stat = os.stat(tmp_path / "b.nii.gz")
+    write_stat(tmp_path / "b.nii.gz","Right")
+    os.utime(tmp_path / "b.nii.gz",ns=(stat.st_atime_ns,stat.st_mtime_ns + 10**9))
+    [out_file,n_failed,n_skipped] = batch(["a","b","c"])
+    
+    assert (n_failed,n_skipped) == (0,1)
+    assert read_rois(out_file) == {"a.nii.gz":"['Left']","b.nii.gz":"['Right']","c.nii.gz":"['Left']"}
+    
+    # Other clustering parameters are new runs of every file
+    [out_file,n_failed,n_skipped] = batch(["a","b","c"],connectivity=6)
+    
+    assert (n_failed,n_skipped) == (0,0)
+    assert len(read_rois(out_file)) == 3
+
+def test_batch_force(batch):
+    [out_file,n_failed,n_skipped] = batch(["a","b"])
+    [out_file,n_failed,n_skipped] = batch(["a","b"],force=True)
+    
+    assert (n_failed,n_skipped) == (0,0)
+    with open(out_file,"r") as f:
+        assert len(f.readlines()) == 3
+
+def test_batch_failed_rerun(batch, tmp_path):
+    '''
+    Files that failed are processed again by the next run.
+    '''
+    with open(tmp_path / "c.nii.gz","wb") as f:
+        f.write(b"not a NIFTI file")
+    
+    [out_file,n_failed,n_skipped] = batch(["a","c"])
+    
+    assert (n_failed,n_skipped) == (1,0)
+    
+    write_stat(tmp_path / "c.nii.gz","Right")
+    [out_file,n_failed,n_skipped] = batch(["a","c"])
+    
+    assert (n_failed,n_skipped) == (0,1)
+    assert read_rois(out_file) == {"a.nii.gz":"['Left']","c.nii.gz":"['Right']"}
@@ -0,0 +1,61 @@
+'''
+Tests of deferred module imports (LazyModule): heavy modules are only imported on first use, such that importing
+nifti_roi, '--help', '--dump-atlases' and argument errors do not import them.
+'''
+
+# Import modules
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+from roilib.lazy import LazyModule
+
+# Define global variable(s)
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+script = os.path.join(repo_dir,"nifti_roi.py")
+
+# Heavy modules that should be deferred (see benchmarks/bench_cold_start.py)
+heavy_modules = ["numpy","pandas","nibabel","scipy","http.server","urllib.request","zipfile","tracemalloc","sqlite3"]
+
+# Define functions
+
+def imported_heavy(code):
+    '''
+    Returns the heavy modules imported by some code, run in a new interpreter (from the repository root).
+    '''
+    code = f"import sys\ntry:\n    {code}\nexcept SystemExit:\n    pass\nprint('\\n' + repr(sorted(m for m in {heavy_modules!r} if m in sys.modules)))"
+    result = subprocess.run([sys.executable,"-c",code],capture_output=True,text=True,cwd=repo_dir)
+    
+    return eval(result.stdout.strip().splitlines()[-1])
+
+def test_lazy_module():
+    '''
+    The placeholder imports its module on first attribute access, and replaces itself with it.
+    '''
+    namespace = dict()
+    namespace["js"] = LazyModule("json","js",namespace)
+    
+    assert isinstance(namespace["js"],LazyModule)
+    assert namespace["js"].dumps([1]) == "[1]"
+    assert namespace["js"] is json
+    
+    namespace["missing"] = LazyModule("not_a_module","missing",namespace)
+    
+    with pytest.raises(ImportError):
+        namespace["missing"].attr
+
+@pytest.mark.parametrize("code",["import nifti_roi",
+                                 f"import runpy; sys.argv = [{script!r},'--help']; runpy.run_path({script!r},run_name='__main__')",
+                                 f"import runpy; sys.argv = [{script!r},'--dump-atlases']; runpy.run_path({script!r},run_name='__main__')",
+                                 f"import runpy; sys.argv = [{script!r},'--thresh','not-a-number']; runpy.run_path({script!r},run_name='__main__')"])
+def test_deferred_imports(code):
+    assert imported_heavy(code) == []
+
+def test_first_use_imports():
+    '''
+    Using a deferred module imports it (only), and binds the module itself.
+    '''
+    assert imported_heavy("import nifti_roi; nifti_roi.np.zeros(1); assert nifti_roi.np is sys.modules['numpy']") == ["numpy"]
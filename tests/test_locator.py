@@ -0,0 +1,71 @@
+'''
+Tests of the reusable ROI locator (RoiLocator): atlases mapped onto the voxel grids of inputs are kept for the most
+recently used grids.
+'''
+
+# Import modules
+import numpy as np
+import nibabel as nib
+import pytest
+
+import nifti_roi
+
+# Define functions
+
+@pytest.fixture
+def locator(tmp_path):
+    '''
+    Loads a RoiLocator with a stand-alone atlas.
+    '''
+    atlas = np.zeros((8,8,8),dtype=np.uint8)
+    atlas[:4] = 1
+    atlas[4:] = 2
+    
+    nib.save(nib.Nifti1Image(atlas,np.eye(4)),tmp_path / "atlas.nii.gz")
+    with open(tmp_path / "atlas.csv","w") as f:
+        f.write("1,Left\n2,Right\n")
+    
+    return nifti_roi.RoiLocator([(str(tmp_path / "atlas.nii.gz"),str(tmp_path / "atlas.csv"))],thresh=1,use_cache=False)
+
+def grid_image(shift):
+    '''
+    Returns an input image in a voxel grid that is shifted by some number of mm along x.
+    '''
+    data = np.zeros((8,8,8),dtype=np.float32)
+    data[1:3,1:3,1:3] = 3
+    affine = np.eye(4)
+    affine[0,3] = shift
+    return nib.Nifti1Image(data,affine)
+
+def test_grid_atlases_lru(locator, monkeypatch):
+    mapped = list()
+    match_atlas_grid = nifti_roi.match_atlas_grid
+    
+    def count_match(atlas, shape, affine):
+        mapped.append(None if affine is None else affine[0,3])
+        return match_atlas_grid(atlas,shape,affine)
+    
+    monkeypatch.setattr(nifti_roi,"match_atlas_grid",count_match)
+    
+    images = [grid_image(shift) for shift in range(1,6)]
+    for img in images[:4]:
+        locator.grid_atlases(img)
+    assert len(mapped) == 4
+    
+    # Reusing the oldest grid keeps it, such that the next new grid evicts the second one
+    assert locator.grid_atlases(images[0]) is locator.grid_atlases(images[0])
+    assert len(mapped) == 4
+    locator.grid_atlases(images[4])
+    assert len(locator.grids) == locator.max_grids
+    
+    locator.grid_atlases(images[0])
+    locator.grid_atlases(images[2])
+    assert len(mapped) == 5
+    locator.grid_atlases(images[1])
+    assert mapped[5:] == [2]
+
+def test_locate_shifted_grid(locator):
+    # The cluster (x = 1-2 mm) lies in the 'Left' half of the atlas (x < 4 mm), and in the 'Right' half if shifted by 3 mm
+    [name] = locator.names
+    assert locator.locate(grid_image(0))[0]["rois"][name] == ["Left"]
+    assert locator.locate(grid_image(3))[0]["rois"][name] == ["Right"]
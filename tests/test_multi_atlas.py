@@ -0,0 +1,97 @@
+'''
+Tests of multi-atlas labelling (get_file_atlas_rois): several atlases are resolved against a single clustering pass,
+with the same ROIs and tables as each atlas alone, and written as one column per atlas.
+'''
+
+# Import modules
+import csv
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import nifti_roi
+from conftest import make_stat
+
+# Define functions
+
+@pytest.fixture
+def atlas_specs(tmp_path):
+    '''
+    Writes two stand-alone atlases (left/right halves, and anterior/posterior halves) in the grid of the stat maps.
+    '''
+    specs = list()
+    
+    for name,axis,rois in [("lr",0,["Left","Right"]),("ap",1,["Posterior","Anterior"])]:
+        atlas = np.ones((24,20,18),dtype=np.uint8)
+        atlas[(slice(None),)*axis + (slice(atlas.shape[axis]//2,None),)] = 2
+        nib.save(nib.Nifti1Image(atlas,np.eye(4)),tmp_path / f"{name}.nii.gz")
+        with open(tmp_path / f"{name}.csv","w") as f:
+            f.write(f"1,{rois[0]}\n2,{rois[1]}\n")
+        specs.append((str(tmp_path / f"{name}.nii.gz"),str(tmp_path / f"{name}.csv")))
+    
+    return specs
+
+def test_multi_atlas_single_pass(tmp_path,atlas_specs,monkeypatch):
+    data = np.stack([make_stat(seed=seed) for seed in [8,9]],axis=3)
+    nib.save(nib.Nifti1Image(data,np.eye(4)),tmp_path / "four.nii.gz")
+    nii_file = str(tmp_path / "four.nii.gz")
+    
+    atlases = nifti_roi.load_atlases(atlas_specs,use_cache=False,table=True)
+    single = [nifti_roi.get_file_atlas_rois(nii_file,[atlas],1.5,table=True) for atlas in atlases]
+    
+    calls = list()
+    sparse_clusters = nifti_roi.sparse_clusters
+    monkeypatch.setattr(nifti_roi,"sparse_clusters",lambda *args: calls.append(args) or sparse_clusters(*args))
+    vol_rois = nifti_roi.get_file_atlas_rois(nii_file,atlases,1.5,table=True)
+    
+    # One clustering pass per volume, shared by both atlases
+    assert len(calls) == 2
+    assert [volume for volume,_,_ in vol_rois] == [0,1]
+    
+    for i,atlas_rois in enumerate(single):
+        for (_,roi_lists,tables),(_,atlas_lists,atlas_tables) in zip(vol_rois,atlas_rois):
+            assert roi_lists[i] == atlas_lists[0]
+            assert tables[i].equals(atlas_tables[0])
+    
+    assert set(vol_rois[0][1][0]) == {"Left","Right"}
+    assert set(vol_rois[0][1][1]) == {"Posterior","Anterior"}
+    
+    table = nifti_roi.atlas_table(atlases,vol_rois[0][2])
+    
+    assert table.columns[0] == "Atlas"
+    assert table["Atlas"].unique().tolist() == [atlas["name"] for atlas in atlases]
+
+def test_multi_atlas_duplicates(tmp_path,atlas_specs):
+    '''
+    Duplicate atlases are loaded (and reported) once, and atlases of the same file name get unique names.
+    '''
+    (tmp_path / "other").mkdir()
+    other = list()
+    for spec in atlas_specs[0]:
+        with open(spec,"rb") as f, open(tmp_path / "other" / spec.rsplit("/",1)[1],"wb") as out:
+            out.write(f.read())
+        other.append(str(tmp_path / "other" / spec.rsplit("/",1)[1]))
+    
+    atlases = nifti_roi.load_atlases([atlas_specs[0],atlas_specs[1],atlas_specs[0],tuple(other)],use_cache=False)
+    names = [atlas["name"] for atlas in atlases]
+    
+    assert len(atlases) == 3
+    assert len(set(names)) == 3
+    assert names[2] == f"{names[0]} (2)"
+
+def test_multi_atlas_columns(tmp_path,atlas_specs):
+    '''
+    Batches write one ROI column per atlas.
+    '''
+    data = make_stat(seed=8)
+    nib.save(nib.Nifti1Image(data,np.eye(4)),tmp_path / "stat.nii.gz")
+    atlases = nifti_roi.load_atlases(atlas_specs,use_cache=False)
+    
+    [out_file,n_failed,n_skipped] = nifti_roi.proc_batch([str(tmp_path / "stat.nii.gz")],str(tmp_path / "out.csv"),thresh=1.5,atlases=atlas_specs,use_cache=False)
+    
+    with open(out_file,"r",newline="") as f:
+        rows = list(csv.reader(f))
+    
+    assert rows[0] == ["File","Volume","Threshold"] + [atlas["name"] for atlas in atlases] + ["Error"]
+    assert len(rows) == 2
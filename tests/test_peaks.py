@@ -0,0 +1,80 @@
+'''
+Tests of the in-process local maxima: find_peaks against a brute force search, the local maxima of each volume of
+inputs (get_file_peaks) and the deprecated (ignored) minimum distance of the clustering functions.
+'''
+
+# Import modules
+import itertools
+import warnings
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import nifti_roi
+from conftest import make_stat
+
+# Define functions
+
+@pytest.mark.parametrize("dist",[0,3])
+def test_find_peaks_brute_force(dist):
+    '''
+    Local maxima match a brute force search (voxels not below any neighbour of the same cluster, then greedily
+    suppressed within the minimum distance of a higher local maximum of the same cluster).
+    '''
+    data = make_stat((16,14,12),seed=2)
+    clusters = nifti_roi.sparse_clusters(data,0.5)
+    cluster_data = nifti_roi.dense_clusters(clusters)
+    
+    peaks = list()
+    for vox in zip(*np.nonzero(cluster_data)):
+        neighbours = [tuple(np.add(vox,step)) for step in itertools.product([-1,0,1],repeat=3) if any(step)]
+        neighbours = [n for n in neighbours if all(0 <= c < s for c,s in zip(n,data.shape)) and cluster_data[n] == cluster_data[vox]]
+        if all(data[vox] >= data[n] for n in neighbours):
+            peaks.append((-int(cluster_data[vox]),-float(data[vox]),vox))
+    
+    kept = list()
+    for cluster,value,vox in sorted(peaks):
+        if all(c != cluster or np.linalg.norm(np.subtract(vox,v)) >= dist for c,_,v in kept):
+            kept.append((cluster,value,vox))
+    
+    peak_table = nifti_roi.find_peaks(data,clusters,dist=dist)
+    
+    assert peak_table["Cluster Index"].tolist() == [-cluster for cluster,_,_ in kept]
+    assert peak_table[["x (vox)","y (vox)","z (vox)"]].values.tolist() == [list(map(float,vox)) for _,_,vox in kept]
+
+def test_get_file_peaks(tmp_path):
+    '''
+    The local maxima of each volume (with minimum distances in mm) match those of find_peaks in the volume.
+    '''
+    data = np.stack([make_stat((16,14,12),seed=seed) for seed in [14,15]],axis=3)
+    affine = np.diag([2.0,2.0,2.0,1.0])
+    nib.save(nib.Nifti1Image(data,affine),tmp_path / "four.nii.gz")
+    
+    vol_peaks = nifti_roi.get_file_peaks(str(tmp_path / "four.nii.gz"),0.5,dist=12)
+    
+    assert [volume for volume,_ in vol_peaks] == [0,1]
+    for volume,peak_table in vol_peaks:
+        clusters = nifti_roi.sparse_clusters(data[...,volume],0.5)
+        expected = nifti_roi.find_peaks(data[...,volume],clusters,affine,12)
+        
+        assert peak_table.equals(expected)
+        assert len(expected) < len(nifti_roi.find_peaks(data[...,volume],clusters,affine,0))
+
+def test_dist_deprecated(tmp_path):
+    '''
+    The (ignored) minimum distance argument of the clustering functions warns that it is deprecated, if provided.
+    '''
+    data = make_stat(seed=3)
+    nib.save(nib.Nifti1Image(data,np.eye(4)),tmp_path / "stat.nii.gz")
+    atlas_data = np.ones(data.shape,dtype=np.uint8)
+    
+    with pytest.warns(DeprecationWarning,match="'dist' argument of load_nii_vol"):
+        clusters = nifti_roi.load_nii_vol(str(tmp_path / "stat.nii.gz"),1,dist=4,dense=False)
+    with pytest.warns(DeprecationWarning,match="'dist' argument of get_rois"):
+        roi_list = nifti_roi.get_rois(str(tmp_path / "stat.nii.gz"),1,4,atlas_data=atlas_data,atlas_dict={1:"A"})
+    
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        assert np.array_equal(nifti_roi.load_nii_vol(str(tmp_path / "stat.nii.gz"),1,dense=False)["index"],clusters["index"])
+        assert nifti_roi.get_rois(str(tmp_path / "stat.nii.gz"),1,atlas_data=atlas_data,atlas_dict={1:"A"}) == roi_list == ["A"]
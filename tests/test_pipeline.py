@@ -0,0 +1,149 @@
+'''
+Tests of pipelined batches (BatchPipeline): results are written in input order, reads overlap compute, the read-ahead
+stays within its memory budget, and pipelined batches (proc_batch with 'prefetch') match batches of worker processes.
+'''
+
+# Import modules
+import time
+import random
+import threading
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import nifti_roi
+from roilib.pipeline import BatchPipeline
+
+# Define functions
+
+def write_list(results):
+    '''
+    Writer of the pipeline tests: returns the (ordered) results.
+    '''
+    return list(results)
+
+def test_pipeline_order():
+    '''
+    Results are written in input order (also when completed out of order), and read errors are passed on to compute.
+    '''
+    def read(item):
+        if item == 3:
+            raise ValueError("unreadable")
+        return item
+    
+    def compute(item,data):
+        time.sleep(random.uniform(0,0.01))
+        return (item,type(data).__name__)
+    
+    pipeline = BatchPipeline(n_readers=3,n_workers=3,depth=4)
+    written = pipeline.run(range(20),read,compute,write_list)
+    
+    assert [item for item,_ in written] == list(range(20))
+    assert written[3] == (3,"ValueError")
+    assert pipeline.stats()["inputs"] == 20
+
+def test_pipeline_overlap():
+    '''
+    Inputs are read while others are processed.
+    '''
+    def read(item):
+        time.sleep(0.02)
+        return item
+    
+    def compute(item,data):
+        time.sleep(0.02)
+        return item
+    
+    pipeline = BatchPipeline(n_readers=1,n_workers=1,depth=2)
+    pipeline.run(range(10),read,compute,write_list)
+    stats = pipeline.stats()
+    
+    assert stats["overlap"] > 0.1
+    assert stats["hidden"] > 0.5
+    assert stats["wall"] < stats["read"]["busy"] + stats["compute"]["busy"]
+
+def test_pipeline_memory_budget():
+    '''
+    The memory of inputs that are read but not yet processed stays within the budget, inputs larger than the budget
+    being read alone.
+    '''
+    sizes = [40]*8 + [250] + [40]*4
+    held = [0]
+    peaks = list()
+    lock = threading.Lock()
+    
+    def read(item):
+        with lock:
+            held[0] += sizes[item]
+            peaks.append((sizes[item],held[0]))
+        return item
+    
+    def compute(item,data):
+        time.sleep(0.005)
+        with lock:
+            held[0] -= sizes[item]
+        return item
+    
+    pipeline = BatchPipeline(n_readers=4,n_workers=2,depth=8,max_bytes=100)
+    written = pipeline.run(range(len(sizes)),read,compute,write_list,lambda item: sizes[item])
+    
+    assert written == list(range(len(sizes)))
+    assert pipeline.peak_bytes == 250
+    assert pipeline.held == 0
+    assert max(peak for size,peak in peaks if size == 250) == 250
+    assert max(peak for size,peak in peaks if size < 250) <= 100
+
+def test_pipeline_errors():
+    '''
+    Compute errors are raised once all inputs are processed, and writer errors stop the pipeline.
+    '''
+    def compute(item,data):
+        if item == 1:
+            raise RuntimeError("failed")
+        return item
+    
+    with pytest.raises(RuntimeError):
+        BatchPipeline().run(range(5),lambda item: item,compute,write_list)
+    
+    def write(results):
+        for result in results:
+            raise OSError("disk full")
+    
+    read = list()
+    pipeline = BatchPipeline(n_readers=1,depth=1)
+    
+    with pytest.raises(OSError):
+        pipeline.run(range(100),read.append,lambda item,data: item,write)
+    
+    assert len(read) < 100
+
+def test_batch_prefetch(tmp_path):
+    '''
+    Pipelined batches write the same results as batches of worker processes.
+    '''
+    atlas = np.zeros((8,8,8),dtype=np.uint8)
+    atlas[:4] = 1
+    atlas[4:] = 2
+    nib.save(nib.Nifti1Image(atlas,np.eye(4)),tmp_path / "atlas.nii.gz")
+    with open(tmp_path / "atlas.csv","w") as f:
+        f.write("1,Left\n2,Right\n")
+    atlases = [(str(tmp_path / "atlas.nii.gz"),str(tmp_path / "atlas.csv"))]
+    
+    nii_files = list()
+    for i in range(6):
+        data = np.zeros((8,8,8),dtype=np.float32)
+        data[1 + (i % 2)*4:3 + (i % 2)*4,1:3,1:3] = 3
+        nii_files.append(str(tmp_path / f"s{i}.nii.gz"))
+        nib.save(nib.Nifti1Image(data,np.eye(4)),nii_files[-1])
+    
+    outputs = list()
+    for name,kwargs in [("procs",{"n_procs":2}),("pipeline",{"n_procs":2,"prefetch":2,"readers":2})]:
+        [out_file,n_failed,n_skipped] = nifti_roi.proc_batch(nii_files,str(tmp_path / f"{name}.csv"),thresh=1,atlases=atlases,use_cache=False,**kwargs)
+        with open(out_file,"r") as f:
+            outputs.append(f.read())
+        
+        assert (n_failed,n_skipped) == (0,0)
+    
+    assert outputs[0] == outputs[1]
+    assert nifti_roi.pipe_stats["inputs"] == 6
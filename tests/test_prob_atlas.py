@@ -0,0 +1,85 @@
+'''
+Tests of probabilistic atlas loading (load_prob_atlas, ProbRows) and whole-cluster membership probabilities
+(cluster_memberships), with and without the atlas cache.
+'''
+
+# Import modules
+import tracemalloc
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import nifti_roi
+
+# Define functions
+
+def make_prob_atlas(tmp_path,name,shape=(24,20,16,12),scaled=False):
+    '''
+    Writes some random 4D probabilistic atlas, and returns its file and (voxels x regions, C order) probabilities.
+    '''
+    rng = np.random.default_rng(0)
+    data = rng.integers(0,101,shape).astype(np.uint8)
+    img = nib.Nifti1Image(data,np.eye(4))
+    
+    if scaled:
+        img.header.set_slope_inter(0.5,0)
+    
+    nib.save(img,tmp_path / name)
+    probs = np.stack([data[...,r].reshape(-1) for r in range(shape[3])],axis=1)*(0.5 if scaled else 1)
+    
+    return str(tmp_path / name),probs
+
+@pytest.mark.parametrize("name,scaled",[("prob.nii.gz",False),("prob.nii",False),("scaled.nii.gz",True)])
+@pytest.mark.parametrize("use_cache",[False,True])
+def test_load_prob_atlas(tmp_path,monkeypatch,name,scaled,use_cache):
+    '''
+    Cached and uncached probabilities match the atlas image (voxel rows in C order).
+    '''
+    monkeypatch.setattr(nifti_roi,"cache_dir",str(tmp_path / "cache"))
+    [image_file,probs] = make_prob_atlas(tmp_path,name,scaled=scaled)
+    rows = np.sort(np.random.default_rng(1).choice(len(probs),500,replace=False))
+    
+    for _ in range(2):
+        [loaded,shape,affine] = nifti_roi.load_prob_atlas(image_file,use_cache)
+        
+        assert shape == (24,20,16) and loaded.shape == probs.shape
+        assert np.array_equal(np.asarray(loaded[rows]),probs[rows])
+        assert isinstance(loaded,np.memmap) == use_cache
+
+def test_load_prob_atlas_memory(tmp_path,monkeypatch):
+    '''
+    Neither the cache nor the on demand view hold the whole (compressed) atlas in memory.
+    '''
+    monkeypatch.setattr(nifti_roi,"cache_dir",str(tmp_path / "cache"))
+    [image_file,probs] = make_prob_atlas(tmp_path,"prob.nii.gz",shape=(64,64,48,24))
+    
+    for use_cache in [False,True]:
+        tracemalloc.start()
+        [loaded,_,_] = nifti_roi.load_prob_atlas(image_file,use_cache)
+        loaded[np.arange(0,len(probs),97)]
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        
+        assert peak < probs.nbytes/4
+
+def test_cluster_memberships_uncached(tmp_path,monkeypatch):
+    '''
+    Whole-cluster membership probabilities are the same with and without the atlas cache.
+    '''
+    monkeypatch.setattr(nifti_roi,"cache_dir",str(tmp_path / "cache"))
+    [image_file,probs] = make_prob_atlas(tmp_path,"prob.nii.gz")
+    
+    data = np.zeros((24,20,16),dtype=np.float32)
+    data[2:6,3:7,1:4] = 3
+    data[10:18,8:12,5:15] = 2
+    clusters = nifti_roi.sparse_clusters(data,1)
+    
+    results = [nifti_roi.cluster_memberships(clusters,nifti_roi.load_prob_atlas(image_file,use_cache)[0]) for use_cache in [False,True]]
+    
+    for cluster in range(2):
+        index = clusters["index"][clusters["offsets"][cluster]:clusters["offsets"][cluster + 1]]
+        assert np.allclose(results[0][0][cluster],probs[index].mean(axis=0))
+        assert np.array_equal(results[0][1][cluster],probs[index].max(axis=0))
+    
+    assert all(np.array_equal(a,b) for a,b in zip(*results))
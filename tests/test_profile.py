@@ -0,0 +1,59 @@
+'''
+Tests of the stage profiles (mem_stage): stages that overlap the stages of other threads are marked as concurrent,
+since their memory peaks and CPU time are process-wide.
+'''
+
+# Import modules
+import threading
+import tracemalloc
+
+import nifti_roi
+
+# Define functions
+
+def run_stages(overlap):
+    '''
+    Runs two stages (each allocating 1 MiB), in two overlapping threads or one after the other, and returns their
+    memory and profile records.
+    '''
+    nifti_roi.start_mem_report()
+    nifti_roi.start_profile()
+    barrier = threading.Barrier(2 if overlap else 1)
+    
+    def work(stage):
+        with nifti_roi.mem_stage(stage):
+            barrier.wait()
+            data = bytearray(2**20)
+            barrier.wait()
+            del data
+    
+    if overlap:
+        threads = [threading.Thread(target=work,args=(stage,)) for stage in ["first","second"]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        work("first")
+        work("second")
+    
+    mem_stats = list(nifti_roi.mem_stats)
+    prof_stats = list(nifti_roi.prof_stats)
+    tracemalloc.stop()
+    nifti_roi.prof_state["enabled"] = False
+    return mem_stats,prof_stats
+
+def test_mem_stage_single_thread():
+    [mem_stats,prof_stats] = run_stages(overlap=False)
+    assert [stats[3] for stats in mem_stats] == [False,False]
+    assert [rec["concurrent"] for rec in prof_stats] == [False,False]
+    assert all(stats[1] >= 2**20 for stats in mem_stats)
+
+def test_mem_stage_concurrent_threads(capsys):
+    [mem_stats,prof_stats] = run_stages(overlap=True)
+    assert [stats[3] for stats in mem_stats] == [True,True]
+    assert [rec["concurrent"] for rec in prof_stats] == [True,True]
+    
+    nifti_roi.mem_stats[:] = mem_stats
+    nifti_roi.print_mem_report()
+    assert "first *" in capsys.readouterr().out
@@ -0,0 +1,105 @@
+'''
+Tests of the mapping of stand-alone atlases onto the voxel grids of inputs (grid_map and match_atlas_grid).
+'''
+
+# Import modules
+import numpy as np
+import nibabel as nib
+import pytest
+
+import nifti_roi
+
+# Define functions
+
+def make_atlas(shape,affine):
+    '''
+    Returns a loaded stand-alone atlas (see load_atlases) with a distinct label per voxel.
+    '''
+    data = np.arange(1,int(np.prod(shape)) + 1,dtype=np.int32).reshape(shape)
+    return {"name":"atlas","data":data,"affine":affine,"sizes":nifti_roi.label_sizes(data)}
+
+def as_key(affine):
+    '''
+    Returns some affine as a (hashable) tuple of rows, as grid_map expects.
+    '''
+    return tuple(map(tuple,np.round(affine,6)))
+
+def test_grid_map():
+    '''
+    Input voxels map onto the nearest atlas voxel (or -1 outside the atlas), and mappings are reused by grid.
+    '''
+    atlas_shape = (10,12,9)
+    atlas_affine = np.diag([1.0,1.0,1.0,1.0])
+    atlas_affine[:3,3] = [-4.3,-5.1,-3.7]
+    
+    # Oblique, anisotropic and flipped input grid
+    shape = (7,6,5)
+    rotation = nib.eulerangles.euler2mat(0.3,0.1,-0.2)
+    affine = np.eye(4)
+    affine[:3,:3] = rotation @ np.diag([-1.6,1.3,2.1])
+    affine[:3,3] = [5.2,-3.9,-2.6]
+    
+    mapping = nifti_roi.grid_map(shape,as_key(affine),atlas_shape,as_key(atlas_affine))
+    
+    ijk = np.indices(shape).reshape(3,-1).T
+    vox = np.rint(nib.affines.apply_affine(np.linalg.inv(atlas_affine) @ affine,ijk)).astype(int)
+    inside = np.all((vox >= 0) & (vox < atlas_shape),axis=1)
+    expected = np.full(len(ijk),-1)
+    expected[inside] = np.ravel_multi_index(tuple(vox[inside].T),atlas_shape)
+    
+    assert np.array_equal(mapping.reshape(-1),expected)
+    assert 0 < inside.sum() < len(ijk)
+    assert not mapping.flags.writeable
+    
+    hits = nifti_roi.grid_map.cache_info().hits
+    
+    assert nifti_roi.grid_map(shape,as_key(affine),atlas_shape,as_key(atlas_affine)) is mapping
+    assert nifti_roi.grid_map.cache_info().hits == hits + 1
+
+def test_match_atlas_grid():
+    atlas_affine = np.eye(4)
+    atlas = make_atlas((8,8,8),atlas_affine)
+    
+    assert nifti_roi.match_atlas_grid(atlas,(8,8,8),atlas_affine) is atlas
+    assert nifti_roi.match_atlas_grid(atlas,(8,8,8),None) is atlas
+    
+    # 2 mm input grid, shifted by one atlas voxel
+    affine = np.diag([2.0,2.0,2.0,1.0])
+    affine[:3,3] = 1
+    matched = nifti_roi.match_atlas_grid(atlas,(5,4,4),affine)
+    
+    assert matched["data"].shape == (5,4,4)
+    assert matched["affine"] is affine
+    assert matched["data"][0,0,0] == atlas["data"][1,1,1]
+    assert matched["data"][1,2,3] == atlas["data"][3,5,7]
+    assert np.all(matched["data"][4] == 0)
+    assert matched["sizes"][atlas["data"][3,5,7]] == 1
+    
+    with pytest.raises(ValueError):
+        nifti_roi.match_atlas_grid(atlas,(4,4,4),None)
+    
+    affine[:3,3] = 100
+    with pytest.raises(ValueError):
+        nifti_roi.match_atlas_grid(atlas,(5,4,4),affine)
+
+def test_locate_other_grid(tmp_path):
+    '''
+    Inputs in another grid than the atlas report the same ROIs as inputs in the atlas grid.
+    '''
+    atlas = np.zeros((16,16,16),dtype=np.uint8)
+    atlas[:8] = 1
+    atlas[8:] = 2
+    nib.save(nib.Nifti1Image(atlas,np.eye(4)),tmp_path / "atlas.nii.gz")
+    with open(tmp_path / "atlas.csv","w") as f:
+        f.write("1,Left\n2,Right\n")
+    
+    locator = nifti_roi.RoiLocator([(str(tmp_path / "atlas.nii.gz"),str(tmp_path / "atlas.csv"))],thresh=1,use_cache=False)
+    [name] = locator.names
+    
+    data = np.zeros((16,16,16),dtype=np.float32)
+    data[2:6,2:6,2:6] = 3
+    data[10:14,10:14,10:14] = 2
+    low = data[::2,::2,::2]
+    
+    assert locator.locate(nib.Nifti1Image(data,np.eye(4)))[0]["rois"][name] == ["Left","Right"]
+    assert locator.locate(nib.Nifti1Image(low,np.diag([2.0,2.0,2.0,1.0])))[0]["rois"][name] == ["Left","Right"]
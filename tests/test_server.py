@@ -0,0 +1,112 @@
+'''
+Tests of the resident ROI query server: its HTTP transport (roilib.server), its query object (RoiServer), the
+loopback-only default and the server root directory.
+'''
+
+# Import modules
+import os
+import sys
+import subprocess
+import threading
+import http.server
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import nifti_roi
+from roilib import server
+
+# Define functions
+
+@pytest.fixture
+def files(tmp_path):
+    '''
+    Writes a stat map and a stand-alone atlas (in the same grid) to the server root directory.
+    '''
+    data = np.zeros((8,8,8),dtype=np.float32)
+    data[1:3,1:3,1:3] = 3
+    data[5:7,5:7,5:7] = 2
+    atlas = np.zeros((8,8,8),dtype=np.uint8)
+    atlas[:4] = 1
+    atlas[4:] = 2
+    
+    nib.save(nib.Nifti1Image(data,np.eye(4)),tmp_path / "stat.nii.gz")
+    nib.save(nib.Nifti1Image(atlas,np.eye(4)),tmp_path / "atlas.nii.gz")
+    with open(tmp_path / "atlas.csv","w") as f:
+        f.write("1,Left\n2,Right\n")
+    
+    return {name:str(tmp_path / name) for name in ["stat.nii.gz","atlas.nii.gz","atlas.csv"]}
+
+@pytest.fixture
+def address(files):
+    '''
+    Serves a RoiServer (rooted at the test directory) on a free loopback port.
+    '''
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1",0),server.RoiRequestHandler)
+    httpd.roi_server = nifti_roi.RoiServer(use_cache=False,root=os.path.dirname(files["stat.nii.gz"]))
+    thread = threading.Thread(target=httpd.serve_forever,daemon=True)
+    thread.start()
+    
+    yield f"127.0.0.1:{httpd.server_address[1]}"
+    
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_parse_address():
+    '''
+    Servers bind to loopback addresses by default, and other hosts are refused unless explicitly allowed.
+    '''
+    assert server.parse_address("8700") == ("127.0.0.1",8700)
+    assert server.parse_address("localhost:8700") == ("localhost",8700)
+    
+    with pytest.raises(ValueError):
+        server.parse_address("0.0.0.0:8700")
+    with pytest.raises(ValueError):
+        server.parse_address("127.0.0.1:port")
+    
+    assert server.parse_address("0.0.0.0:8700",allow_remote=True) == ("0.0.0.0",8700)
+
+def test_query_input(files,address):
+    '''
+    Input queries list the ROIs of a single atlas, or of several atlases keyed by atlas name.
+    '''
+    request = {"input":files["stat.nii.gz"],"atlas":files["atlas.nii.gz"],"atlas_info":files["atlas.csv"],"thresh":2.5}
+    
+    assert server.query_server(address,request)["rois"] == ["Left"]
+    
+    request = {"input":files["stat.nii.gz"],"atlases":[[files["atlas.nii.gz"],files["atlas.csv"]]]*2,"thresh":1}
+    
+    assert server.query_server(address,request)["rois"] == {"atlas":["Left","Right"],"atlas (2)":["Left","Right"]}
+
+def test_query_coords(files,address):
+    '''
+    Coordinate queries list the ROIs (and nearest labelled voxel distances) of each coordinate.
+    '''
+    request = {"coords":[[1,1,1],[6,6,6]],"atlases":[[files["atlas.nii.gz"],files["atlas.csv"]]],"nearest":True}
+    response = server.query_server(address,request)
+    
+    assert response["rois"] == {"atlas":[["Left"],["Right"]]}
+    assert response["distances"] == {"atlas":[0.0,0.0]}
+
+def test_query_root(files,address,tmp_path_factory):
+    '''
+    Queries may only name files in the server root directory (also through symbolic links).
+    '''
+    outside = str(tmp_path_factory.mktemp("outside") / "stat.nii.gz")
+    link = os.path.join(os.path.dirname(files["stat.nii.gz"]),"link.nii.gz")
+    nib.save(nib.load(files["stat.nii.gz"]),outside)
+    os.symlink(outside,link)
+    
+    for input_file in [outside,link]:
+        with pytest.raises(RuntimeError,match="PermissionError"):
+            server.query_server(address,{"input":input_file,"atlas":files["atlas.nii.gz"],"atlas_info":files["atlas.csv"]})
+
+def test_roilib_imports():
+    '''
+    roilib does not import nifti_roi (nor the heavy modules that nifti_roi defers).
+    '''
+    code = "import sys, roilib.server, roilib.stores, roilib.pipeline; print(sorted(m for m in ['nifti_roi','numpy','pandas'] if m in sys.modules))"
+    result = subprocess.run([sys.executable,"-c",code],capture_output=True,text=True,cwd=os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    
+    assert result.stdout.strip() == "[]"
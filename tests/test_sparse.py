@@ -0,0 +1,71 @@
+'''
+Tests of sparse clusters (sparse_clusters): clusters against scipy's (dense) connected component labelling, and the
+cluster cache of unchanged inputs.
+'''
+
+# Import modules
+import numpy as np
+import nibabel as nib
+import pytest
+from scipy import ndimage
+
+import nifti_roi
+from conftest import make_stat
+
+# Define functions
+
+def voxel_sets(labels,n_labels):
+    '''
+    Returns the set of (flat voxel index) sets of some labelled volume.
+    '''
+    flat = labels.ravel()
+    
+    return {frozenset(np.flatnonzero(flat == i).tolist()) for i in range(1,n_labels + 1)}
+
+@pytest.mark.parametrize("connectivity",[6,18,26])
+def test_sparse_clusters_parity(connectivity):
+    '''
+    Sparse clusters have the same voxels as scipy.ndimage.label components, and are enumerated by size.
+    '''
+    data = make_stat()
+    structure = ndimage.generate_binary_structure(3,nifti_roi.conn_rank[connectivity])
+    [labels,n_labels] = ndimage.label(data >= 1,structure)
+    
+    clusters = nifti_roi.sparse_clusters(data,1,connectivity)
+    
+    assert len(clusters["offsets"]) - 1 == n_labels
+    assert voxel_sets(nifti_roi.dense_clusters(clusters),n_labels) == voxel_sets(labels,n_labels)
+    assert np.all(np.diff(np.diff(clusters["offsets"])) >= 0)
+
+def test_sparse_clusters_empty():
+    '''
+    Volumes without suprathreshold voxels have no clusters.
+    '''
+    clusters = nifti_roi.sparse_clusters(np.zeros((4,4,4)),1)
+    
+    assert len(clusters["offsets"]) == 1
+    assert len(nifti_roi.sparse_table(clusters)) == 0
+
+def test_cluster_cache(tmp_path,monkeypatch):
+    '''
+    The sparse clusters of unchanged inputs are read from the cluster cache (for the same threshold and connectivity),
+    rather than clustered again.
+    '''
+    monkeypatch.setattr(nifti_roi,"cache_dir",str(tmp_path / "cache"))
+    data = make_stat(seed=13)
+    nib.save(nib.Nifti1Image(data,np.eye(4)),tmp_path / "stat.nii.gz")
+    nii_file = str(tmp_path / "stat.nii.gz")
+    atlas = {"name":"atlas","data":(np.arange(data.size) % 3).reshape(data.shape).astype(np.uint8),"affine":np.eye(4),"lut":np.array([None,"A","B"],dtype=object)}
+    
+    vol_rois = nifti_roi.get_file_atlas_rois(nii_file,[atlas],1,use_cache=True)
+    
+    prefetched = nifti_roi.read_input(nii_file,1,26,use_cache=True)
+    
+    assert prefetched["data"] is None
+    assert np.array_equal(prefetched["cached"][None]["index"],nifti_roi.sparse_clusters(data,1)["index"])
+    assert nifti_roi.read_input(nii_file,2,26,use_cache=True)["cached"][None] is None
+    assert nifti_roi.read_input(nii_file,1,6,use_cache=True)["cached"][None] is None
+    
+    monkeypatch.setattr(nifti_roi,"sparse_clusters",lambda *args: pytest.fail("cached clusters were clustered again"))
+    
+    assert nifti_roi.get_file_atlas_rois(nii_file,[atlas],1,use_cache=True) == vol_rois
@@ -0,0 +1,284 @@
+'''
+Tests of the results stores: recovery of interrupted writes, replacement of reprocessed files, the fixed CSV columns
+and concurrent writers of CSV files (CsvStore), SQLite databases (SqliteStore) and Parquet datasets (ParquetStore).
+'''
+
+# Import modules
+import os
+import csv
+import threading
+import sqlite3
+import multiprocessing
+
+import pandas as pd
+import pytest
+
+import nifti_roi
+from roilib.stores import CsvStore, SqliteStore, ParquetStore, store_backend
+
+# Define functions
+
+def read_rows(out_file):
+    '''
+    Returns the rows of some CSV file.
+    '''
+    with open(out_file,"r",newline="") as f:
+        return list(csv.reader(f))
+
+def write_rows(out_file,name,n_rows):
+    '''
+    Writes some rows (one per input file) to some CSV output file, reopening the store for each row (see write_spread).
+    '''
+    for i in range(n_rows):
+        nifti_roi.write_spread(f"{name}-{i}.nii.gz",out_file,[name])
+
+def roi_table(rois):
+    '''
+    Returns a cluster x ROI table (see overlap_table) with one cluster overlapping some ROIs.
+    '''
+    return pd.DataFrame({"Cluster Index":[1]*len(rois),
+                         "Cluster Voxels":[10]*len(rois),
+                         "MAX":[3.5]*len(rois),
+                         "MAX X":[1.0]*len(rois),
+                         "MAX Y":[2.0]*len(rois),
+                         "MAX Z":[3.0]*len(rois),
+                         "Label":list(range(1,len(rois) + 1)),
+                         "ROI":rois,
+                         "Voxels":[5]*len(rois),
+                         "% Cluster":[50.0]*len(rois),
+                         "% ROI":[25.0]*len(rois)})
+
+def write_store(out_file,name,n_files):
+    '''
+    Writes some input files (one ROI each) to some SQLite or Parquet output, with a single store (see store_backend).
+    '''
+    store = store_backend(out_file)(out_file,params={"thresh":0.95,"connectivity":26})
+    for i in range(n_files):
+        store.write([(f"{name}-{i}.nii.gz",None,[[name]],"")],[(None,roi_table([name]))],fingerprint=f"{name}{i}")
+    store.close()
+
+def journal_ends(out_file):
+    '''
+    Returns the journal offsets of some CSV output file.
+    '''
+    with open(out_file + ".fingerprints","r") as f:
+        return [int(line.rstrip("\n").split("\t")[2]) for line in f]
+
+def test_csv_store_recover(tmp_path):
+    '''
+    Rows written after the last journal entry (i.e. by an interrupted run) are removed when the store is reopened,
+    while rows written by batches and single inputs (write_spread) are kept.
+    '''
+    out_file = str(tmp_path / "out.csv")
+    
+    store = CsvStore(out_file,params={"thresh":0.95})
+    store.write([("a.nii.gz",None,[["A"]],"")],fingerprint="fa")
+    store.close()
+    nifti_roi.write_spread("b.nii.gz",out_file,["B"],thresh=2)
+    
+    with open(out_file,"a") as f:
+        f.write("/partial/c.nii.gz,,0.95,\"['C'")
+    
+    store = CsvStore(out_file,params={"thresh":0.95})
+    store.close()
+    
+    rows = read_rows(out_file)
+    
+    assert rows[0] == ["File","Volume","Threshold","ROIs","Error"]
+    assert [row[0].rsplit("/",1)[1] for row in rows[1:]] == ["a.nii.gz","b.nii.gz"]
+    assert [row[2] for row in rows[1:]] == ["0.95","2"]
+    assert store.done() == {"fa"}
+
+def test_csv_store_drop(tmp_path):
+    '''
+    Files that are processed again (e.g. with --force) replace their previous rows.
+    '''
+    out_file = str(tmp_path / "out.csv")
+    
+    store = CsvStore(out_file)
+    store.write([("a.nii.gz",0,[["A0"]],""),("a.nii.gz",1,[["A1"]],"")],fingerprint="fa")
+    store.write([("b.nii.gz",None,[["B"]],"")],fingerprint="fb")
+    store.write([("c.nii.gz",None,[[]],"Error: failed")],fingerprint="fc")
+    
+    assert store.done() == {"fa","fb"}
+    
+    store.drop(["a.nii.gz","c.nii.gz"])
+    store.write([("a.nii.gz",None,[["A"]],"")],fingerprint="fa2")
+    store.close()
+    
+    rows = read_rows(out_file)
+    
+    assert [(row[0].rsplit("/",1)[1],row[3]) for row in rows[1:]] == [("b.nii.gz","['B']"),("a.nii.gz","['A']")]
+    
+    store = CsvStore(out_file)
+    store.close()
+    
+    assert store.done() == {"fb","fa2"}
+
+def test_csv_store_columns(tmp_path):
+    '''
+    Rows are only appended to CSV files with the same columns.
+    '''
+    out_file = str(tmp_path / "out.csv")
+    
+    nifti_roi.write_spread("a.nii.gz",out_file,{"Atlas 1":["A"],"Atlas 2":["B"]})
+    
+    assert read_rows(out_file)[0] == ["File","Volume","Threshold","Atlas 1","Atlas 2","Error"]
+    
+    with pytest.raises(ValueError):
+        CsvStore(out_file,["ROIs"])
+    
+    assert nifti_roi.csv_name(str(tmp_path / "out.tsv")) == out_file
+
+def test_csv_store_legacy_append(tmp_path):
+    '''
+    Rows are appended to CSV files of earlier versions ('File' and 'ROIs' only) in their own layout.
+    '''
+    out_file = str(tmp_path / "out.csv")
+    
+    with open(out_file,"w") as f:
+        f.write("File,ROIs\n/data/old.nii.gz,\"['A']\"\n")
+    
+    nifti_roi.write_spread("new.nii.gz",out_file,["B","C"],volume=1,thresh=2)
+    
+    store = CsvStore(out_file)
+    store.write([("failed.nii.gz",None,[[]],"Error: failed")])
+    store.write([("again.nii.gz",None,[["D"]],"")],fingerprint="fa")
+    store.drop(["new.nii.gz"])
+    store.close()
+    
+    rows = read_rows(out_file)
+    
+    assert rows[:2] == [["File","ROIs"],["/data/old.nii.gz","['A']"]]
+    assert [row[0].rsplit("/",1)[1] for row in rows[2:]] == ["again.nii.gz"]
+    assert all(len(row) == 2 for row in rows)
+    assert journal_ends(out_file)[-1] == os.path.getsize(out_file)
+
+def test_csv_store_reopened_writer(tmp_path):
+    '''
+    A store opened while another store of the same output file is open waits for it to close, rather than removing
+    its (not yet journaled) rows.
+    '''
+    out_file = str(tmp_path / "out.csv")
+    
+    store = CsvStore(out_file)
+    store.writer.writerow([os.path.abspath("a.nii.gz"),"","","['A']",""])
+    store.file.flush()
+    
+    thread = threading.Thread(target=write_rows,args=(out_file,"b",1))
+    thread.start()
+    thread.join(0.5)
+    
+    assert thread.is_alive()
+    
+    store.journal.write(f"fa\t{os.path.abspath('a.nii.gz')}\t{os.path.getsize(out_file)}\n")
+    store.close()
+    thread.join()
+    
+    assert [row[0].rsplit("/",1)[1] for row in read_rows(out_file)[1:]] == ["a.nii.gz","b-0.nii.gz"]
+
+def test_csv_store_concurrent_writers(tmp_path):
+    '''
+    Several processes writing to the same output file keep every row, and the journal offsets of the rows of every
+    file remain row boundaries (also once some files are dropped).
+    '''
+    out_file = str(tmp_path / "out.csv")
+    
+    procs = [multiprocessing.Process(target=write_rows,args=(out_file,name,20)) for name in "abcd"]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    
+    rows = read_rows(out_file)
+    
+    assert len(rows) == 81
+    assert sorted(row[0].rsplit("/",1)[1] for row in rows[1:]) == sorted(f"{name}-{i}.nii.gz" for name in "abcd" for i in range(20))
+    
+    store = CsvStore(out_file)
+    store.drop([f"b-{i}.nii.gz" for i in range(20)])
+    store.close()
+    
+    with open(out_file,"rb") as f:
+        data = f.read()
+    ends = journal_ends(out_file)
+    
+    assert len(read_rows(out_file)) == 61
+    assert len(ends) == 60 and ends[-1] == len(data)
+    assert all(data[end - 1:end] == b"\n" for end in ends)
+
+def test_store_backend():
+    assert store_backend("out.db") is SqliteStore
+    assert store_backend("out.SQLITE") is SqliteStore
+    assert store_backend("out.parquet" + os.sep) is ParquetStore
+    assert store_backend("out.tsv") is CsvStore
+
+def test_sqlite_store(tmp_path):
+    '''
+    Files are recorded (with their ROIs) once per threshold and connectivity: rerunning them replaces their previous
+    results, and files with errors are not done.
+    '''
+    out_file = str(tmp_path / "out.db")
+    
+    store = SqliteStore(out_file,params={"thresh":0.95,"connectivity":26})
+    store.write([("a.nii.gz",None,[["A","B"]],"")],[(None,roi_table(["A","B"]))],fingerprint="fa")
+    store.write([("b.nii.gz",None,[[]],"Error: failed")],fingerprint="fb")
+    store.write([("a.nii.gz",None,[["C"]],"")],[(None,roi_table(["C"]))],fingerprint="fa2")
+    store.write([("a.nii.gz",None,[["A"]],"")],[(None,roi_table(["A"]))],fingerprint="fa3",thresh=2)
+    
+    assert store.done() == {"fa2","fa3"}
+    store.close()
+    
+    conn = sqlite3.connect(out_file)
+    runs = conn.execute("SELECT file, thresh, error FROM runs ORDER BY id").fetchall()
+    rois = conn.execute("SELECT runs.thresh, rois.roi, rois.voxels FROM rois JOIN runs ON rois.run = runs.id ORDER BY runs.id").fetchall()
+    conn.close()
+    
+    assert [(os.path.basename(file),thresh,error) for file,thresh,error in runs] == [("b.nii.gz",0.95,"Error: failed"),("a.nii.gz",0.95,""),("a.nii.gz",2,"")]
+    assert rois == [(0.95,"C",5),(2,"A",5)]
+
+def test_sqlite_store_concurrent_writers(tmp_path):
+    '''
+    Several processes writing to the same database keep the results of every file.
+    '''
+    out_file = str(tmp_path / "out.db")
+    
+    procs = [multiprocessing.Process(target=write_store,args=(out_file,name,10)) for name in "abcd"]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    
+    store = SqliteStore(out_file)
+    
+    assert store.done() == {f"{name}{i}" for name in "abcd" for i in range(10)}
+    assert store.conn.execute("SELECT COUNT(*) FROM rois").fetchone()[0] == 40
+    store.close()
+
+def test_parquet_store(tmp_path):
+    '''
+    Pending rows are written every 'flush_files' files and on close, each writer writing its own part files (with the
+    same schema, also for part files without ROIs), and files with errors are not done.
+    '''
+    out_file = str(tmp_path / "out.parquet")
+    
+    store = ParquetStore(out_file,params={"thresh":0.95},flush_files=2)
+    store.write([("a.nii.gz",0,[["A","B"]],""),("a.nii.gz",1,[[]],"")],[(0,roi_table(["A","B"]))],fingerprint="fa")
+    
+    assert not os.path.exists(out_file)
+    
+    store.write([("b.nii.gz",None,[[]],"Error: failed")],fingerprint="fb")
+    
+    assert len(os.listdir(out_file)) == 1
+    
+    store.write([("c.nii.gz",None,[["C"]],"")],[(None,roi_table(["C"]))],fingerprint="fc")
+    store.close()
+    write_store(out_file,"d",3)
+    
+    df = pd.read_parquet(out_file)
+    
+    assert len(os.listdir(out_file)) == 3
+    assert len({str(pd.read_parquet(os.path.join(out_file,part)).dtypes.to_dict()) for part in os.listdir(out_file)}) == 1
+    assert store.done() == {"fa","fc","d0","d1","d2"}
+    assert sorted(df["ROI"].dropna()) == ["A","B","C","d","d","d"]
+    assert df[df["File"].str.endswith("a.nii.gz")]["Volume"].tolist() == [0,0,1]
@@ -0,0 +1,106 @@
+'''
+Tests of z-slab streaming (stream_clusters): streamed clusters and atlas overlaps are identical to those of the
+in-memory path, for 3D and 4D inputs, and memory is bounded by the slab rather than the volume.
+'''
+
+# Import modules
+import tracemalloc
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import nifti_roi
+from conftest import make_stat
+
+# Define functions
+
+@pytest.fixture
+def atlas_files(tmp_path):
+    '''
+    Writes a stand-alone 2 mm atlas (with 7 interleaved labels) in the grid of the stat maps.
+    '''
+    affine = np.diag([2.0,2.0,2.0,1.0])
+    affine[:3,3] = [-20,-18,-16]
+    atlas_data = (np.arange(24*20*18) % 7).reshape((24,20,18)).astype(np.uint8)
+    nib.save(nib.Nifti1Image(atlas_data,affine),tmp_path / "atlas.nii.gz")
+    with open(tmp_path / "atlas.csv","w") as f:
+        f.write("".join(f"{label},ROI {label}\n" for label in range(1,7)))
+    
+    return str(tmp_path / "atlas.nii.gz"),str(tmp_path / "atlas.csv")
+
+@pytest.mark.parametrize("connectivity,slab",[(6,1),(18,4),(26,5)])
+def test_stream_clusters_parity(tmp_path,connectivity,slab):
+    '''
+    Streamed clusters (and their atlas overlaps) are identical to those of the in-memory path.
+    '''
+    data = make_stat(seed=1)
+    affine = np.diag([2.0,2.0,2.0,1.0])
+    affine[:3,3] = [-20,-18,-16]
+    nib.save(nib.Nifti1Image(data,affine),tmp_path / "stat.nii.gz")
+    atlas_data = (np.arange(data.size) % 7).reshape(data.shape).astype(np.uint8)
+    
+    clusters = nifti_roi.sparse_clusters(data,1,connectivity)
+    [clust_table,overlap] = nifti_roi.stream_clusters(str(tmp_path / "stat.nii.gz"),1,connectivity,slab,atlas_data,affine)
+    
+    assert clust_table.astype(float).equals(nifti_roi.sparse_table(clusters,affine).astype(float))
+    for streamed,in_memory in zip(overlap,nifti_roi.atlas_overlaps(clusters,[atlas_data])[0]):
+        assert np.array_equal(streamed,in_memory)
+
+@pytest.mark.parametrize("slab",[1,3,18,40])
+def test_stream_file_rois(tmp_path,atlas_files,slab):
+    '''
+    Streamed inputs (3D and 4D) report the same ROIs and cluster x ROI tables as inputs loaded into memory.
+    '''
+    [atlas] = nifti_roi.load_atlases([atlas_files],use_cache=False,table=True)
+    affine = nib.load(atlas_files[0]).affine
+    
+    data = np.stack([make_stat(seed=seed) for seed in [4,5]],axis=3)
+    nib.save(nib.Nifti1Image(data,affine),tmp_path / "four.nii.gz")
+    nib.save(nib.Nifti1Image(data[...,0],affine),tmp_path / "three.nii.gz")
+    
+    for nii_file in [str(tmp_path / "three.nii.gz"),str(tmp_path / "four.nii.gz")]:
+        in_memory = nifti_roi.get_file_atlas_rois(nii_file,[atlas],1.5,26,0,table=True)
+        streamed = nifti_roi.get_file_atlas_rois(nii_file,[atlas],1.5,26,slab,table=True)
+        
+        assert [(volume,roi_lists) for volume,roi_lists,_ in streamed] == [(volume,roi_lists) for volume,roi_lists,_ in in_memory]
+        assert len(in_memory[0][1][0]) > 1
+        for (_,_,streamed_tables),(_,_,tables) in zip(streamed,in_memory):
+            assert streamed_tables[0].astype(str).equals(tables[0].astype(str))
+
+def test_stream_clusters_4d(tmp_path):
+    '''
+    4D inputs are streamed one volume at a time, which must be given.
+    '''
+    data = np.stack([make_stat(seed=seed) for seed in [6,7]],axis=3)
+    nib.save(nib.Nifti1Image(data,np.eye(4)),tmp_path / "four.nii.gz")
+    
+    for volume in range(2):
+        [clust_table,_] = nifti_roi.stream_clusters(str(tmp_path / "four.nii.gz"),1,26,4,affine=np.eye(4),volume=volume)
+        expected = nifti_roi.sparse_table(nifti_roi.sparse_clusters(data[...,volume],1,26),np.eye(4))
+        
+        assert clust_table.astype(float).equals(expected.astype(float))
+    
+    with pytest.raises(ValueError):
+        nifti_roi.stream_clusters(str(tmp_path / "four.nii.gz"),1,26,4)
+
+def test_stream_clusters_memory(tmp_path):
+    '''
+    The peak memory of streaming a large (uncompressed) input is a fraction of its size.
+    '''
+    data = np.zeros((96,96,256),dtype=np.float32)
+    data[10:20,10:20,5:120] = 3
+    data[50:60,40:80,60:70] = 2
+    nib.save(nib.Nifti1Image(data,np.eye(4)),tmp_path / "large.nii")
+    nib.save(nib.Nifti1Image(data[:8,:8,:8],np.eye(4)),tmp_path / "small.nii")
+    
+    # Deferred modules are imported by a first (small) input, rather than counted
+    nifti_roi.stream_clusters(str(tmp_path / "small.nii"),1,26,8)
+    
+    tracemalloc.start()
+    [clust_table,_] = nifti_roi.stream_clusters(str(tmp_path / "large.nii"),1,26,8)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    
+    assert clust_table["Voxels"].tolist() == [11500,4000]
+    assert peak < data.nbytes/4
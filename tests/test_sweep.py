@@ -0,0 +1,75 @@
+'''
+Tests of threshold sweeps (sweep_clusters and proc_sweep): the clusters, overlaps and written ROIs of each threshold
+are identical to those of clustering at that threshold alone.
+'''
+
+# Import modules
+import csv
+
+import numpy as np
+import nibabel as nib
+import pandas as pd
+import pytest
+
+import nifti_roi
+from conftest import make_stat
+
+# Define functions
+
+@pytest.mark.parametrize("connectivity",[6,18,26])
+def test_sweep_clusters_parity(connectivity):
+    data = make_stat(seed=10)
+    affine = np.diag([2.0,2.0,2.0,1.0])
+    atlas_data = (np.arange(data.size) % 5).reshape(data.shape).astype(np.uint8)
+    thresholds = [2.5,0.5,1,1.5,2]
+    
+    sweep = nifti_roi.sweep_clusters(data,thresholds,connectivity,affine,[atlas_data])
+    
+    assert [thresh for thresh,_,_ in sweep] == sorted(thresholds,reverse=True)
+    
+    for thresh,clust_table,overlaps in sweep:
+        [cluster_data,expected] = nifti_roi.find_clusters(data,thresh,connectivity,affine)
+        
+        pd.testing.assert_frame_equal(clust_table,expected,check_exact=False,rtol=1e-12)
+        for swept,single in zip(overlaps[0],nifti_roi.atlas_overlaps(cluster_data,[atlas_data])[0]):
+            assert np.array_equal(swept,single)
+
+def test_sweep_clusters_ties():
+    '''
+    Voxels equal to a threshold are included at that threshold.
+    '''
+    rng = np.random.default_rng(11)
+    data = rng.standard_normal((20,17,13))
+    data[rng.random(data.shape) < 0.1] = 1.0
+    
+    for thresh,clust_table,_ in nifti_roi.sweep_clusters(data,[0,0.5,1.0,1.5],26):
+        pd.testing.assert_frame_equal(clust_table,nifti_roi.find_clusters(data,thresh,26)[1],check_exact=False,rtol=1e-12)
+
+def test_proc_sweep(tmp_path):
+    '''
+    Sweeps write the same ROIs as runs at each threshold alone (one row for each threshold with overlapping ROIs).
+    '''
+    atlas = (np.arange(24*20*18) % 5).reshape((24,20,18)).astype(np.uint8)
+    nib.save(nib.Nifti1Image(atlas,np.eye(4)),tmp_path / "atlas.nii.gz")
+    with open(tmp_path / "atlas.csv","w") as f:
+        f.write("".join(f"{label},ROI {label}\n" for label in range(1,5)))
+    atlases = [(str(tmp_path / "atlas.nii.gz"),str(tmp_path / "atlas.csv"))]
+    
+    nib.save(nib.Nifti1Image(make_stat(seed=12),np.eye(4)),tmp_path / "stat.nii.gz")
+    nii_file = str(tmp_path / "stat.nii.gz")
+    thresholds = [1,2,3,10]
+    
+    out_file = nifti_roi.proc_sweep(nii_file,str(tmp_path / "sweep.csv"),thresholds,atlases=atlases,use_cache=False)
+    
+    with open(out_file,"r",newline="") as f:
+        rows = {float(row["Threshold"]):row["ROIs"] for row in csv.DictReader(f)}
+    
+    [atlas] = nifti_roi.load_atlases(atlases,use_cache=False)
+    expected = dict()
+    for thresh in thresholds:
+        [roi_list] = nifti_roi.get_file_atlas_rois(nii_file,[atlas],thresh)[0][1]
+        if roi_list:
+            expected[float(thresh)] = str(roi_list)
+    
+    assert rows == expected
+    assert sorted(rows) == [1,2,3]